@@ -15,6 +15,10 @@
 # Code for creating a BVH out of Tilt Brush data
 # Usage:
 #   RTree.from_bounds_iter()
+#   RTree.from_bounds_str()   -- faster, and doesn't need rtree
+#   ArrayRTree.from_storage() -- flat-array form of an existing tree
+#   ArrayRTree.write(), ArrayRTree.load() -- see "Binary format"
+#   ArrayRTree.query_rays(), query_frustums(), query_boxes()
 
 import os
 import struct
@@ -23,9 +27,11 @@ from cStringIO import StringIO
 
 try:
   import rtree
+  _CustomStorage = rtree.index.CustomStorage
 except ImportError:
-  print "You need to install rtree (https://pypi.org/project/Rtree/)."
-  sys.exit(1)
+  # Only RTree.from_bounds_iter() needs it
+  rtree = None
+  _CustomStorage = object
 
 
 # ---------------------------------------------------------------------------
@@ -94,7 +100,7 @@ class BinaryReader(object):
     return (bmin, bmax)
 
 
-class RTreeStorageDict(rtree.index.CustomStorage):
+class RTreeStorageDict(_CustomStorage):
   def __init__(self):
     self.datas = {}
     self.cached_nodes = {}
@@ -141,6 +147,9 @@ class RTreeStorageDict(rtree.index.CustomStorage):
 class RTree(object):
   @classmethod
   def from_bounds_iter(cls, bounds_iter, leaf_capacity_multiplier=1):
+    if rtree is None:
+      print "You need to install rtree (https://pypi.org/project/Rtree/)."
+      sys.exit(1)
     storage = RTreeStorageDict()
     p = rtree.index.Property()
     p.dimension = 3
@@ -152,24 +161,44 @@ class RTree(object):
     index.close()
     return cls(storage, 1)
 
+  @classmethod
+  def from_bounds_str(cls, bounds_iter, leaf_capacity_multiplier=1):
+    """Like from_bounds_iter(), but bulk-loads with ArrayRTree."""
+    import numpy
+    ids = []
+    bounds = []
+    for (item_id, coords, _) in bounds_iter:
+      ids.append(item_id)
+      bounds.append(coords)
+    leaf_capacity = int(LEAF_CAPACITY * leaf_capacity_multiplier)
+    tree = ArrayRTree.from_bounds(ids, numpy.array(bounds).reshape(-1, 2, 3), leaf_capacity)
+    return cls(tree.to_storage(leaf_capacity), 1)
+
   def __init__(self, storage, header_id=1):
     self.header = None          # RTreeHeader
     self.root = None            # RTreeNode
     self.nodes_by_id = {}       # dict<int, RTreeNode>
 
     self.header = RTreeHeader(storage.datas[header_id])
-    self.root = self._recursive_create_node(storage, self.header.rootId)
+    self.root = self._create_nodes(storage, self.header.rootId)
 
-  def _recursive_create_node(self, storage, node_id):
-    node_data = storage.datas[node_id]
-    assert node_data != 'deleted'
-    node = self.nodes_by_id[node_id] = RTreeNode(node_id, node_data)
-    if node.is_index():
-      for c in node.children:
-        assert c.data is None
-        c.node = self._recursive_create_node(storage, c.id)
-      
-    return node
+  def _create_nodes(self, storage, root_id):
+    root = None
+    stack = [(root_id, None)]
+    while stack:
+      node_id, parent_child = stack.pop()
+      node_data = storage.datas[node_id]
+      assert node_data != 'deleted'
+      node = self.nodes_by_id[node_id] = RTreeNode(node_id, node_data)
+      if parent_child is None:
+        root = node
+      else:
+        parent_child.node = node
+      if node.is_index():
+        for c in node.children:
+          assert c.data is None
+          stack.append((c.id, c))
+    return root
 
   def dfs_iter(self):
     from collections import deque
@@ -181,6 +210,35 @@ class RTree(object):
         q.extend(c.node for c in n.children)
 
 
+# Node::storeToByteArray, for children without data. See RTreeNode.
+_NODE_HEADER_FORMAT = "III"
+_NODE_HEADER_SIZE = struct.calcsize(_NODE_HEADER_FORMAT)
+_NODE_BOUNDS_SIZE = struct.calcsize("<6d")
+_child_dtype = None
+
+def decode_node_page(data):
+  """Decodes a node page without creating an object per child.
+  Returns (nodeType, level, child_ids, child_bounds, bounds), where
+  child_ids is an (n,) uint64 array and child_bounds is (n, 2, 3).
+  Falls back to RTreeNode if any child has attached data."""
+  import numpy
+  global _child_dtype
+  if _child_dtype is None:
+    _child_dtype = numpy.dtype([('bounds', '<f8', (2, 3)), ('id', '<u8'), ('data_len', '<u4')])
+  node_type, level, num_children = struct.unpack_from(_NODE_HEADER_FORMAT, data)
+  end = _NODE_HEADER_SIZE + num_children * _child_dtype.itemsize
+  if len(data) == end + _NODE_BOUNDS_SIZE:
+    children = numpy.frombuffer(data, _child_dtype, num_children, _NODE_HEADER_SIZE)
+    if not children['data_len'].any():
+      bounds = numpy.frombuffer(data, '<f8', 6, end).reshape(2, 3)
+      return node_type, level, children['id'], children['bounds'], bounds
+  node = RTreeNode(None, data)
+  return (node.nodeType, node.level,
+          numpy.array([c.id for c in node.children], dtype=numpy.uint64),
+          numpy.array([c.bounds for c in node.children], dtype=numpy.float64).reshape(-1, 2, 3),
+          numpy.array(node.bounds, dtype=numpy.float64))
+
+
 class RTreeHeader(object):
   # RTree::storeHeader
   #  id_type    root
@@ -319,3 +377,704 @@ class RTreeChild(object):
     if self.data is not None:
       description = " + %d bytes" % len(self.data)
     return "leaf %4d: %s%s" % (self.id, str_bounds(self.bounds), description)
+
+
+# ---------------------------------------------------------------------------
+# Surface area heuristic
+# ---------------------------------------------------------------------------
+
+# Relative costs of culling a node, and of drawing a batch (leaf) and each
+# item in it. Only the ratios matter.
+SAH_TRAVERSAL_COST = 1.0
+SAH_LEAF_COST = 1.0
+SAH_ITEM_COST = 0.01
+
+def surface_areas(bounds):
+  """Vectorized BBox.surface_area() over (..., 2, 3) bounds."""
+  d = bounds[..., 1, :] - bounds[..., 0, :]
+  return 2 * (d[..., 0] * d[..., 1] + d[..., 1] * d[..., 2] + d[..., 2] * d[..., 0])
+
+
+def sah_partition(bounds, leaf_capacity, split_cost, max_leaves=None,
+                  leaf_cost=SAH_LEAF_COST, item_cost=SAH_ITEM_COST):
+  """Partitions items into leaves of at most leaf_capacity items, splitting
+  top-down wherever that lowers the surface area heuristic.
+  bounds is an (n, 2, 3) array. split_cost is the cost of one more leaf
+  regardless of its size, ie the parent's area times the traversal cost.
+  Optional splits are only made while the result fits in max_leaves.
+  Returns a list of index arrays."""
+  import numpy
+  def min_leaves(n):
+    return _ceil_div(n, leaf_capacity)
+
+  centers = bounds.mean(axis=1)
+  leaves = []
+  stack = [numpy.arange(len(bounds))]
+  while stack:
+    idx = stack.pop()
+    n = len(idx)
+    b = bounds[idx]
+    forced = n > leaf_capacity
+    if not forced and max_leaves is not None:
+      committed = len(leaves) + 1 + sum(min_leaves(len(s)) for s in stack)
+      if committed >= max_leaves:
+        leaves.append(idx)
+        continue
+    counts = numpy.arange(1, n)
+    if forced:
+      # Don't split in a way that needs more leaves than necessary
+      allowed = (-(-counts // leaf_capacity) - (-(n - counts) // leaf_capacity)) == min_leaves(n)
+    best = None
+    for axis in xrange(3):
+      order = numpy.argsort(centers[idx, axis], kind='mergesort')
+      lo = b[order, 0]
+      hi = b[order, 1]
+      # Bounds of [0, k) and [k, n) for every k
+      left = numpy.stack([numpy.minimum.accumulate(lo)[:-1],
+                          numpy.maximum.accumulate(hi)[:-1]], axis=1)
+      right = numpy.stack([numpy.minimum.accumulate(lo[::-1])[::-1][1:],
+                           numpy.maximum.accumulate(hi[::-1])[::-1][1:]], axis=1)
+      costs = (surface_areas(left) * (leaf_cost + item_cost * counts) +
+               surface_areas(right) * (leaf_cost + item_cost * (n - counts)) +
+               split_cost)
+      if forced:
+        costs[~allowed] = numpy.inf
+      if len(costs) == 0:
+        continue
+      k = int(numpy.argmin(costs))
+      if best is None or costs[k] < best[0]:
+        best = (costs[k], idx[order], k + 1)
+    no_split_cost = (surface_areas(numpy.array([b[:, 0].min(axis=0), b[:, 1].max(axis=0)])) *
+                     (leaf_cost + item_cost * n))
+    if best is not None and (forced or best[0] < no_split_cost):
+      _, idx, k = best
+      stack.append(idx[k:])
+      stack.append(idx[:k])
+    else:
+      leaves.append(idx)
+  return leaves
+
+
+# ---------------------------------------------------------------------------
+# Binary format
+# ---------------------------------------------------------------------------
+
+# Layout of a .tbvh file. Everything is little-endian, and each section
+# starts on a 16-byte boundary so it can be mapped directly as an array.
+#
+#   Header (64 bytes)
+#     char[4]  magic "TBVH"
+#     u32      version
+#     u32      header size
+#     u32      node count
+#     u32      item count
+#     u32      height
+#     u64      offset of nodes
+#     u64      offset of item ids
+#     u64      offset of item bounds
+#     u64      file size
+#     u32[2]   reserved
+#   Nodes (32 bytes each), breadth-first with the root first
+#     f32[3]   bounds min
+#     f32[3]   bounds max
+#     u32      first child node (index nodes) or first item (leaves)
+#     u16      child or item count
+#     u16      level; 0 for leaves
+#   Item ids (u32 each), grouped by leaf
+#   Item bounds (f32[3] min, f32[3] max each)
+#
+# Bounds are rounded outwards to float32, so they never shrink.
+
+BVH_MAGIC = 'TBVH'
+BVH_VERSION = 1
+_BVH_HEADER_FORMAT = '<4s5I4Q2I'
+_BVH_HEADER_SIZE = struct.calcsize(_BVH_HEADER_FORMAT)
+assert _BVH_HEADER_SIZE == 64
+
+def _bvh_node_dtype():
+  import numpy
+  return numpy.dtype([('bounds', '<f4', (2, 3)), ('first', '<u4'),
+                      ('count', '<u2'), ('level', '<u2')])
+
+def _align(offset, alignment=16):
+  return _ceil_div(offset, alignment) * alignment
+
+def _to_f32_bounds(bounds):
+  """Converts (..., 2, 3) bounds to float32, rounding min down and max up."""
+  import numpy
+  ret = numpy.asarray(bounds).astype('<f4')
+  lo, hi = ret[..., 0, :], ret[..., 1, :]
+  inf = numpy.float32(numpy.inf)
+  lo[...] = numpy.where(lo > bounds[..., 0, :], numpy.nextafter(lo, -inf), lo)
+  hi[...] = numpy.where(hi < bounds[..., 1, :], numpy.nextafter(hi, inf), hi)
+  return ret
+
+
+class InvalidBvh(Exception):
+  pass
+
+
+# ---------------------------------------------------------------------------
+# ArrayRTree
+# ---------------------------------------------------------------------------
+
+def _ceil_div(a, b):
+  return -(-a // b)
+
+
+def _str_groups(centers, capacity):
+  """Sort-Tile-Recursive grouping.
+  centers is an (n, 3) array. Returns (order, starts): order is a permutation
+  of range(n), and starts are the offsets in order at which each group of at
+  most *capacity* items begins."""
+  import numpy
+  n = len(centers)
+  num_groups = _ceil_div(n, capacity)
+  # Number of slabs along x; each is then split into tiles along y, and
+  # each tile into groups along z
+  num_slabs = max(1, int(numpy.ceil(num_groups ** (1 / 3.0))))
+  slab_size = _ceil_div(num_groups, num_slabs) * capacity
+  tiles_per_slab = max(1, int(numpy.ceil((slab_size // capacity) ** .5)))
+  tile_size = _ceil_div(_ceil_div(slab_size, capacity), tiles_per_slab) * capacity
+
+  order = numpy.argsort(centers[:, 0], kind='mergesort')
+  pos = numpy.arange(n)
+  slab = pos // slab_size
+  order = order[numpy.lexsort((centers[order, 1], slab))]
+  tile = slab * tiles_per_slab + (pos - slab * slab_size) // tile_size
+  order = order[numpy.lexsort((centers[order, 2], tile))]
+  # Tiles are contiguous; start a new group every *capacity* items within a tile
+  tile_start = numpy.concatenate([[0], numpy.flatnonzero(numpy.diff(tile)) + 1])
+  rank_in_tile = pos - numpy.repeat(tile_start, numpy.diff(numpy.append(tile_start, n)))
+  starts = numpy.flatnonzero(rank_in_tile % capacity == 0)
+  return order, starts
+
+
+def _concatenate_ranges(first, count):
+  """Returns the concatenation of range(f, f + c) for each (f, c)."""
+  import numpy
+  offsets = numpy.cumsum(count) - count
+  return numpy.repeat(first - offsets, count) + numpy.arange(count.sum())
+
+
+def frustum_planes(view_projection):
+  """Returns the 6 inward-facing planes of the frustum of a 4x4 view-projection
+  matrix, for use with ArrayRTree.query_frustums(). The matrix transforms
+  column vectors, with clip space -w <= x, y, z <= w."""
+  import numpy
+  m = numpy.asarray(view_projection, dtype=numpy.float64)
+  planes = numpy.array([m[3] + m[0], m[3] - m[0],    # left, right
+                        m[3] + m[1], m[3] - m[1],    # bottom, top
+                        m[3] + m[2], m[3] - m[2]])   # near, far
+  return planes / numpy.linalg.norm(planes[:, :3], axis=1)[:, numpy.newaxis]
+
+
+class ArrayRTree(object):
+  """An RTree stored as flat numpy arrays.
+
+  Nodes are numbered breadth-first; the root is node 0, and the children
+  of every index node are contiguous.
+    node_bounds  (M, 2, 3) float64: (min, max) of each node
+    node_level   (M,) 0 for leaves, increasing towards the root
+    node_first   (M,) index of the first child node (index nodes), or of
+                 the first item (leaves)
+    node_count   (M,) number of children or items
+    item_ids     (N,) int64 leaf-specific ids (like stroke numbers), grouped by leaf
+    item_bounds  (N, 2, 3) float64"""
+  def __init__(self, node_bounds, node_level, node_first, node_count, item_ids, item_bounds):
+    self.node_bounds = node_bounds
+    self.node_level = node_level
+    self.node_first = node_first
+    self.node_count = node_count
+    self.item_ids = item_ids
+    self.item_bounds = item_bounds
+
+  @classmethod
+  def from_bounds(cls, ids, bounds,
+                  leaf_capacity=LEAF_CAPACITY, index_capacity=INDEX_CAPACITY):
+    """Bulk-loads with Sort-Tile-Recursive.
+    ids is an (n,) array; bounds is an (n, 2, 3) array of (min, max)."""
+    import numpy
+    ids = numpy.asarray(ids, dtype=numpy.int64)
+    bounds = numpy.asarray(bounds, dtype=numpy.float64).reshape(-1, 2, 3)
+    assert len(ids) == len(bounds) > 0
+
+    order, starts = _str_groups(bounds.mean(axis=1), leaf_capacity)
+    item_ids = ids[order]
+    item_bounds = bounds[order]
+    # Built bottom-up; each entry is (bounds, first, count) for one level
+    levels = [cls._group_bounds(item_bounds, starts)]
+    while len(levels[-1][0]) > 1:
+      child_bounds = levels[-1][0]
+      order, starts = _str_groups(child_bounds.mean(axis=1), index_capacity)
+      # Reorder the level below so each parent's children are contiguous
+      levels[-1] = tuple(a[order] for a in levels[-1])
+      levels.append(cls._group_bounds(child_bounds[order], starts))
+
+    # Renumber breadth-first, from the root down: each level's nodes must be
+    # in the order of their parents
+    levels.reverse()
+    for i in xrange(len(levels)):
+      bounds, first, count = levels[i]
+      order = _concatenate_ranges(first, count)
+      new_first = numpy.cumsum(count) - count
+      levels[i] = (bounds, new_first, count)
+      if i + 1 < len(levels):
+        levels[i + 1] = tuple(a[order] for a in levels[i + 1])
+      else:
+        item_ids = item_ids[order]
+        item_bounds = item_bounds[order]
+    level_offsets = numpy.cumsum([0] + [len(b) for (b, _, _) in levels])
+    node_first = []
+    for i, (_, first, _) in enumerate(levels):
+      if i + 1 < len(levels):
+        node_first.append(first + level_offsets[i + 1])
+      else:
+        node_first.append(first)
+    return cls(
+      numpy.concatenate([b for (b, _, _) in levels]),
+      numpy.concatenate([numpy.full(len(b), len(levels) - 1 - i, dtype=numpy.uint32)
+                         for i, (b, _, _) in enumerate(levels)]),
+      numpy.concatenate(node_first).astype(numpy.int64),
+      numpy.concatenate([c for (_, _, c) in levels]).astype(numpy.int64),
+      item_ids, item_bounds)
+
+  @classmethod
+  def from_storage(cls, storage, header_id=1):
+    """Loads a tree from a RTreeStorageDict (see RTree) without creating
+    per-node or per-child objects. Any data attached to leaf entries is dropped."""
+    import numpy
+    from collections import deque
+    header = RTreeHeader(storage.datas[header_id])
+    node_bounds, node_level, node_first, node_count = [], [], [], []
+    item_ids, item_bounds = [], []
+    num_items = 0
+    # Breadth-first, so children are numbered contiguously
+    q = deque([header.rootId])
+    num_nodes = 1
+    while q:
+      node_data = storage.datas[q.popleft()]
+      assert node_data != 'deleted'
+      node_type, level, ids, bounds, own_bounds = decode_node_page(node_data)
+      node_bounds.append(own_bounds)
+      node_level.append(level)
+      node_count.append(len(ids))
+      if node_type == RTreeNode.PERSISTENT_LEAF:
+        node_first.append(num_items)
+        num_items += len(ids)
+        item_ids.append(ids)
+        item_bounds.append(bounds)
+      else:
+        node_first.append(num_nodes)
+        num_nodes += len(ids)
+        q.extend(ids.tolist())
+    return cls(numpy.array(node_bounds).reshape(-1, 2, 3),
+               numpy.array(node_level, dtype=numpy.uint32),
+               numpy.array(node_first, dtype=numpy.int64),
+               numpy.array(node_count, dtype=numpy.int64),
+               numpy.concatenate(item_ids).astype(numpy.int64),
+               numpy.concatenate(item_bounds).reshape(-1, 2, 3))
+
+  @staticmethod
+  def _group_bounds(bounds, starts):
+    """Returns (bounds, first, count) for groups of bounds beginning at starts."""
+    import numpy
+    group_bounds = numpy.empty((len(starts), 2, 3))
+    group_bounds[:, 0] = numpy.minimum.reduceat(bounds[:, 0], starts)
+    group_bounds[:, 1] = numpy.maximum.reduceat(bounds[:, 1], starts)
+    return group_bounds, starts, numpy.diff(numpy.append(starts, len(bounds)))
+
+  def __len__(self):
+    return len(self.node_bounds)
+
+  def is_leaf(self, node):
+    return self.node_level[node] == 0
+
+  def height(self):
+    return int(self.node_level[0]) + 1
+
+  def children(self, node):
+    """Returns the range of child nodes (index nodes) or items (leaves)."""
+    first = int(self.node_first[node])
+    return xrange(first, first + int(self.node_count[node]))
+
+  def sah_cost(self, traversal_cost=SAH_TRAVERSAL_COST, leaf_cost=SAH_LEAF_COST,
+               item_cost=SAH_ITEM_COST):
+    """Returns the expected cost of culling and drawing the tree, for a query
+    that hits a random part of the root's bounds. Visiting an index node costs
+    traversal_cost per child tested; visiting a leaf costs leaf_cost plus
+    item_cost per item."""
+    import numpy
+    areas = surface_areas(self.node_bounds)
+    if areas[0] <= 0:
+      return 0.0
+    is_leaf = self.node_level == 0
+    costs = numpy.where(is_leaf, leaf_cost + item_cost * self.node_count,
+                        traversal_cost * self.node_count)
+    return float((areas * costs).sum() / areas[0])
+
+  def sah_optimized(self, leaf_capacity=LEAF_CAPACITY, index_capacity=INDEX_CAPACITY,
+                    traversal_cost=SAH_TRAVERSAL_COST, leaf_cost=SAH_LEAF_COST,
+                    item_cost=SAH_ITEM_COST):
+    """Re-splits and merges the leaves under each lowest-level index node to
+    minimize the surface area heuristic. Upper levels are left alone.
+    Prints the cost before and after, and returns a new ArrayRTree."""
+    import numpy
+    if self.height() < 2:
+      return self
+    leaf_start = int(numpy.flatnonzero(self.node_level == 0)[0])
+    parents = numpy.flatnonzero(self.node_level == 1)
+    groups = []           # item indices, per new leaf
+    parent_counts = []    # new leaves, per parent
+    for parent in parents:
+      leaves = self.children(parent)
+      old = [numpy.arange(self.node_first[leaf], self.node_first[leaf] + self.node_count[leaf])
+             for leaf in leaves]
+      items = numpy.concatenate(old)
+      split_cost = surface_areas(self.node_bounds[parent]) * traversal_cost
+      new = [items[g] for g in sah_partition(
+        self.item_bounds[items], leaf_capacity, split_cost, index_capacity,
+        leaf_cost, item_cost)]
+
+      def cost(group_list):
+        return sum(surface_areas(numpy.array([self.item_bounds[g, 0].min(axis=0),
+                                              self.item_bounds[g, 1].max(axis=0)])) *
+                   (leaf_cost + item_cost * len(g)) + split_cost for g in group_list)
+      if len(new) > index_capacity or cost(new) >= cost(old):
+        new = old
+      groups.extend(new)
+      parent_counts.append(len(new))
+
+    order = numpy.concatenate(groups)
+    leaf_count = numpy.array([len(g) for g in groups], dtype=numpy.int64)
+    leaf_first = numpy.cumsum(leaf_count) - leaf_count
+    item_bounds = self.item_bounds[order]
+    leaf_bounds, _, _ = self._group_bounds(item_bounds, leaf_first)
+
+    node_first = self.node_first[:leaf_start].copy()
+    node_count = self.node_count[:leaf_start].copy()
+    parent_counts = numpy.array(parent_counts, dtype=numpy.int64)
+    node_count[parents] = parent_counts
+    node_first[parents] = leaf_start + numpy.cumsum(parent_counts) - parent_counts
+    ret = ArrayRTree(
+      numpy.concatenate([self.node_bounds[:leaf_start], leaf_bounds]),
+      numpy.concatenate([self.node_level[:leaf_start],
+                         numpy.zeros(len(groups), dtype=self.node_level.dtype)]),
+      numpy.concatenate([node_first, leaf_first]),
+      numpy.concatenate([node_count, leaf_count]),
+      self.item_ids[order], item_bounds)
+    print "SAH cost: %.3f -> %.3f  leaves: %d -> %d" % (
+      self.sah_cost(traversal_cost, leaf_cost, item_cost),
+      ret.sah_cost(traversal_cost, leaf_cost, item_cost),
+      len(self) - leaf_start, len(groups))
+    return ret
+
+  def to_bytes(self):
+    """Returns the tree in the .tbvh format; see "Binary format" above."""
+    import numpy
+    if len(self.item_ids) and (self.item_ids.min() < 0 or self.item_ids.max() > 0xffffffff):
+      raise InvalidBvh("Item ids must fit in 32 bits")
+    if self.node_count.max() > 0xffff:
+      raise InvalidBvh("Too many children in one node")
+    nodes = numpy.zeros(len(self), dtype=_bvh_node_dtype())
+    nodes['bounds'] = _to_f32_bounds(self.node_bounds)
+    nodes['first'] = self.node_first
+    nodes['count'] = self.node_count
+    nodes['level'] = self.node_level
+    item_ids = self.item_ids.astype('<u4')
+    item_bounds = _to_f32_bounds(self.item_bounds)
+
+    nodes_offset = _align(_BVH_HEADER_SIZE)
+    item_ids_offset = _align(nodes_offset + nodes.nbytes)
+    item_bounds_offset = _align(item_ids_offset + item_ids.nbytes)
+    file_size = item_bounds_offset + item_bounds.nbytes
+    chunks = [struct.pack(_BVH_HEADER_FORMAT, BVH_MAGIC, BVH_VERSION, _BVH_HEADER_SIZE,
+                          len(self), len(self.item_ids), self.height(),
+                          nodes_offset, item_ids_offset, item_bounds_offset, file_size, 0, 0)]
+    for (offset, array) in ((nodes_offset, nodes),
+                            (item_ids_offset, item_ids),
+                            (item_bounds_offset, item_bounds)):
+      chunks.append('\0' * (offset - sum(map(len, chunks))))
+      chunks.append(array.tobytes())
+    return ''.join(chunks)
+
+  def write(self, filename):
+    with open(filename, 'wb') as outf:
+      outf.write(self.to_bytes())
+
+  @classmethod
+  def from_bytes(cls, data):
+    """Loads a tree from .tbvh data, without copying. data may be a string,
+    or anything else supporting the buffer protocol, like a numpy.memmap.
+    The arrays of the returned tree are read-only views of data, with
+    float32 bounds. Raises InvalidBvh if the header is malformed; use
+    validate() to check the rest."""
+    import numpy
+    if len(data) < _BVH_HEADER_SIZE:
+      raise InvalidBvh("Truncated header")
+    (magic, version, header_size, num_nodes, num_items, height,
+     nodes_offset, item_ids_offset, item_bounds_offset, file_size,
+     _, _) = struct.unpack(_BVH_HEADER_FORMAT,
+                          numpy.frombuffer(data, 'u1', _BVH_HEADER_SIZE).tobytes())
+    if magic != BVH_MAGIC:
+      raise InvalidBvh("Not a .tbvh file")
+    if version != BVH_VERSION:
+      raise InvalidBvh("Unsupported .tbvh version %d" % version)
+    if file_size != len(data) or header_size != _BVH_HEADER_SIZE:
+      raise InvalidBvh("Size mismatch")
+    node_dtype = _bvh_node_dtype()
+    for (offset, size) in ((nodes_offset, num_nodes * node_dtype.itemsize),
+                           (item_ids_offset, num_items * 4),
+                           (item_bounds_offset, num_items * 24)):
+      if offset % 16 != 0 or offset < _BVH_HEADER_SIZE or offset + size > file_size:
+        raise InvalidBvh("Bad section offset %d" % offset)
+    if num_nodes == 0:
+      raise InvalidBvh("No nodes")
+    nodes = numpy.frombuffer(data, node_dtype, num_nodes, nodes_offset)
+    tree = cls(nodes['bounds'], nodes['level'], nodes['first'], nodes['count'],
+               numpy.frombuffer(data, '<u4', num_items, item_ids_offset),
+               numpy.frombuffer(data, '<f4', num_items * 6, item_bounds_offset
+                                ).reshape(num_items, 2, 3))
+    if tree.height() != height:
+      raise InvalidBvh("Height mismatch")
+    return tree
+
+  @classmethod
+  def load(cls, filename, use_mmap=True):
+    """Loads a .tbvh file; see from_bytes()."""
+    import numpy
+    if use_mmap:
+      return cls.from_bytes(numpy.memmap(filename, dtype='u1', mode='r'))
+    with open(filename, 'rb') as inf:
+      return cls.from_bytes(inf.read())
+
+  def validate(self):
+    """Checks the tree's structure. Raises InvalidBvh on the first problem."""
+    import numpy
+    num_nodes = len(self)
+    level = self.node_level.astype(numpy.int64)
+    first = self.node_first.astype(numpy.int64)
+    count = self.node_count.astype(numpy.int64)
+    if numpy.any(count == 0) and num_nodes > 1:
+      raise InvalidBvh("Empty node")
+    if numpy.any(self.node_bounds[:, 0] > self.node_bounds[:, 1]):
+      raise InvalidBvh("Inverted node bounds")
+    if numpy.any(self.item_bounds[:, 0] > self.item_bounds[:, 1]):
+      raise InvalidBvh("Inverted item bounds")
+
+    is_leaf = level == 0
+    index = numpy.flatnonzero(~is_leaf)
+    leaves = numpy.flatnonzero(is_leaf)
+    # Children of index nodes must be exactly nodes 1..M-1, in order
+    expected = 1
+    for (f, c) in zip(first[index], count[index]):
+      if f != expected:
+        raise InvalidBvh("Children are not contiguous and breadth-first")
+      expected += c
+    if expected != num_nodes:
+      raise InvalidBvh("Unreachable or missing nodes")
+    # Items must be exactly 0..N-1, in leaf order
+    if numpy.any(first[leaves] != numpy.cumsum(count[leaves]) - count[leaves]):
+      raise InvalidBvh("Leaf items are not contiguous")
+    if count[leaves].sum() != len(self.item_ids):
+      raise InvalidBvh("Unreferenced or missing items")
+
+    # Levels decrease by one from parent to child, and children are inside parents
+    parent = numpy.repeat(index, count[index])
+    if numpy.any(level[1:] != level[parent] - 1):
+      raise InvalidBvh("Bad node levels")
+    if (numpy.any(self.node_bounds[1:, 0] < self.node_bounds[parent, 0]) or
+        numpy.any(self.node_bounds[1:, 1] > self.node_bounds[parent, 1])):
+      raise InvalidBvh("Child node outside its parent")
+    item_leaf = numpy.repeat(leaves, count[leaves])
+    if (numpy.any(self.item_bounds[:, 0] < self.node_bounds[item_leaf, 0]) or
+        numpy.any(self.item_bounds[:, 1] > self.node_bounds[item_leaf, 1])):
+      raise InvalidBvh("Item outside its leaf")
+
+  # Batched queries. Each traverses the tree for many queries at once,
+  # keeping a frontier of (query, node) pairs instead of a stack per query.
+
+  def _get_subtree_items(self):
+    """Returns (start, end) arrays: the items under each node are range(start, end).
+    This relies on the breadth-first layout, which keeps subtrees contiguous."""
+    import numpy
+    if getattr(self, '_subtree_items', None) is None:
+      first = self.node_first.astype(numpy.int64)
+      count = self.node_count.astype(numpy.int64)
+      start = numpy.where(self.node_level == 0, first, 0)
+      end = numpy.where(self.node_level == 0, first + count, 0)
+      for level in xrange(1, self.height()):
+        nodes = numpy.flatnonzero(self.node_level == level)
+        start[nodes] = start[first[nodes]]
+        end[nodes] = end[first[nodes] + count[nodes] - 1]
+      self._subtree_items = (start, end)
+    return self._subtree_items
+
+  def _batch_query(self, num_queries, test, contains=None):
+    """test(query_indices, bounds) returns a bool mask of the boxes to descend
+    into or accept. If passed, contains(query_indices, bounds) returns a mask
+    of the boxes entirely inside the query, whose items are accepted without
+    further tests. Returns (query_indices, item_indices) for accepted items."""
+    import numpy
+    node_first = self.node_first.astype(numpy.int64)
+    node_count = self.node_count.astype(numpy.int64)
+    is_leaf = self.node_level == 0
+    q = numpy.arange(num_queries)
+    n = numpy.zeros(num_queries, dtype=numpy.int64)
+    out_q, out_i = [], []
+    while len(q):
+      mask = test(q, self.node_bounds[n])
+      q, n = q[mask], n[mask]
+      if contains is not None:
+        inside = contains(q, self.node_bounds[n])
+        if inside.any():
+          start, end = self._get_subtree_items()
+          count = end[n[inside]] - start[n[inside]]
+          out_q.append(numpy.repeat(q[inside], count))
+          out_i.append(_concatenate_ranges(start[n[inside]], count))
+          q, n = q[~inside], n[~inside]
+      leaf = is_leaf[n]
+      lq, ln = q[leaf], n[leaf]
+      if len(ln):
+        count = node_count[ln]
+        items = _concatenate_ranges(node_first[ln], count)
+        iq = numpy.repeat(lq, count)
+        mask = test(iq, self.item_bounds[items])
+        out_q.append(iq[mask])
+        out_i.append(items[mask])
+      iq, inode = q[~leaf], n[~leaf]
+      count = node_count[inode]
+      q = numpy.repeat(iq, count)
+      n = _concatenate_ranges(node_first[inode], count)
+    if not out_q:
+      return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64)
+    return numpy.concatenate(out_q), numpy.concatenate(out_i)
+
+  def _group_by_query(self, num_queries, q, items, keys):
+    """Returns a list, per query, of item ids sorted by keys."""
+    import numpy
+    if keys.dtype.kind in 'iu' and len(keys) and (
+        float(keys.max() - keys.min() + 1) * num_queries < 2 ** 62):
+      # Much faster than lexsort for the large results of frustum queries
+      order = numpy.argsort(q * (keys.max() - keys.min() + 1) + (keys - keys.min()))
+    else:
+      order = numpy.lexsort((keys, q))
+    q = q[order]
+    ids = self.item_ids[items[order]]
+    splits = numpy.searchsorted(q, numpy.arange(1, num_queries))
+    return numpy.split(ids, splits)
+
+  def query_boxes(self, bmins, bmaxs):
+    """Returns, per box, an array of ids of items whose bounds overlap it.
+    bmins and bmaxs are (Q, 3) arrays."""
+    import numpy
+    bmins = numpy.asarray(bmins, dtype=numpy.float64).reshape(-1, 3)
+    bmaxs = numpy.asarray(bmaxs, dtype=numpy.float64).reshape(-1, 3)
+    def test(q, bounds):
+      return (numpy.all(bounds[:, 0] <= bmaxs[q], axis=1) &
+              numpy.all(bounds[:, 1] >= bmins[q], axis=1))
+    def contains(q, bounds):
+      return (numpy.all(bounds[:, 0] >= bmins[q], axis=1) &
+              numpy.all(bounds[:, 1] <= bmaxs[q], axis=1))
+    q, items = self._batch_query(len(bmins), test, contains)
+    return self._group_by_query(len(bmins), q, items, self.item_ids[items])
+
+  def query_frustums(self, planes):
+    """Returns, per frustum, an array of ids of items whose bounds are not
+    entirely outside it. This is conservative: boxes near a corner of the
+    frustum may be returned although they are outside.
+    planes is an (F, P, 4) array of planes (a, b, c, d), with normals pointing
+    inwards: a point is inside if ax + by + cz + d >= 0 for every plane."""
+    import numpy
+    planes = numpy.asarray(planes, dtype=numpy.float64)
+    if planes.ndim == 2:
+      planes = planes[numpy.newaxis]
+    normals = planes[..., :3]
+    def corner_distances(q, bounds, furthest):
+      # For each plane, the corner of the box furthest along (or against) its normal
+      n = normals[q]                                    # (k, P, 3)
+      lo = bounds[:, numpy.newaxis, 0]
+      hi = bounds[:, numpy.newaxis, 1]
+      corner = numpy.where((n >= 0) == furthest, hi, lo)
+      return (n * corner).sum(axis=2) + planes[q, :, 3]
+    def test(q, bounds):
+      return numpy.all(corner_distances(q, bounds, True) >= 0, axis=1)
+    def contains(q, bounds):
+      return numpy.all(corner_distances(q, bounds, False) >= 0, axis=1)
+    q, items = self._batch_query(len(planes), test, contains)
+    return self._group_by_query(len(planes), q, items, self.item_ids[items])
+
+  def query_rays(self, origins, directions, max_distance=float('inf'), batch_size=4096,
+                 return_distances=False):
+    """Returns, per ray, an array of ids of items whose bounds the ray hits,
+    nearest first. origins and directions are (R, 3) arrays; distances are in
+    units of the direction's length.
+    If return_distances, returns (ids, distances) per ray instead."""
+    import numpy
+    origins = numpy.asarray(origins, dtype=numpy.float64).reshape(-1, 3)
+    directions = numpy.asarray(directions, dtype=numpy.float64).reshape(-1, 3)
+    results = []
+    for start in xrange(0, len(origins), batch_size):
+      o = origins[start:start + batch_size]
+      with numpy.errstate(divide='ignore', invalid='ignore'):
+        inv = 1.0 / directions[start:start + batch_size]
+      def slab(q, bounds):
+        """Returns (t_enter, t_exit) for each ray and box."""
+        with numpy.errstate(invalid='ignore'):
+          t1 = (bounds[:, 0] - o[q]) * inv[q]
+          t2 = (bounds[:, 1] - o[q]) * inv[q]
+        # fmin/fmax ignore the NaNs from 0 * inf, ie rays in the plane of a slab
+        t_enter = numpy.fmin(t1, t2).max(axis=1)
+        t_exit = numpy.fmax(t1, t2).min(axis=1)
+        return t_enter, t_exit
+      def test(q, bounds):
+        t_enter, t_exit = slab(q, bounds)
+        return (t_exit >= numpy.maximum(t_enter, 0)) & (t_enter <= max_distance)
+      q, items = self._batch_query(len(o), test)
+      t_enter = numpy.maximum(slab(q, self.item_bounds[items])[0], 0)
+      ids = self._group_by_query(len(o), q, items, t_enter)
+      if return_distances:
+        order = numpy.lexsort((t_enter, q))
+        dists = numpy.split(t_enter[order], numpy.searchsorted(q[order], numpy.arange(1, len(o))))
+        results.extend(zip(ids, dists))
+      else:
+        results.extend(ids)
+    return results
+
+  def pick(self, origins, directions, max_distance=float('inf')):
+    """Returns (ids, distances) arrays with the nearest item hit by each ray,
+    or -1 and inf for rays that hit nothing. Only bounds are tested."""
+    import numpy
+    hits = self.query_rays(origins, directions, max_distance, return_distances=True)
+    ids = numpy.array([h[0][0] if len(h[0]) else -1 for h in hits], dtype=numpy.int64)
+    dists = numpy.array([h[1][0] if len(h[1]) else numpy.inf for h in hits])
+    return ids, dists
+
+  def to_storage(self, leaf_capacity=LEAF_CAPACITY, index_capacity=INDEX_CAPACITY):
+    """Returns a RTreeStorageDict in libspatialindex's page layout, readable by RTree()."""
+    # The header goes in page 1 and the root in page 0, as libspatialindex does
+    page_ids = [0] + range(2, len(self) + 1)
+    storage = RTreeStorageDict()
+    nodes_in_level = [0] * self.height()
+    for level in self.node_level:
+      nodes_in_level[level] += 1
+    storage.datas[1] = struct.pack(
+      "<QIdIIIddI?IQI%dI" % self.height(),
+      page_ids[0], 1, 0.7, index_capacity, leaf_capacity, 32, 0.4, 0.3, 3, True,
+      len(self), len(self.item_ids), self.height(), *nodes_in_level)
+    for node in xrange(len(self)):
+      chunks = []
+      if self.is_leaf(node):
+        chunks.append(struct.pack("III", RTreeNode.PERSISTENT_LEAF, 0, self.node_count[node]))
+        for i in self.children(node):
+          chunks.append(struct.pack("<6dQI", *(tuple(self.item_bounds[i].ravel()) +
+                                               (self.item_ids[i], 0))))
+      else:
+        chunks.append(struct.pack("III", RTreeNode.PERSISTENT_INDEX,
+                                  self.node_level[node], self.node_count[node]))
+        for i in self.children(node):
+          chunks.append(struct.pack("<6dQI", *(tuple(self.node_bounds[i].ravel()) +
+                                               (page_ids[i], 0))))
+      chunks.append(struct.pack("<6d", *self.node_bounds[node].ravel()))
+      storage.datas[page_ids[node]] = ''.join(chunks)
+    return storage
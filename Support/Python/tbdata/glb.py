@@ -38,6 +38,14 @@ STRUCT_FORMAT = {
   5126: 'f'              # FLOAT
 }
 
+# numpy dtypes, for accessor.componentType
+NUMPY_DTYPE = {
+  5120: 'i1', 5121: 'u1',    # BYTE, UBYTE
+  5122: '<i2', 5123: '<u2',  # SHORT, USHORT
+  5124: '<i4', 5125: '<u4',  # INT, UINT
+  5126: '<f4'                # FLOAT
+}
+
 
 # From itertools docs
 def grouper(n, iterable, fillvalue=None):
@@ -178,6 +186,33 @@ class BaseGltf(object):
     if count_per_element == 1: return flat
     else: return list(grouper(count_per_element, flat))
 
+  def get_accessor_array(self, accessor):
+    """Returns accessor data as a read-only numpy array that views bin_chunk.
+    The shape is (count,) for SCALAR and (count, n) otherwise.
+    Unlike get_accessor_data, this respects byteStride and does not need
+    dereference()."""
+    import numpy
+    buffer_view = accessor.get('bufferView_')
+    if buffer_view is None:
+      buffer_view = self.json['bufferViews'][accessor['bufferView']]
+    dtype = numpy.dtype(NUMPY_DTYPE[accessor['componentType']])
+    count_per_element = SIZES[accessor['type']]
+    # gltf1 has byteStride on the accessor; gltf2 on the bufferView
+    stride = (accessor.get('byteStride') or buffer_view.get('byteStride') or
+              dtype.itemsize * count_per_element)
+    start = buffer_view.get('byteOffset', 0) + accessor.get('byteOffset', 0)
+    count = accessor['count']
+    if count == 0:
+      data = numpy.zeros((0, count_per_element), dtype=dtype)
+    else:
+      data = numpy.ndarray((count, count_per_element), dtype=dtype, buffer=self.bin_chunk,
+                           offset=start, strides=(stride, dtype.itemsize))
+    return data[:, 0] if count_per_element == 1 else data
+
+
+# backwards-compat: compare_glb and unpack_glb use the old name
+BaseGlb = BaseGltf
+
 
 class Gltf(BaseGltf):
   def __init__(self, filename):
@@ -0,0 +1,233 @@
+# Copyright 2020 The Tilt Brush Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Structural diff of parsed json, tuned for glTF
+# Usage:
+#   rules = [Ignore('asset/generator'), Rewrite('images/*/uri', '^refimage', 'media', which=1)]
+#   for difference in diff(json_a, json_b, rules):
+#     print(format_difference(difference))
+#
+# Paths are '/'-separated. Dict members are named by key. Elements of lists
+# whose elements all have unique 'name' properties (eg glTF 2 meshes) are
+# named by that property, so inserting an object doesn't make every later
+# object look different. Lists of scalars, and lists of the same length,
+# are compared element by element. Other lists are aligned by content;
+# their elements are named by index (in a, except for elements only in b).
+
+from __future__ import print_function
+
+import collections
+import difflib
+import fnmatch
+import json
+import re
+
+
+Difference = collections.namedtuple('Difference', 'op path a b')
+# op is '+' (only in b), '-' (only in a), or '~' (changed)
+
+
+class Rule(object):
+  """Base class for rules that apply at paths matching a pattern.
+  Patterns are '/'-separated fnmatch patterns, one per path segment."""
+  def __init__(self, pattern):
+    self.pattern = pattern
+    self._segments = [re.compile(fnmatch.translate(p)) for p in pattern.split('/')]
+
+  def matches(self, path):
+    return (len(path) == len(self._segments) and
+            all(r.match(p) for (r, p) in zip(self._segments, path)))
+
+  def __repr__(self):
+    return '%s(%r)' % (type(self).__name__, self.pattern)
+
+
+class Ignore(Rule):
+  """Ignores differences at, and underneath, matching paths."""
+  pass
+
+
+class Rewrite(Rule):
+  """Applies re.sub(regex, replacement) to matching string values before
+  comparing them. which is 0 or 1 to only rewrite values from one side."""
+  def __init__(self, pattern, regex, replacement, which=(0, 1)):
+    super(Rewrite, self).__init__(pattern)
+    self.regex = re.compile(regex)
+    self.replacement = replacement
+    self.which = (which,) if isinstance(which, int) else tuple(which)
+
+  def apply(self, value, side):
+    if side in self.which and isinstance(value, basestring):
+      return self.regex.sub(self.replacement, value)
+    return value
+
+
+def _leaf_key(value):
+  # 1 and 1.0 are equal in json
+  if type(value) is float and value.is_integer():
+    value = int(value)
+  return '%s:%r' % (type(value).__name__, value)
+
+
+def _element_key(value):
+  """Returns a hashable summary of value, for aligning lists.
+  Doesn't sort keys, since that disables the fast C encoder; equal dicts
+  with different key order only align less well."""
+  if type(value) is dict or type(value) is list:
+    return json.dumps(value, separators=(',', ':'))
+  return _leaf_key(value)
+
+
+def _all_scalars(lst):
+  for elt in lst:
+    if type(elt) is dict or type(elt) is list:
+      return False
+  return True
+
+
+class _Differ(object):
+  def __init__(self, rules):
+    self.ignores = [r for r in rules if isinstance(r, Ignore)]
+    self.rewrites = [r for r in rules if isinstance(r, Rewrite)]
+
+  def is_ignored(self, path):
+    return any(rule.matches(path) for rule in self.ignores)
+
+  def diff(self, a, b, path):
+    # Deep == is done in C and stops at the first difference, so this is
+    # the cheapest way to skip identical subtrees
+    if (a == b and type(a) is type(b)) or self.is_ignored(path):
+      return
+    if type(a) is dict and type(b) is dict:
+      for difference in self.diff_dicts(a, b, path):
+        yield difference
+    elif type(a) is list and type(b) is list:
+      for difference in self.diff_lists(a, b, path):
+        yield difference
+    else:
+      for rule in self.rewrites:
+        if rule.matches(path):
+          a, b = rule.apply(a, 0), rule.apply(b, 1)
+      if _leaf_key(a) != _leaf_key(b):
+        yield Difference('~', path, a, b)
+
+  def diff_dicts(self, a, b, path):
+    for key in sorted(set(a) | set(b)):
+      child = path + (unicode(key),)
+      if key not in b:
+        if not self.is_ignored(child):
+          yield Difference('-', child, a[key], None)
+      elif key not in a:
+        if not self.is_ignored(child):
+          yield Difference('+', child, None, b[key])
+      else:
+        for difference in self.diff(a[key], b[key], child):
+          yield difference
+
+  def diff_lists(self, a, b, path):
+    names_a, names_b = get_element_names(a), get_element_names(b)
+    if names_a is not None and names_b is not None:
+      by_name = [dict(zip(names_a, a)), dict(zip(names_b, b))]
+      for difference in self.diff_named(names_a, names_b, by_name, path):
+        yield difference
+      return
+
+    if len(a) == len(b) or (_all_scalars(a) and _all_scalars(b)):
+      # eg min/max, matrices, colors: a changed value should show as changed
+      for difference in self.diff_positional(a, b, path):
+        yield difference
+      return
+
+    # Align unnamed elements by content, so an insertion only shows as an insertion
+    keys = [map(_element_key, a), map(_element_key, b)]
+    matcher = difflib.SequenceMatcher(None, keys[0], keys[1], autojunk=False)
+    for (op, i1, i2, j1, j2) in matcher.get_opcodes():
+      if op == 'equal':
+        continue
+      if op == 'replace':
+        # Compare replaced elements pairwise, and the excess as added/removed
+        n = min(i2 - i1, j2 - j1)
+        for (i, j) in zip(xrange(i1, i1 + n), xrange(j1, j1 + n)):
+          for difference in self.diff(a[i], b[j], path + (unicode(i),)):
+            yield difference
+        i1, j1 = i1 + n, j1 + n
+      for i in xrange(i1, i2):
+        if not self.is_ignored(path + (unicode(i),)):
+          yield Difference('-', path + (unicode(i),), a[i], None)
+      for j in xrange(j1, j2):
+        if not self.is_ignored(path + (unicode(j),)):
+          yield Difference('+', path + (unicode(j),), None, b[j])
+
+  def diff_positional(self, a, b, path):
+    n = min(len(a), len(b))
+    for i in xrange(n):
+      for difference in self.diff(a[i], b[i], path + (unicode(i),)):
+        yield difference
+    for i in xrange(n, len(a)):
+      if not self.is_ignored(path + (unicode(i),)):
+        yield Difference('-', path + (unicode(i),), a[i], None)
+    for j in xrange(n, len(b)):
+      if not self.is_ignored(path + (unicode(j),)):
+        yield Difference('+', path + (unicode(j),), None, b[j])
+
+  def diff_named(self, names_a, names_b, by_name, path):
+    # Report in the order of a, then new elements of b
+    seen = set(names_a)
+    for name in names_a + [n for n in names_b if n not in seen]:
+      child = path + (name,)
+      if name not in by_name[1]:
+        if not self.is_ignored(child):
+          yield Difference('-', child, by_name[0][name], None)
+      elif name not in by_name[0]:
+        if not self.is_ignored(child):
+          yield Difference('+', child, None, by_name[1][name])
+      else:
+        for difference in self.diff(by_name[0][name], by_name[1][name], child):
+          yield difference
+
+
+def get_element_names(lst):
+  """Returns the 'name' of every element of lst, or None if they aren't
+  all dicts with unique string names."""
+  names = []
+  for elt in lst:
+    if type(elt) is not dict or not isinstance(elt.get('name'), basestring):
+      return None
+    names.append(elt['name'])
+  if len(set(names)) != len(names):
+    return None
+  return names
+
+
+def diff(a, b, rules=()):
+  """Yields a Difference for each difference between a and b, lazily, so
+  callers can stop early or stream the output. Equal subtrees are skipped
+  without being walked."""
+  return _Differ(rules).diff(a, b, ())
+
+
+def format_value(value, max_length=200):
+  text = json.dumps(value, sort_keys=True, separators=(',', ':'))
+  if len(text) > max_length:
+    text = text[:max_length - 3] + '...'
+  return text
+
+
+def format_difference(difference):
+  path = '/'.join(difference.path) or '/'
+  if difference.op == '-':
+    return '- %s: %s' % (path, format_value(difference.a))
+  elif difference.op == '+':
+    return '+ %s: %s' % (path, format_value(difference.b))
+  return '~ %s: %s -> %s' % (path, format_value(difference.a), format_value(difference.b))
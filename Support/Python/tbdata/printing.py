@@ -146,74 +146,94 @@ def get_replacements_by_guid(replacements_by_name):
 
 def convert_brushes(tilt, replacements_by_name, show_removed=False):
   """Convert brushes to 3d-printable versions, or remove their strokes from the tilt."""
-  replacements = get_replacements_by_guid(replacements_by_name)
+  apply_brush_replacements(tilt, [replacements_by_name], show_removed)
+
+
+def get_brush_index_table(index_to_guid, replacements, brush_lookup):
+  """Returns (lut, remove) arrays, indexed by brush index, for one
+  replacement table. lut[i] is the new index for brush i; remove[i] is True
+  if strokes using brush i should be removed (in which case lut[i] == i).
+  May append new brushes to index_to_guid."""
+  lut = numpy.arange(len(index_to_guid))
+  remove = numpy.zeros(len(index_to_guid), dtype=bool)
+  for i, guid in enumerate(index_to_guid[:]):
+    name = brush_lookup.guid_to_name.get(guid, guid)
+    try:
+      new_guid = replacements[guid]
+    except KeyError:
+      print "%d: Don't know what to do with brush %s" % (i, name)
+    else:
+      new_name = brush_lookup.guid_to_name.get(new_guid, new_guid)
+      if new_guid is None:
+        print "%d: Remove %s" % (i, name)
+        remove[i] = True
+      else:
+        if guid == new_guid:
+          print "%d: Keep %s" % (i, name)
+        elif name == new_name:
+          print "%d: Replace %s/%s -> %s/%s" % (i, name, guid, new_name, new_guid)
+        else:
+          print "%d: Replace %s -> %s" % (i, name, new_name)
+        try:
+          new_idx = index_to_guid.index(new_guid)
+        except ValueError:
+          new_idx = len(index_to_guid)
+          index_to_guid.append(new_guid)
+        lut[i] = new_idx
+  # Brushes added above map to themselves
+  extra = numpy.arange(len(lut), len(index_to_guid))
+  return numpy.concatenate([lut, extra]), numpy.concatenate([remove, extra < 0])
+
+
+def apply_brush_replacements(tilt, replacement_tables, show_removed=False):
+  """Like calling convert_brushes() once per table in replacement_tables,
+  but touches each stroke only once.
+  If show_removed, strokes are rendered in magenta instead of removed."""
   brush_lookup = BrushLookup.get()
+  strokes = tilt.sketch.strokes
+  original = numpy.array([stroke.brush_idx for stroke in strokes], dtype=int)
+  current = original.copy()
+  removed = numpy.zeros(len(strokes), dtype=bool)
 
   with tilt.mutable_metadata() as dct:
     index_to_guid = dct['BrushIndex']
 
-    # First, show us what brushes the tilt file uses
-    used_guids = Counter()
-    for stroke in tilt.sketch.strokes:
-      guid = index_to_guid[stroke.brush_idx]
-      used_guids[guid] += 1
-    print "Brushes used:"
-    for guid, n in sorted(used_guids.items(), key=lambda p:-p[1]):
-      print "  %5d %s" % (n, brush_lookup.guid_to_name.get(guid))
-    sys.stdout.flush()
-    del used_guids
-
-    index_to_new_index = {}
-
-    for i, guid in enumerate(index_to_guid):
-      name = brush_lookup.guid_to_name.get(guid, guid)
-      try:
-        new_guid = replacements[guid]
-      except KeyError:
-        print "%d: Don't know what to do with brush %s" % (i, name)
-        index_to_new_index[i] = i
-      else:
-        new_name = brush_lookup.guid_to_name.get(new_guid, new_guid)
-        if new_guid is None:
-          print "%d: Remove %s" % (i, name)
-          index_to_new_index[i] = None
-        else:
-          if guid == new_guid:
-            print "%d: Keep %s" % (i, name)
-          elif name == new_name:
-            print "%d: Replace %s/%s -> %s/%s" % (i, name, guid, new_name, new_guid)
-          else:
-            print "%d: Replace %s -> %s" % (i, name, new_name)
-          try:
-            new_idx = index_to_guid.index(new_guid)
-          except ValueError:
-            new_idx = len(index_to_guid)
-            index_to_guid.append(new_guid)
-          index_to_new_index[i] = new_idx
-
-  brush_indices_to_remove = set(i for (i, new_i) in index_to_new_index.items() if new_i is None)
-
-  if brush_indices_to_remove:
-    old_len = len(tilt.sketch.strokes)
-    if show_removed:
-      # Render in magenta instead of removing
-      for stroke in tilt.sketch.strokes:
-        if stroke.brush_idx in brush_indices_to_remove:
-          stroke.brush_color = (1, 0, 1, 1)
-        else:
-          stroke.brush_color = stroke.brush_color
-    else:
-      tilt.sketch.strokes[:] = filter(
-        lambda s: s.brush_idx not in brush_indices_to_remove,
-        tilt.sketch.strokes)
-    new_len = len(tilt.sketch.strokes)
-    print "Strokes %d -> %d" % (old_len, new_len)
+    for replacements_by_name in replacement_tables:
+      replacements = get_replacements_by_guid(replacements_by_name)
 
-  for stroke in tilt.sketch.strokes:
-    new_idx = index_to_new_index[stroke.brush_idx]
-    # Might be none if it's a removed brush
-    if new_idx is not None:
-      stroke.brush_idx = new_idx
+      # First, show us what brushes the tilt file uses
+      if show_removed:
+        counts = numpy.bincount(current, minlength=len(index_to_guid))
+      else:
+        counts = numpy.bincount(current[~removed], minlength=len(index_to_guid))
+      used_guids = Counter()
+      for i in numpy.flatnonzero(counts):
+        used_guids[index_to_guid[i]] += counts[i]
+      print "Brushes used:"
+      for guid, n in sorted(used_guids.items(), key=lambda p:-p[1]):
+        print "  %5d %s" % (n, brush_lookup.guid_to_name.get(guid))
+      sys.stdout.flush()
+      del used_guids
+
+      lut, remove = get_brush_index_table(index_to_guid, replacements, brush_lookup)
+      old_len = len(strokes) if show_removed else numpy.count_nonzero(~removed)
+      removed |= remove[current]
+      current = lut[current]
+      if remove.any():
+        new_len = len(strokes) if show_removed else numpy.count_nonzero(~removed)
+        print "Strokes %d -> %d" % (old_len, new_len)
+
+  if show_removed:
+    # Render in magenta instead of removing
+    for i, stroke in enumerate(strokes):
+      if removed[i]:
+        stroke.brush_color = (1, 0, 1, 1)
+      else:
+        stroke.brush_color = stroke.brush_color
+  for i in numpy.flatnonzero(current != original):
+    strokes[i].brush_idx = int(current[i])
+  if removed.any() and not show_removed:
+    strokes[:] = [strokes[i] for i in numpy.flatnonzero(~removed)]
 
 
 # ----------------------------------------------------------------------
@@ -473,6 +493,100 @@ def tilt_colors_to_image(tilt, max_aspect_ratio=None, preserve_colors=()):
   return Image.fromarray(colors_array, mode='RGB')
   
 
+def get_color_counts(tilt, preserve_colors=()):
+  """Returns a Counter mapping rgb8 colors to the number of control points
+  using them. Colors in preserve_colors are weighted more heavily, as
+  tilt_colors_to_image() does."""
+  counter = Counter()
+  for stroke in tilt.sketch.strokes:
+    counter[rgbaf_to_rgb8(stroke.brush_color)] += len(stroke.controlpoints)
+  if counter:
+    most_used_color, amt = max(counter.iteritems(), key=lambda pair: pair[1])
+    for rgb8 in set(preserve_colors):
+      if rgb8 in counter:
+        counter[rgb8] += amt / 2
+  return counter
+
+
+def median_cut(colors, weights, num_colors):
+  """Weighted median cut.
+  colors is an (n, 3) float array; weights is an (n,) array.
+  Returns a (k, 3) array of box centroids, k <= num_colors."""
+  def sse(idx):
+    w = weights[idx]
+    mean = numpy.average(colors[idx], axis=0, weights=w)
+    return (w[:, numpy.newaxis] * (colors[idx] - mean) ** 2).sum()
+
+  boxes = [numpy.arange(len(colors))]
+  errors = [sse(boxes[0])]
+  while len(boxes) < num_colors:
+    ibox = int(numpy.argmax(errors))
+    if errors[ibox] <= 0:
+      break  # every box is a single color
+    idx = boxes[ibox]
+    w = weights[idx]
+    mean = numpy.average(colors[idx], axis=0, weights=w)
+    channel = int(numpy.argmax((w[:, numpy.newaxis] * (colors[idx] - mean) ** 2).sum(axis=0)))
+    idx = idx[numpy.argsort(colors[idx, channel], kind='mergesort')]
+    cumulative = numpy.cumsum(weights[idx])
+    split = int(numpy.searchsorted(cumulative, cumulative[-1] / 2.0))
+    split = min(max(split, 1), len(idx) - 1)
+    boxes[ibox:ibox+1] = [idx[:split], idx[split:]]
+    errors[ibox:ibox+1] = [sse(idx[:split]), sse(idx[split:])]
+  return numpy.array([numpy.average(colors[idx], axis=0, weights=weights[idx])
+                      for idx in boxes])
+
+
+def quantize_colors(color_counts, num_colors, preserve_colors=(), max_iterations=20):
+  """Weighted color quantization: median cut, refined with k-means.
+  color_counts maps rgb8 colors to weights (eg, from get_color_counts()).
+  Colors in preserve_colors are kept exactly, and count towards num_colors.
+  Returns a dict mapping every rgb8 color in color_counts to an rgb8 color."""
+  items = sorted(color_counts.iteritems())
+  if len(items) <= num_colors:
+    return dict((color, color) for (color, _) in items)
+  colors = numpy.array([color for (color, _) in items], dtype=numpy.float64)
+  weights = numpy.array([count for (_, count) in items], dtype=numpy.float64)
+
+  fixed = sorted(set(c for c in preserve_colors if c in color_counts))
+  fixed = numpy.array(fixed, dtype=numpy.float64).reshape(-1, 3)
+  num_free = max(0, num_colors - len(fixed))
+  is_free = numpy.ones(len(colors), dtype=bool)
+  for color in fixed:
+    is_free &= numpy.any(colors != color, axis=1)
+  if num_free > 0 and numpy.any(is_free):
+    free = median_cut(colors[is_free], weights[is_free], num_free)
+  else:
+    free = numpy.zeros((0, 3))
+
+  color_sq = (colors ** 2).sum(axis=1)[:, numpy.newaxis]
+  for _ in xrange(max_iterations):
+    centers = numpy.vstack([fixed, free])
+    # |a-b|^2 without materializing an (n, k, 3) array
+    dists = color_sq - 2 * colors.dot(centers.T) + (centers ** 2).sum(axis=1)
+    labels = numpy.argmin(dists, axis=1)
+    if len(free) == 0:
+      break
+    free_labels = labels - len(fixed)
+    moved = False
+    totals = numpy.bincount(free_labels[free_labels >= 0],
+                            weights=weights[free_labels >= 0], minlength=len(free))
+    for channel in xrange(3):
+      sums = numpy.bincount(free_labels[free_labels >= 0],
+                            weights=(weights * colors[:, channel])[free_labels >= 0],
+                            minlength=len(free))
+      # Leave empty clusters where they are
+      new = numpy.where(totals > 0, sums / numpy.maximum(totals, 1e-12), free[:, channel])
+      moved = moved or numpy.any(numpy.abs(new - free[:, channel]) > 0.25)
+      free[:, channel] = new
+    if not moved:
+      break
+
+  palette = numpy.clip(numpy.round(centers), 0, 255).astype(int)
+  return dict((color, tuple(palette[label]))
+              for ((color, _), label) in zip(items, labels))
+
+
 def get_quantized_image_pillow(im, num_colors):
   MAXIMUM_COVERAGE = 1
   print "Falling back to old color quantization"
@@ -518,12 +632,41 @@ def get_quantized_image(im, num_colors):
 
 
 def simplify_colors(tilt, num_colors, preserve_colors):
-  im = tilt_colors_to_image(tilt, max_aspect_ratio=4, preserve_colors=preserve_colors)
+  """Reduce the tilt to num_colors colors.
+  If num_colors is negative, use the older image-based quantizer, forcing
+  Pillow as before; it also writes before and after images next to the tilt."""
   if num_colors < 0:
     # Little hack to force use of pillow
-    imq, method = get_quantized_image_pillow(im, -num_colors)
+    old_to_new = simplify_colors_image(tilt, -num_colors, preserve_colors,
+                                       quantize=get_quantized_image_pillow)
   else:
-    imq, method = get_quantized_image(im, num_colors)
+    color_counts = get_color_counts(tilt, preserve_colors)
+    for rgb8 in preserve_colors:
+      if rgb8 not in color_counts:
+        print "Ignoring: #%02x%02x%02x is not in the image" % rgb8
+    old_to_new = dict((old8, rgb8_to_rgbaf(new8)) for (old8, new8) in
+                      quantize_colors(color_counts, num_colors, preserve_colors).iteritems())
+
+  for stroke in tilt.sketch.strokes:
+    stroke.brush_color = old_to_new[rgbaf_to_rgb8(stroke.brush_color)]
+
+  for old8, newf in old_to_new.iteritems():
+    oldv = numpy.array(rgb8_to_rgbaf(old8)[0:3])
+    newv = numpy.array(newf[0:3])
+    err = oldv - newv
+    err = math.sqrt(numpy.dot(err, err))
+    if err > .2:
+      print "High color error: #%02x%02x%02x" % old8
+  print "Colors: %d -> %d" % (len(old_to_new), len(set(map(tuple, old_to_new.values()))))
+
+
+def simplify_colors_image(tilt, num_colors, preserve_colors,
+                          quantize=get_quantized_image):
+  """Quantizes an image of the tilt's colors with quantize(im, num_colors),
+  eg get_quantized_image_pillow.
+  Returns a dict mapping unquantized rgb8 to quantized rgbaf."""
+  im = tilt_colors_to_image(tilt, max_aspect_ratio=4, preserve_colors=preserve_colors)
+  imq, method = quantize(im, num_colors)
 
   def iter_rgb8(im):
     return itertools.izip(im.getdata(0), im.getdata(1), im.getdata(2))
@@ -542,23 +685,11 @@ def simplify_colors(tilt, num_colors, preserve_colors):
     old_to_new[old_color] = rgb8_to_rgbaf(get_imq_color(idx))
     idx += len(list(group))
 
-  for stroke in tilt.sketch.strokes:
-    stroke.brush_color = old_to_new[rgbaf_to_rgb8(stroke.brush_color)]
-
-  if True:
-    import numpy as np
-    for old8, newf in old_to_new.iteritems():
-      oldv = np.array(rgb8_to_rgbaf(old8)[0:3])
-      newv = np.array(newf[0:3])
-      err = oldv - newv
-      err = math.sqrt(np.dot(err, err))
-      if err > .2:
-        print "High color error: #%02x%02x%02x" % old8
-
-    num_colors = len(set(map(tuple, old_to_new.values())))
-    base, _ = os.path.splitext(tilt.filename)
-    im.save('%s_%s.png' % (base, 'orig'))
-    imq.save('%s_%s_%d.png' % (base, method, num_colors))
+  num_colors = len(set(map(tuple, old_to_new.values())))
+  base, _ = os.path.splitext(tilt.filename)
+  im.save('%s_%s.png' % (base, 'orig'))
+  imq.save('%s_%s_%d.png' % (base, method, num_colors))
+  return old_to_new
   
 
 # ----------------------------------------------------------------------
@@ -689,7 +820,7 @@ You should generally do the steps in this order:
 
   parser.add_argument(
     '--simplify-colors', type=int, metavar='N',
-    help='Simplify down to N colors. Use a negative number to try the alternate algorithm.')
+    help='Simplify down to N colors. Use a negative number to try the older image-based algorithm.')
   parser.add_argument(
     '--preserve-color', dest='preserve_colors', type=hex_color, action='append',
     default=[],
@@ -0,0 +1,146 @@
+# Copyright 2020 The Tilt Brush Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Spatial queries over the strokes of a sketch, backed by tbdata.bvh
+# Usage:
+#   index = StrokeIndex.from_tilt(tilt)
+#   index.query_box(bmin, bmax)
+
+import heapq
+
+import numpy
+
+from tbdata.bvh import RTree
+
+
+def get_stroke_bounds(strokes):
+  """Returns (stroke_ids, bounds) for strokes that have control points.
+  stroke_ids is an array of indices into strokes; bounds is an (n, 2, 3)
+  array of (min, max), padded by half the brush size."""
+  ids = []
+  bounds = []
+  for i, stroke in enumerate(strokes):
+    if len(stroke.controlpoints) == 0:
+      continue
+    positions = numpy.array([cp.position for cp in stroke.controlpoints], dtype=numpy.float64)
+    pad = stroke.brush_size * .5
+    ids.append(i)
+    bounds.append((positions.min(axis=0) - pad, positions.max(axis=0) + pad))
+  return (numpy.array(ids, dtype=numpy.int64),
+          numpy.array(bounds, dtype=numpy.float64).reshape(-1, 2, 3))
+
+
+def box_distance_sq(bounds, point):
+  """Returns squared distance from point to the nearest point of each box.
+  bounds is (..., 2, 3); the result is 0 for boxes containing point."""
+  d = numpy.maximum(bounds[..., 0, :] - point, 0) + numpy.maximum(point - bounds[..., 1, :], 0)
+  return (d * d).sum(axis=-1)
+
+
+class StrokeIndex(object):
+  """Bounds of every stroke in a sketch, bulk-loaded into an RTree.
+  Query results are stroke indices, in the order of tilt.sketch.strokes.
+  Strokes without control points are never returned."""
+  @classmethod
+  def from_tilt(cls, tilt, leaf_capacity_multiplier=1):
+    return cls(tilt.sketch.strokes, leaf_capacity_multiplier)
+
+  def __init__(self, strokes, leaf_capacity_multiplier=1):
+    self.num_strokes = len(strokes)
+    self.stroke_ids, self.bounds = get_stroke_bounds(strokes)
+    # stroke index -> row in self.bounds
+    self.row_by_stroke = dict((int(s), row) for (row, s) in enumerate(self.stroke_ids))
+    if len(self.stroke_ids) == 0:
+      self.tree = None
+    else:
+      self.tree = RTree.from_bounds_str(
+        ((int(s), tuple(b[0]) + tuple(b[1]), None)
+         for (s, b) in zip(self.stroke_ids, self.bounds)),
+        leaf_capacity_multiplier)
+
+  def _iter_candidates(self, visit):
+    """Yields ids of leaf entries for which visit(bounds) is true, skipping
+    subtrees for which it is false. visit must be conservative: if it is
+    true for a box, it must be true for any box enclosing it."""
+    if self.tree is None:
+      return
+    stack = [self.tree.root]
+    while stack:
+      node = stack.pop()
+      for c in node.children:
+        if visit(numpy.array(c.bounds)):
+          if node.is_leaf():
+            yield c.id
+          else:
+            stack.append(c.node)
+
+  def query_box(self, bmin, bmax, contained=False):
+    """Returns a sorted list of strokes whose bounds overlap the box.
+    If contained, only returns strokes whose bounds are entirely inside it."""
+    bmin = numpy.asarray(bmin, dtype=numpy.float64)
+    bmax = numpy.asarray(bmax, dtype=numpy.float64)
+    def overlaps(b):
+      return numpy.all(b[0] <= bmax) and numpy.all(b[1] >= bmin)
+    ret = []
+    for s in self._iter_candidates(overlaps):
+      b = self.bounds[self.row_by_stroke[s]]
+      if contained and not (numpy.all(b[0] >= bmin) and numpy.all(b[1] <= bmax)):
+        continue
+      ret.append(s)
+    return sorted(ret)
+
+  def query_sphere(self, center, radius):
+    """Returns a sorted list of strokes whose bounds intersect the sphere."""
+    center = numpy.asarray(center, dtype=numpy.float64)
+    radius_sq = float(radius) ** 2
+    return sorted(self._iter_candidates(
+      lambda b: box_distance_sq(b, center) <= radius_sq))
+
+  def nearest(self, point, k=1):
+    """Returns up to k (distance, stroke) pairs, nearest first, where distance
+    is from point to the stroke's bounds."""
+    if self.tree is None or k <= 0:
+      return []
+    point = numpy.asarray(point, dtype=numpy.float64)
+    # Best-first search. Entries are (distance_sq, tiebreak, is_stroke, node_or_stroke)
+    heap = [(0.0, 0, False, self.tree.root)]
+    tiebreak = 1
+    ret = []
+    while heap and len(ret) < k:
+      dist_sq, _, is_stroke, item = heapq.heappop(heap)
+      if is_stroke:
+        ret.append((dist_sq ** .5, item))
+        continue
+      for c in item.children:
+        d = float(box_distance_sq(numpy.array(c.bounds), point))
+        if item.is_leaf():
+          heapq.heappush(heap, (d, tiebreak, True, c.id))
+        else:
+          heapq.heappush(heap, (d, tiebreak, False, c.node))
+        tiebreak += 1
+    return ret
+
+  def strokes_outside(self, bmin, bmax):
+    """Returns a sorted list of strokes that are not entirely inside the box,
+    eg a print volume."""
+    inside = set(self.query_box(bmin, bmax, contained=True))
+    return [int(s) for s in self.stroke_ids if s not in inside]
+
+  def overlapping_pairs(self):
+    """Returns a sorted list of (i, j) strokes, i < j, whose bounds overlap."""
+    ret = []
+    for (s, b) in zip(self.stroke_ids, self.bounds):
+      s = int(s)
+      ret.extend((s, other) for other in self.query_box(b[0], b[1]) if other > s)
+    return ret
@@ -0,0 +1,165 @@
+# Copyright 2020 The Tilt Brush Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Local content-addressed cache of finished builds.
+
+Entries are keyed by a hash of everything that goes into a build (see
+make_key()). Restoring an entry hardlinks its files into place, so a hit
+costs about as much as a directory walk rather than a Unity launch."""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import unitybuild.utils
+
+ENTRY_FILE = 'cache_entry.json'
+OUTPUT_DIR = 'output'
+
+
+def make_key(**inputs):
+  """Returns a cache key for a build with the given inputs.
+  All values must be json-serializable."""
+  return hashlib.sha1(json.dumps(inputs, sort_keys=True)).hexdigest()
+
+
+def _link_or_copy(src, dst):
+  # os.link isn't available on Windows in Python 2, and fails across filesystems
+  try:
+    os.link(src, dst)
+  except (AttributeError, OSError):
+    shutil.copy2(src, dst)
+
+
+def link_tree(src_dir, dst_dir):
+  """Recreates *src_dir* as *dst_dir*, hardlinking files where possible.
+  Returns the total size of the files, in bytes."""
+  total = 0
+  for r, ds, fs in os.walk(src_dir):
+    dst_r = os.path.join(dst_dir, os.path.relpath(r, src_dir))
+    if not os.path.isdir(dst_r):
+      os.makedirs(dst_r)
+    for name in ds + fs:
+      src = os.path.join(r, name)
+      dst = os.path.join(dst_r, name)
+      if os.path.islink(src):
+        # eg, frameworks inside OSX .app bundles
+        os.symlink(os.readlink(src), dst)
+      elif name in fs:
+        _link_or_copy(src, dst)
+        total += os.path.getsize(src)
+  return total
+
+
+class ArtifactCache(object):
+  """A directory of cached build outputs, evicted least-recently-used
+  first once their total size exceeds *max_bytes*."""
+  def __init__(self, cache_dir, max_bytes):
+    self.cache_dir = cache_dir
+    self.max_bytes = max_bytes
+    self.hits = 0
+    self.misses = 0
+    self.stores = 0
+    self.evictions = 0
+
+  def _entry_dir(self, key):
+    return os.path.join(self.cache_dir, key)
+
+  def _iter_entries(self):
+    """Yields (key, last_used_time, size) for all complete entries."""
+    try:
+      keys = os.listdir(self.cache_dir)
+    except OSError:
+      return
+    for key in keys:
+      if key.startswith('tmp_'):
+        continue
+      entry_file = os.path.join(self._entry_dir(key), ENTRY_FILE)
+      try:
+        with open(entry_file) as inf:
+          size = json.load(inf)['size']
+        yield (key, os.path.getmtime(entry_file), size)
+      except (IOError, OSError, ValueError, KeyError):
+        continue
+
+  def restore(self, key, output_dir):
+    """If *key* is in the cache, recreates its output as *output_dir* and returns True.
+    *output_dir* is replaced if it exists.
+    Errors while restoring are reported and count as a miss, so the caller
+    does a real build instead."""
+    entry_dir = self._entry_dir(key)
+    entry_file = os.path.join(entry_dir, ENTRY_FILE)
+    if not os.path.exists(entry_file):
+      self.misses += 1
+      return False
+    unitybuild.utils.destroy_in_background(output_dir)
+    try:
+      link_tree(os.path.join(entry_dir, OUTPUT_DIR), output_dir)
+    except (IOError, OSError) as e:
+      print 'WARN: Cannot restore %s from the build cache: %s' % (output_dir, e)
+      unitybuild.utils.destroy_in_background(output_dir)
+      self.misses += 1
+      return False
+    # The entry file's mtime is the last-used time
+    os.utime(entry_file, None)
+    self.hits += 1
+    return True
+
+  def store(self, key, build_dir, **metadata):
+    """Adds the contents of *build_dir* to the cache under *key*.
+    Any extra keyword args are recorded in the entry, for debugging.
+    Errors are reported but are not fatal."""
+    entry_dir = self._entry_dir(key)
+    if os.path.exists(os.path.join(entry_dir, ENTRY_FILE)):
+      return
+    tmp_dir = self._entry_dir('tmp_%s_%d' % (key, os.getpid()))
+    try:
+      unitybuild.utils.destroy(tmp_dir)
+      size = link_tree(build_dir, os.path.join(tmp_dir, OUTPUT_DIR))
+      metadata.update(key=key, size=size, created=time.time())
+      with open(os.path.join(tmp_dir, ENTRY_FILE), 'w') as outf:
+        json.dump(metadata, outf, indent=2, sort_keys=True)
+      unitybuild.utils.destroy(entry_dir)  # an incomplete entry, if anything
+      os.rename(tmp_dir, entry_dir)
+      self.stores += 1
+    except Exception as e:
+      print 'WARN: Cannot add %s to the build cache: %s' % (build_dir, e)
+      unitybuild.utils.destroy_in_background(tmp_dir)
+      return
+    self.evict(keep=key)
+
+  def evict(self, keep=None):
+    """Removes least-recently-used entries until the cache fits in max_bytes.
+    Never removes the entry *keep*."""
+    entries = sorted(self._iter_entries(), key=lambda (k, last_used, size): last_used)
+    total = sum(size for (_, _, size) in entries)
+    for (key, _, size) in entries:
+      if total <= self.max_bytes:
+        break
+      if key == keep:
+        continue
+      unitybuild.utils.destroy_in_background(self._entry_dir(key))
+      total -= size
+      self.evictions += 1
+
+  def get_stats(self):
+    """Returns a one-line summary of cache activity, suitable for printing."""
+    entries = list(self._iter_entries())
+    return ('Build cache: %d hit(s), %d miss(es), %d stored, %d evicted; '
+            '%d entries, %.1f of %.1f GB' % (
+              self.hits, self.misses, self.stores, self.evictions,
+              len(entries), sum(size for (_, _, size) in entries) / 1e9,
+              self.max_bytes / 1e9))
@@ -54,6 +54,7 @@ import shutil
 import threading
 import subprocess
 
+import unitybuild.artifact_cache
 import unitybuild.utils
 import unitybuild.push
 from unitybuild.constants import *
@@ -103,31 +104,99 @@ class LogTailer(threading.Thread):
     # All of BuildTiltBrush.CommandLine()'s output is prefixed with _btb_
     munge_pat = re.compile('Updating (Assets/.*) - GUID')
     progress_pat = re.compile('(_btb_ |DisplayProgressbar: )(.*)')
-    with open(self.logfile) as inf:
+    reader = unitybuild.utils.LineReader()
+    with open(self.logfile, 'rb') as inf:
       while True:
-        where = inf.tell()
-        line = inf.readline()
-        try:
-          if not line:
-            if self.should_exit: return
-            time.sleep(self.POLL_TIME)
-            inf.seek(where)
-          elif progress_pat.match(line):
-            print 'Unity> %-70s\r' % progress_pat.match(line).group(2)[-70:],
-          elif munge_pat.match(line):
-            print 'Munge> %-70s\r' % munge_pat.match(line).group(1)[-70:],
-        except IOError:
-          # The "print" can raise IOError
-          pass
-
-def get_unity_exe(version, lenient=True):
-  """Returns a Unity executable of the same major version.
-  version - a (major, minor, point) tuple. Strings.
-  lenient - if True, allow the micro version to be higher.
-  """
-  exes = sorted(iter_editors_and_versions(), reverse=True)
-  if len(exes) == 0:
-    raise BuildFailed("Cannot find any Unity versions (want %s)" % (version,))
+        data = inf.read(65536)
+        if not data:
+          if self.should_exit: return
+          time.sleep(self.POLL_TIME)
+          continue
+        # Unlike readline(), this never hands us a line Unity is still writing
+        for line in reader.feed(data):
+          line = line.rstrip('\r\n')
+          try:
+            if progress_pat.match(line):
+              print 'Unity> %-70s\r' % progress_pat.match(line).group(2)[-70:],
+            elif munge_pat.match(line):
+              print 'Munge> %-70s\r' % munge_pat.match(line).group(1)[-70:],
+          except IOError:
+            # The "print" can raise IOError
+            pass
+
+class EditorRegistry(object):
+  """Persistent cache of installed Unity editors and their versions.
+  Entries are keyed by executable path and are only trusted while the
+  executable's mtime is unchanged, since determining an editor's version
+  can mean walking its install directory or reading binary metadata."""
+  DEFAULT_FILENAME = os.path.join(os.path.expanduser('~'), '.unitybuild_editors.json')
+
+  def __init__(self, filename=DEFAULT_FILENAME):
+    self.filename = filename
+    self.entries = {}          # exe -> {'mtime': float, 'version': [str, str, str]}
+    self.dirty = False
+    try:
+      import json
+      with open(filename) as inf:
+        self.entries = json.load(inf)['editors']
+    except (IOError, ValueError, KeyError, TypeError):
+      # Missing or corrupt; it'll get rebuilt
+      self.entries = {}
+
+  @staticmethod
+  def _get_mtime(exe):
+    try: return os.path.getmtime(exe)
+    except OSError: return None
+
+  def get_version(self, exe):
+    """Returns the cached version of *exe*, or None if it's unknown or stale."""
+    entry = self.entries.get(exe)
+    if entry is None or entry['mtime'] != self._get_mtime(exe):
+      return None
+    return tuple(entry['version'])
+
+  def set_version(self, exe, version):
+    self.entries[exe] = {'mtime': self._get_mtime(exe), 'version': list(version)}
+    self.dirty = True
+
+  def iter_editors_and_versions(self):
+    """Yields the (exe_path, version) tuples that are still valid."""
+    for exe in sorted(self.entries):
+      version = self.get_version(exe)
+      if version is not None:
+        yield (exe, version)
+
+  def replace(self, editors_and_versions):
+    """Replace all entries with the results of a full scan."""
+    scanned = set(exe for (exe, _) in editors_and_versions)
+    for exe in self.entries.keys():
+      if exe not in scanned:
+        del self.entries[exe]
+        self.dirty = True
+    for (exe, version) in editors_and_versions:
+      if self.get_version(exe) != tuple(version):
+        self.set_version(exe, version)
+
+  def save(self):
+    if not self.dirty:
+      return
+    import json
+    tmp_filename = self.filename + '.tmp'
+    try:
+      with open(tmp_filename, 'w') as outf:
+        json.dump({'editors': self.entries}, outf, indent=2, sort_keys=True)
+      if os.path.exists(self.filename):
+        os.unlink(self.filename)  # Windows rename doesn't overwrite
+      os.rename(tmp_filename, self.filename)
+      self.dirty = False
+    except (IOError, OSError) as e:
+      print 'WARN: Cannot write %s: %s' % (self.filename, e)
+
+
+def find_unity_exe(version, lenient, exes):
+  """Returns an executable from *exes* compatible with *version*, or None.
+  exes - a list of (exe_path, (major, minor, micro)) tuples."""
+  exes = sorted(exes, reverse=True)
   for (found_exe, found_version) in exes:
     if found_version == version:
       return found_exe
@@ -144,7 +213,34 @@ def get_unity_exe(version, lenient=True):
       found_exe, found_version = max(compatible, key=by_int_version)
       if int_version(found_version) >= int_version(version):
         return found_exe
+  return None
+
+
+def get_unity_exe(version, lenient=True, rescan=False, registry=None):
+  """Returns a Unity executable of the same major version.
+  version - a (major, minor, point) tuple. Strings.
+  lenient - if True, allow the micro version to be higher.
+  rescan - if True, ignore previously-cached editor locations.
+  registry - an EditorRegistry; defaults to the per-user one.
+  """
+  if registry is None:
+    registry = EditorRegistry()
+
+  # Fast path: a match among the editors we've seen before. Editors
+  # installed since the last scan are only found by a rescan (or a miss).
+  if not rescan:
+    found_exe = find_unity_exe(version, lenient, registry.iter_editors_and_versions())
+    if found_exe is not None:
+      return found_exe
 
+  exes = list(iter_editors_and_versions(registry))
+  registry.replace(exes)
+  registry.save()
+  if len(exes) == 0:
+    raise BuildFailed("Cannot find any Unity versions (want %s)" % (version,))
+  found_exe = find_unity_exe(version, lenient, exes)
+  if found_exe is not None:
+    return found_exe
   raise BuildFailed("Cannot find desired Unity version (want %s)" % (version,))
 
 
@@ -168,9 +264,17 @@ def iter_possible_windows_editor_locations():
         yield editor_dir
 
 
-def iter_editors_and_versions():
+def iter_editors_and_versions(registry=None):
   """Yields (exe_path, (major, minor, micro)) tuples.
-  All elements are strings."""
+  All elements are strings.
+  registry - optional EditorRegistry used to avoid re-computing versions of
+    editors that haven't changed."""
+  def get_version(exe, editor_app, editor_data_dir):
+    version = registry and registry.get_version(exe)
+    if version is None:
+      version = get_editor_unity_version(editor_app, editor_data_dir)
+    return version
+
   hub_exe = None
   if sys.platform == 'win32':
     hub_exe = r'c:\Program Files\Unity Hub\Unity Hub.exe'
@@ -196,7 +300,7 @@ def iter_editors_and_versions():
         try:
           exe = os.path.join(editor_dir, 'Unity.exe')
           if os.path.exists(exe):
-            yield (exe, get_editor_unity_version(exe, editor_data_dir))
+            yield (exe, get_version(exe, exe, editor_data_dir))
           else:
             print 'WARN: Missing executable %s' % exe
         except LookupError as e:
@@ -215,7 +319,7 @@ def iter_editors_and_versions():
       exe = os.path.join(editor_dir, 'Contents/MacOS/Unity')
       editor_data_dir = os.path.join(editor_dir, 'Contents')
       if os.path.exists(editor_dir):
-        yield (exe, get_editor_unity_version(editor_dir, editor_data_dir))
+        yield (exe, get_version(exe, editor_dir, editor_data_dir))
 
 
 def parse_version(txt):
@@ -410,7 +514,7 @@ PLATFORM_TO_UNITYTARGET = {
 }
 def build(stamp, output_dir, project_dir, exe_base_name,
           experimental, platform, il2cpp, vrsdk, config, for_distribution,
-          is_jenkins):
+          is_jenkins, rescan_editors=False):
   """Create a build of Tilt Brush.
   Pass:
     stamp - string describing the version+build; will be embedded into the build somehow.
@@ -424,6 +528,7 @@ def build(stamp, output_dir, project_dir, exe_base_name,
     config - one of (Debug, Release)
     for_distribution - boolean. Enables android signing, version code bump, removal of pdb files.
     is_jenkins - boolean; used to customize stdout logging
+    rescan_editors - boolean; ignore the cache of installed Unity editors
   Returns:
     the actual output directory used
   """
@@ -436,19 +541,19 @@ def build(stamp, output_dir, project_dir, exe_base_name,
     raise InternalError("Don't know executable suffix for %s" % platform)
 
   try:
-    unitybuild.utils.destroy(output_dir)
+    unitybuild.utils.destroy_in_background(output_dir)
   except Exception as e:
     print 'WARN: could not use %s: %s' % (output_dir, e)
     output_dir = make_unused_directory_name(output_dir)
     print 'WARN: using %s intead' % output_dir
-    unitybuild.utils.destroy(output_dir)
+    unitybuild.utils.destroy_in_background(output_dir)
   os.makedirs(output_dir)
   logfile = os.path.join(output_dir, 'build_log.txt')
 
   exe_name = os.path.join(output_dir, exe_base_name + get_exe_suffix(platform))
   cmd_env = os.environ.copy()
   cmdline = [get_unity_exe(get_project_unity_version(project_dir),
-                           lenient=is_jenkins),
+                           lenient=is_jenkins, rescan=rescan_editors),
              '-logFile', logfile,
              '-batchmode',
              # '-nographics',   Might be needed on OSX if running w/o window server?
@@ -540,69 +645,151 @@ def finalize_build(project_dir, src_dir, dst_dir):
   """Attempts to move *src_dir* to *dst_dir*.
   Return *dst_dir* on success, or some other directory name if there was some problem.
   This should be as close to atomic as possible."""
-  try:
-    unitybuild.utils.destroy(dst_dir)
-  except OSError as e:
-    print 'WARN: Cannot remove %s; putting output in %s' % (dst_dir, src_dir)
-    return src_dir
-
   try: os.makedirs(os.path.dirname(dst_dir))
   except OSError: pass
 
   try:
-    os.rename(src_dir, dst_dir)
+    # The previous dst_dir is renamed aside and deleted in the background,
+    # so this doesn't wait on deleting a multi-GB build.
+    unitybuild.utils.swap_directories(src_dir, dst_dir)
     return dst_dir
   except OSError as e:
     # TODO(pld): Try to do something better
     # On Jon's computer, Android builds always leave behind a Java.exe process that
     # holds onto the directory and prevents its rename.
     # raise InternalError("Can't rename %s to %s: %s" % (src_dir, dst_dir, e))
-    print 'WARN: Cannot rename %s; leaving it as-is' % (src_dir,)
+    print 'WARN: Cannot rename %s to %s (%s); leaving it as-is' % (src_dir, dst_dir, e)
     return src_dir
 
 
-def create_notice_file(project_dir):
-  def iter_notice_files():
-    """Yields (library_name, notice_file_name) tuples."""
-    root = os.path.join(project_dir, 'Assets/ThirdParty')
-    if not os.path.exists(root):
-      raise BuildFailed("Cannot generate NOTICE: missing %s" % root)
-    for r, ds, fs in os.walk(root):
-      for f in fs:
-        if f.lower() in ('notice', 'notice.txt', 'notice.tiltbrush', 'notice.md'):
-          yield (os.path.basename(r), os.path.join(r, f))
-    root = os.path.join(project_dir, 'Assets/ThirdParty/NuGet/Packages')
-    if not os.path.exists(root):
-      raise BuildFailed("Cannot generate NOTICE: missing %s" % root)
+def iter_notice_files(project_dir, dir_mtimes=None):
+  """Yields (library_name, notice_file_name) tuples.
+  If *dir_mtimes* is passed, it is filled in with the mtime of every directory visited."""
+  def walk(root):
     for r, ds, fs in os.walk(root):
-      for f in fs:
-        if f.lower() in ('notice', 'notice.md', 'notice.txt'):
-          m = re.match('\D+', os.path.basename(r))
-          if m:
-            name = m.group(0).rstrip('.')
-            if (name[-2:] == '.v' or name[-2:] == '.V'):
-              name = name[:-2]
-            yield (name, os.path.join(r, f))
+      if dir_mtimes is not None:
+        dir_mtimes[r] = os.path.getmtime(r)
+      yield r, ds, fs
+
+  root = os.path.join(project_dir, 'Assets/ThirdParty')
+  if not os.path.exists(root):
+    raise BuildFailed("Cannot generate NOTICE: missing %s" % root)
+  for r, ds, fs in walk(root):
+    for f in fs:
+      if f.lower() in ('notice', 'notice.txt', 'notice.tiltbrush', 'notice.md'):
+        yield (os.path.basename(r), os.path.join(r, f))
+  root = os.path.join(project_dir, 'Assets/ThirdParty/NuGet/Packages')
+  if not os.path.exists(root):
+    raise BuildFailed("Cannot generate NOTICE: missing %s" % root)
+  for r, ds, fs in walk(root):
+    for f in fs:
+      if f.lower() in ('notice', 'notice.md', 'notice.txt'):
+        m = re.match('\D+', os.path.basename(r))
+        if m:
+          name = m.group(0).rstrip('.')
+          if (name[-2:] == '.v' or name[-2:] == '.V'):
+            name = name[:-2]
+          yield (name, os.path.join(r, f))
+
 
+def create_notice_file(project_dir):
+  """Generates Support/ThirdParty/GeneratedThirdPartyNotices.txt.
+  This is incremental: a manifest in the project's Library/ directory records
+  the directories searched and the notice files found, with their hashes.
+  The output file is only rewritten if its contents would change."""
   import codecs
-  import StringIO
-  tmpf = StringIO.StringIO()
-  tmpf.write('''This file is automatically generated.
-This software makes use of third-party software with the following notices.
-''')
-  for (library_name, notice_file) in iter_notice_files():
-    tmpf.write('\n\n=== %s ===\n' % library_name)
-    with open(notice_file) as inf:
-      contents = inf.read()
-      if contents.startswith(codecs.BOM_UTF8):
-        contents = contents[len(codecs.BOM_UTF8):]
-    tmpf.write(contents)
-    tmpf.write('\n')
+  import hashlib
+  import json
 
   output_filename = os.path.join(project_dir,
                                  'Support/ThirdParty/GeneratedThirdPartyNotices.txt')
-  with open(output_filename, 'w') as outf:
-    outf.write(tmpf.getvalue())
+  manifest_filename = os.path.join(project_dir, 'Library/unitybuild_notices.json')
+  try:
+    with open(manifest_filename) as inf:
+      manifest = json.load(inf)
+    old_dirs = manifest['dirs']
+    old_notices = manifest['notices']
+    old_output_sha = manifest['output_sha']
+  except (IOError, ValueError, KeyError):
+    old_dirs, old_notices, old_output_sha = {}, [], None
+
+  def get_mtime(filename):
+    try: return os.path.getmtime(filename)
+    except OSError: return None
+
+  # Adding or removing a notice file changes its directory's mtime, so if
+  # no directory has changed there's no need to walk the tree again.
+  if old_dirs and all(get_mtime(d) == mtime for (d, mtime) in old_dirs.iteritems()):
+    dirs = old_dirs
+    notice_files = [(n['library'], n['file']) for n in old_notices]
+  else:
+    dirs = {}
+    notice_files = list(iter_notice_files(project_dir, dirs))
+
+  # Only re-read notice files whose size or mtime changed
+  old_notices_by_file = dict((n['file'], n) for n in old_notices)
+  notices = []
+  contents_by_file = {}
+  for (library_name, notice_file) in notice_files:
+    st = os.stat(notice_file)
+    old = old_notices_by_file.get(notice_file)
+    if old is not None and (old['mtime'], old['size']) == (st.st_mtime, st.st_size):
+      sha = old['sha']
+    else:
+      with open(notice_file) as inf:
+        contents_by_file[notice_file] = inf.read()
+      sha = hashlib.sha1(contents_by_file[notice_file]).hexdigest()
+    notices.append({'library': library_name, 'file': notice_file,
+                    'mtime': st.st_mtime, 'size': st.st_size, 'sha': sha})
+
+  def identity(notice):
+    return (notice['library'], notice['file'], notice['sha'])
+  up_to_date = (old_output_sha is not None and
+                map(identity, notices) == map(identity, old_notices))
+  if up_to_date:
+    try:
+      with open(output_filename) as inf:
+        up_to_date = (hashlib.sha1(inf.read()).hexdigest() == old_output_sha)
+    except IOError:
+      up_to_date = False
+
+  output_sha = old_output_sha
+  if not up_to_date:
+    chunks = ['This file is automatically generated.\n'
+              'This software makes use of third-party software with the following notices.\n']
+    for notice in notices:
+      chunks.append('\n\n=== %s ===\n' % notice['library'])
+      contents = contents_by_file.get(notice['file'])
+      if contents is None:
+        with open(notice['file']) as inf:
+          contents = inf.read()
+      if contents.startswith(codecs.BOM_UTF8):
+        contents = contents[len(codecs.BOM_UTF8):]
+      chunks.append(contents)
+      chunks.append('\n')
+    output = ''.join(chunks)
+    output_sha = hashlib.sha1(output).hexdigest()
+
+    # The output is checked in, and touching it makes Unity re-import it,
+    # so leave it alone unless it actually changes.
+    try:
+      with open(output_filename) as inf:
+        existing = inf.read()
+    except IOError:
+      existing = None
+    if existing != output:
+      with open(output_filename, 'w') as outf:
+        outf.write(output)
+
+  if dirs is not old_dirs or notices != old_notices or output_sha != old_output_sha:
+    try:
+      try: os.makedirs(os.path.dirname(manifest_filename))
+      except OSError: pass
+      with open(manifest_filename, 'w') as outf:
+        json.dump({'dirs': dirs, 'notices': notices, 'output_sha': output_sha},
+                  outf, indent=1, sort_keys=True)
+    except IOError as e:
+      print 'WARN: Cannot write %s: %s' % (manifest_filename, e)
 
 # ----------------------------------------------------------------------
 # Front-end
@@ -629,6 +816,12 @@ def parse_args(args):
   parser.add_argument(
     '--il2cpp', action='store_true', default=False,
     help='Build using il2cpp as the runtime instead of Mono')
+  parser.add_argument(
+    '--rescan', dest='rescan_editors', action='store_true', default=False,
+    help='Search for installed Unity editors instead of using the cached list')
+  parser.add_argument(
+    '--no-build-cache', dest='build_cache', action='store_false', default=True,
+    help='Always launch Unity, even if an identical build is in the build cache')
   parser.add_argument(
     '--for-distribution', dest='for_distribution', action='store_true', default=False,
     help='Implicitly set when the build is being pushed; use explicitly if you want a signed build but do not want to push it yet')
@@ -637,7 +830,8 @@ def parse_args(args):
   grp = parser.add_argument_group('Pushing to Steam/Oculus')
   grp.add_argument('--push', action='store_true', help='Push to Steam/Oculus')
   grp.add_argument('--user', type=str, help='(optional) Steam user to authenticate as.')
-  grp.add_argument('--branch', type=str, help='(optional) Steam branch or Oculus release channel.')
+  grp.add_argument('--branch', type=str, action='append', dest='branches',
+                   help='(optional) Steam branch or Oculus release channel. Can pass multiple times to push to several concurrently.')
 
   grp = parser.add_argument_group('Continuous Integration')
   grp.add_argument('--jenkins', action='store_true', help='Build with continuous integration settings.')
@@ -657,7 +851,7 @@ def parse_args(args):
     else:
       args.vrsdks = ['SteamVR']
 
-  if args.branch is not None:
+  if args.branches is not None:
     args.push = True
 
   if args.push:
@@ -734,6 +928,27 @@ def maybe_prompt_and_set_version_code(project_dir):
     print 'Now building version code %s' % get_android_version_code(project_dir)
 
 
+def create_build_cache(build_dir):
+  """Returns an ArtifactCache for builds in *build_dir*.
+  Its size limit comes from $TILT_BRUSH_BUILD_CACHE_GB."""
+  max_gb = float(os.getenv('TILT_BRUSH_BUILD_CACHE_GB', '20'))
+  # Must be on the same filesystem as the builds, so it can use hardlinks
+  return unitybuild.artifact_cache.ArtifactCache(
+    os.path.join(build_dir, '.build_cache'), int(max_gb * 1e9))
+
+
+def get_build_cache_key(vcs, project_dir, revision, **flags):
+  """Returns a key for the build cache, or None if the build shouldn't be cached."""
+  if revision == 'nostamp':
+    return None
+  try:
+    inputs = vcs.get_input_hash(project_dir)
+  except LookupError as e:
+    print 'WARN: not using build cache: %s' % e
+    return None
+  return unitybuild.artifact_cache.make_key(stamp=revision, inputs=inputs, **flags)
+
+
 def sanity_check_build(build_dir):
   # We've had issues with Unity dying(?) or exiting(?) before emitting an exe
   exes = []
@@ -751,9 +966,10 @@ def main(args=None):
   args = parse_args(args)
 
   if args.push:
-    num = len(args.platforms) * len(args.vrsdks) * len(args.configs)
-    if num != 1:
-      raise UserError('Must specify exactly one build to push')
+    # Several builds can be pushed (eg, to both Steam and Oculus) but
+    # they'd clobber each other if they only differed by config.
+    if len(args.configs) != 1:
+      raise UserError('Must specify exactly one config to push')
 
   import unitybuild.vcs as vcs
   vcs = vcs.create()
@@ -782,6 +998,8 @@ def main(args=None):
 
     create_notice_file(project_dir)
 
+    cache = create_build_cache(build_dir) if args.build_cache else None
+    upload_jobs = []
     for (platform, vrsdk, config) in iter_builds(args):
       stamp = revision + ('-exp' if args.experimental else '')
       print "Building %s %s %s exp:%d signed:%d il2cpp:%d" % (
@@ -801,14 +1019,28 @@ def main(args=None):
         except Exception as e:
           print 'Error prompting for version code: %s' % e
 
-      tmp_dir = build(stamp, tmp_dir, project_dir, EXE_BASE_NAME,
-            experimental=args.experimental,
-            platform=platform,
-            il2cpp=args.il2cpp, vrsdk=vrsdk, config=config,
-            for_distribution=args.for_distribution,
-            is_jenkins=args.jenkins)
+      cache_key = None
+      if cache is not None:
+        cache_key = get_build_cache_key(
+          vcs, project_dir, stamp, platform=platform, vrsdk=vrsdk, config=config,
+          experimental=args.experimental, il2cpp=args.il2cpp,
+          for_distribution=args.for_distribution)
+      if cache_key is not None and cache.restore(cache_key, tmp_dir):
+        print 'Restored %s from the build cache' % dirname
+        cache_hit = True
+      else:
+        tmp_dir = build(stamp, tmp_dir, project_dir, EXE_BASE_NAME,
+              experimental=args.experimental,
+              platform=platform,
+              il2cpp=args.il2cpp, vrsdk=vrsdk, config=config,
+              for_distribution=args.for_distribution,
+              is_jenkins=args.jenkins,
+              rescan_editors=args.rescan_editors)
+        cache_hit = False
       output_dir = finalize_build(project_dir, tmp_dir, output_dir)
       sanity_check_build(output_dir)
+      if cache_key is not None and not cache_hit:
+        cache.store(cache_key, output_dir, stamp=stamp, name=dirname)
 
       if args.for_distribution and platform == 'Android':
         set_android_version_code(project_dir, 'increment')
@@ -839,24 +1071,39 @@ def main(args=None):
           embedded_stamp = inf.read().strip()
         import getpass
         from platform import node as platform_node  # Don't overwrite 'platform' local var!
-        description = '%s %s | %s@%s' % (
+        base_description = '%s %s | %s@%s' % (
           config, embedded_stamp, getpass.getuser(), platform_node())
-        if args.branch is not None:
-          description += ' to %s' % args.branch
+        def get_description(branch):
+          if branch is None:
+            return base_description
+          return base_description + ' to %s' % branch
 
         if vrsdk == 'SteamVR':
           if platform not in ('Windows',):
             raise BuildFailed("Unsupported platform for push to Steam: %s" % platform)
-          unitybuild.push.push_tilt_brush_to_steam(
-            output_dir, description, args.user or 'tiltbrush_build', args.branch)
+          for branch in (args.branches or [None]):
+            upload_jobs.append(unitybuild.push.make_steam_upload_job(
+              output_dir, get_description(branch), args.user or 'tiltbrush_build', branch))
         elif vrsdk == 'Oculus':
           if platform not in ('Windows', 'Android'):
             raise BuildFailed("Unsupported platform for push to Oculus: %s" % platform)
-          release_channel = args.branch
-          if release_channel is None:
-            release_channel = 'ALPHA'
-            print("No release channel specified for Oculus: using %s" % release_channel)
-          unitybuild.push.push_tilt_brush_to_oculus(output_dir, release_channel, description)
+          release_channels = args.branches
+          if release_channels is None:
+            release_channels = ['ALPHA']
+            print("No release channel specified for Oculus: using %s" % release_channels[0])
+          for release_channel in release_channels:
+            upload_jobs.append(unitybuild.push.make_oculus_upload_job(
+              output_dir, release_channel, get_description(release_channel)))
+
+    if upload_jobs:
+      unitybuild.push.UploadOrchestrator(
+        upload_jobs, state_file=os.path.join(build_dir, 'upload_state.json')).run()
+
+    if cache is not None:
+      print cache.get_stats()
+    if not unitybuild.utils.wait_for_background_destroys(timeout=0):
+      print 'Waiting for old builds to finish deleting...'
+      unitybuild.utils.wait_for_background_destroys()
   except Error as e:
     print "\n%s: %s" % ('ERROR', e)
     if isinstance(e, BadVersionCode):
@@ -874,17 +1121,19 @@ def main(args=None):
 # Tests
 
 def test_get_unity_exe():
+  import tempfile
   global iter_editors_and_versions
-  def iter_editors_and_versions():
+  def iter_editors_and_versions(registry=None):
     return map(lambda s: ("Unity_%s.exe" % s, tuple(s.split('.'))), [
       "2017.1.2", "2017.1.3", "2017.4.3", "2017.4.10", "2017.4.9"])
-  assert get_unity_exe(('2017', '4', '8'), True) == 'Unity_2017.4.10.exe'
-  try:   get_unity_exe(('2017', '4', '8'), False)
+  registry = EditorRegistry(os.path.join(tempfile.mkdtemp(), 'editors.json'))
+  assert get_unity_exe(('2017', '4', '8'), True, registry=registry) == 'Unity_2017.4.10.exe'
+  try:   get_unity_exe(('2017', '4', '8'), False, registry=registry)
   except BuildFailed as e: pass
   else: assert False  # must raise
 
 def test_iter_editors():
-  for tup in iter_editors_and_versions():
+  for tup in iter_editors_and_versions(EditorRegistry()):
     print tup
 
 if __name__ == '__main__':
@@ -25,10 +25,15 @@ import subprocess
 from subprocess import Popen, PIPE, STDOUT
 
 from unitybuild.constants import *
+from unitybuild.utils import LineReader
 from unitybuild.credentials import get_credential, TB_OCULUS_RIFT_APP_ID, TB_OCULUS_QUEST_APP_ID
 
 class ExpansionError(LookupError): pass
 
+class TransientUploadError(BuildFailed):
+  """An upload failed, but might succeed if retried."""
+  pass
+
 def steamcmd(*args):
   args = list(args)
   if len(args) == 1:
@@ -139,14 +144,16 @@ def create_from_template(input_file, variables, tmp_dir):
   return output_file
 
 
-def push_tilt_brush_to_steam(source_dir, description, steam_user, steam_branch=None):
-  try:
-    steamcmd('+exit')
-  except subprocess.CalledProcessError:
-    raise BuildFailed("You don't seem to have steamcmd installed")
-
+def prepare_steam_push(source_dir, description, steam_branch=None, tmp_dir=None):
+  """Creates the vdf files needed to push *source_dir* to Steam.
+  tmp_dir - where to put the generated files; defaults to get_tmp_steam_dir().
+  Returns the name of the app build vdf file to pass to +run_app_build."""
   support_dir = get_support_dir()
   tmp_steam_dir = get_tmp_steam_dir()
+  if tmp_dir is None:
+    tmp_dir = tmp_steam_dir
+  elif not os.path.isdir(tmp_dir):
+    os.makedirs(tmp_dir)
 
   variables = {
     'DESC': description,
@@ -157,13 +164,21 @@ def push_tilt_brush_to_steam(source_dir, description, steam_user, steam_branch=N
   # This file has no variables that need expanding, but steamcmd.exe
   # mutates it to add a digital signature so we should copy it off to a temp file.
   variables['INSTALLSCRIPT_WIN'] = create_from_template(
-    os.path.join(support_dir, 'steam/installscript_win.vdf'), {}, tmp_steam_dir)
+    os.path.join(support_dir, 'steam/installscript_win.vdf'), {}, tmp_dir)
   variables['MAIN_DEPOT_VDF'] = create_from_template(
-    os.path.join(support_dir, 'steam/main_depot_template.vdf'), variables, tmp_steam_dir)
-  app_vdf = create_from_template(
-    os.path.join(support_dir, 'steam/app_template.vdf'), variables, tmp_steam_dir)
+    os.path.join(support_dir, 'steam/main_depot_template.vdf'), variables, tmp_dir)
+  return create_from_template(
+    os.path.join(support_dir, 'steam/app_template.vdf'), variables, tmp_dir)
+
+
+def push_tilt_brush_to_steam(source_dir, description, steam_user, steam_branch=None):
+  try:
+    steamcmd('+exit')
+  except subprocess.CalledProcessError:
+    raise BuildFailed("You don't seem to have steamcmd installed")
 
-  print "Pushing %s to Steam" % (variables['CONTENT_ROOT'], )
+  app_vdf = prepare_steam_push(source_dir, description, steam_branch)
+  print "Pushing %s to Steam" % (os.path.abspath(source_dir), )
   steamcmd('+login', steam_user,
            '+run_app_build', app_vdf,
            '+quit')
@@ -194,35 +209,21 @@ def get_oculus_tiltbrush_exe(directory):
     raise BuildFailed("Ambiguous launch executable: %s" % (files,))
 
 
-def unbuffered_reads(inf):
-  """Yields unbuffered reads from file, until eof."""
+def buffered_reads(inf, size=65536):
+  """Yields reads from file, until eof.
+  Each read returns as soon as any data is available, so output is still
+  seen promptly, without paying for a read() call per byte."""
+  fd = inf.fileno()
   while True:
-    data = inf.read(1)
+    data = os.read(fd, size)
     if data == '': break
     yield data
 
 
 def group_into_lines(iterable):
-  """Yields complete lines (lines terminated with \\r and/or \\n)."""
-  current = []
-  terminator = re.compile(r'^([^\r\n]*[\r\n]+)(.*)$', re.MULTILINE)
-  for data in iterable:
-    # Deal with any line terminators in the data
-    #print "IN %r" % data
-    while True:
-      m = terminator.match(data)
-      if m is None:
-        break
-
-      eol, data = m.groups()
-      #print " match %r %r" % (eol, data)
-      current.append(eol)
-      yield ''.join(current)
-      current = []
-
-    current.append(data)
-
-  yield ''.join(current)
+  """Yields complete lines (lines terminated with \\r and/or \\n).
+  The last line yielded may be unterminated."""
+  return LineReader().iter_lines(iterable)
 
 
 def get_oculus_build_type(build_path):
@@ -243,10 +244,9 @@ def get_secret(env_var_name, credential_name):
   return get_credential(credential_name).get_secret()
 
 
-def push_tilt_brush_to_oculus(
-    build_path,
-    release_channel,
-    release_notes):
+def get_oculus_upload_args(build_path, release_channel, release_notes):
+  """Returns (args, app_id) for an ovr-platform-util upload of *build_path*.
+  May prompt for the app secret."""
   assert os.path.isabs(build_path)
   assert os.path.exists(build_path)
   assert release_channel is not None, "You must pass a release channel to push to Oculus Home"
@@ -290,7 +290,12 @@ def push_tilt_brush_to_oculus(
     ]
   else:
     raise BuildFailed("Internal error: %s" % build_type)
+  return args, app_id
+
 
+def run_ovr_platform_util(args, app_id, write=sys.stdout.write):
+  """Runs an ovr-platform-util upload, passing its output to *write* line by line.
+  Raises TransientUploadError if the upload failed in a way that's worth retrying."""
   try:
     proc = Popen(args, stdin=PIPE, stdout=PIPE, stderr=STDOUT)
     proc.stdin.close()
@@ -305,13 +310,14 @@ def push_tilt_brush_to_oculus(
 
   saw_output = False
   desired_version_code = None
-  for line in group_into_lines(unbuffered_reads(proc.stdout)):
+  for line in group_into_lines(buffered_reads(proc.stdout)):
     if line.strip():
       saw_output = True
-    sys.stdout.write(line)
+    write(line)
     # The request will be retried indefinitely, so stall it out
     if 'error occurred. The request will be retried.' in line:
-      print
+      proc.terminate()
+      write('\n')
       get_credential(app_id).delete_secret()
       # Maybe the secret changed; ask user to re-enter it
       raise BuildFailed("Your App Secret might be incorrect. Try again.")
@@ -330,11 +336,252 @@ def push_tilt_brush_to_oculus(
     if desired_version_code is not None:
       raise BadVersionCode(message, desired_version_code)
     else:
-      raise BuildFailed(message)
+      raise TransientUploadError(message)
   if not saw_output:
     raise BuildFailed('ovr-platform-util seemed to do nothing.\nYou probably need a newer version.\nDownload it at https://dashboard.oculus.com/tools/cli')
 
 
+def push_tilt_brush_to_oculus(
+    build_path,
+    release_channel,
+    release_notes):
+  args, app_id = get_oculus_upload_args(build_path, release_channel, release_notes)
+  run_ovr_platform_util(args, app_id)
+
+
+# ----------------------------------------------------------------------
+# Upload orchestration
+# ----------------------------------------------------------------------
+
+class RetryPolicy(object):
+  """How many times to attempt an upload, and how long to wait in between.
+  The delay grows by *backoff* after each failed attempt, up to *max_delay*."""
+  def __init__(self, max_attempts=3, initial_delay=30, backoff=2.0, max_delay=600):
+    self.max_attempts = max_attempts
+    self.initial_delay = initial_delay
+    self.backoff = backoff
+    self.max_delay = max_delay
+
+  def get_delay(self, attempt):
+    """Returns the number of seconds to wait after failed attempt number *attempt* (1-based)."""
+    return min(self.max_delay, self.initial_delay * self.backoff ** (attempt - 1))
+
+
+class UploadJob(object):
+  """A single upload to a single storefront and channel.
+
+  name - short human-readable name, eg "Oculus:ALPHA". Must be unique.
+  state_key - identifies the upload in the resumable state file; should
+    include the build stamp so a new build isn't mistaken for a finished one.
+  run - callable taking a write(text) function. Raises TransientUploadError
+    for failures worth retrying, BuildFailed for others.
+  prepare - optional callable run serially (and possibly interactively)
+    before any uploads start, eg to log in or fetch secrets.
+  lock_name - jobs with the same lock_name never run concurrently,
+    eg because their tool only allows a single instance."""
+  def __init__(self, name, state_key, run, prepare=None, lock_name=None):
+    self.name = name
+    self.state_key = state_key
+    self.run = run
+    self.prepare = prepare
+    self.lock_name = lock_name
+
+
+def make_steam_upload_job(source_dir, description, steam_user, steam_branch=None):
+  """Returns an UploadJob that pushes *source_dir* to Steam."""
+  state = {}
+  branch_name = steam_branch or 'default'
+  def prepare():
+    # Log in interactively up front, so the upload itself never prompts.
+    # steamcmd caches the login for subsequent runs.
+    try:
+      steamcmd('+login', steam_user, '+quit')
+    except OSError:
+      raise BuildFailed("You don't seem to have steamcmd installed")
+    state['app_vdf'] = prepare_steam_push(
+      source_dir, description, steam_branch,
+      tmp_dir=os.path.join(get_tmp_steam_dir(), 'branch_' + branch_name))
+  def run(write):
+    write("Pushing %s to Steam\n" % os.path.abspath(source_dir))
+    run_tool_noninteractive(['steamcmd',
+                             '+login', steam_user,
+                             '+run_app_build', state['app_vdf'],
+                             '+quit'], write)
+  return UploadJob('Steam:%s' % branch_name,
+                   'Steam:%s:%s' % (branch_name, get_build_stamp(source_dir)),
+                   run, prepare=prepare, lock_name='steamcmd')
+
+
+def make_oculus_upload_job(build_path, release_channel, release_notes):
+  """Returns an UploadJob that pushes *build_path* to an Oculus release channel."""
+  state = {}
+  def prepare():
+    state['args'], state['app_id'] = get_oculus_upload_args(
+      build_path, release_channel, release_notes)
+  def run(write):
+    run_ovr_platform_util(state['args'], state['app_id'], write)
+  build_type = get_oculus_build_type(build_path)
+  return UploadJob('Oculus-%s:%s' % (build_type, release_channel),
+                   'Oculus-%s:%s:%s' % (build_type, release_channel,
+                                        get_build_stamp(build_path)),
+                   run, prepare=prepare)
+
+
+def run_tool_noninteractive(args, write):
+  """Runs *args* with no stdin, passing its output to *write* line by line.
+  Raises TransientUploadError if the tool exits with an error."""
+  try:
+    proc = Popen(args, stdin=PIPE, stdout=PIPE, stderr=STDOUT)
+    proc.stdin.close()
+  except OSError as e:
+    raise BuildFailed("Cannot run %s: %s" % (args[0], e))
+  for line in group_into_lines(buffered_reads(proc.stdout)):
+    write(line)
+  if proc.wait() != 0:
+    raise TransientUploadError("%s failed with code %s" % (args[0], proc.wait()))
+
+
+class UploadOrchestrator(object):
+  """Runs several UploadJobs concurrently, retrying transient failures.
+
+  Progress is recorded in *state_file* (if passed) after every attempt.
+  Jobs that the state file says have already succeeded are skipped, so a
+  partially-failed push can be re-run without re-uploading everything.
+  Each run gets the full number of retries; the state file records the
+  total number of attempts across runs."""
+  def __init__(self, jobs, state_file=None, retry_policy=None, max_parallel=4):
+    import threading
+    names = [job.name for job in jobs]
+    if len(set(names)) != len(names):
+      raise InternalError("Duplicate upload job names: %s" % (names,))
+    self.jobs = jobs
+    self.state_file = state_file
+    self.retry_policy = retry_policy or RetryPolicy()
+    self.max_parallel = max_parallel
+    self.state = self._load_state()
+    self._state_lock = threading.Lock()
+    self._output_lock = threading.Lock()
+    self._parallel = threading.Semaphore(max_parallel)
+    self._named_locks = dict((job.lock_name, threading.Lock())
+                             for job in jobs if job.lock_name is not None)
+
+  def _load_state(self):
+    if self.state_file is None:
+      return {}
+    import json
+    try:
+      with open(self.state_file) as inf:
+        return json.load(inf)['jobs']
+    except (IOError, ValueError, KeyError):
+      return {}
+
+  def _save_state(self):
+    if self.state_file is None:
+      return
+    import json
+    tmp_file = self.state_file + '.tmp'
+    with open(tmp_file, 'w') as outf:
+      json.dump({'jobs': self.state}, outf, indent=2, sort_keys=True)
+    if os.path.exists(self.state_file):
+      os.unlink(self.state_file)  # Windows rename doesn't overwrite
+    os.rename(tmp_file, self.state_file)
+
+  def _update_state(self, job, **kwargs):
+    import time
+    with self._state_lock:
+      entry = self.state.setdefault(job.state_key, {'attempts': 0})
+      entry.update(kwargs, time=time.time())
+      self._save_state()
+
+  def _make_writer(self, job):
+    """Returns a write(text) function that prefixes lines with the job name,
+    if there's more than one job."""
+    prefix = '%s| ' % job.name if len(self.jobs) > 1 else ''
+    def write(text):
+      if not text:
+        return
+      with self._output_lock:
+        sys.stdout.write(prefix + text)
+        sys.stdout.flush()
+    return write
+
+  def _run_job(self, job, results):
+    import time
+    write = self._make_writer(job)
+    lock = self._named_locks.get(job.lock_name)
+    previous_attempts = self.state.get(job.state_key, {}).get('attempts', 0)
+    attempt = 0
+    while True:
+      attempt += 1
+      attempts = previous_attempts + attempt
+      try:
+        with self._parallel:
+          if lock is not None:
+            lock.acquire()
+          try:
+            job.run(write)
+          finally:
+            if lock is not None:
+              lock.release()
+      except TransientUploadError as e:
+        self._update_state(job, status='failed', attempts=attempts, error=str(e))
+        if attempt >= self.retry_policy.max_attempts:
+          results[job.name] = e
+          return
+        delay = self.retry_policy.get_delay(attempt)
+        write('WARN: %s; retrying in %d seconds\n' % (e, delay))
+        time.sleep(delay)
+      except Exception as e:
+        self._update_state(job, status='failed', attempts=attempts, error=str(e))
+        results[job.name] = e
+        return
+      else:
+        self._update_state(job, status='succeeded', attempts=attempts, error=None)
+        results[job.name] = None
+        return
+
+  def run(self):
+    """Runs all jobs that haven't already succeeded.
+    Raises BuildFailed (or BadVersionCode) if any of them fail."""
+    import threading
+    pending = [job for job in self.jobs
+               if self.state.get(job.state_key, {}).get('status') != 'succeeded']
+    for job in self.jobs:
+      if job not in pending:
+        print 'Skipping %s: already uploaded' % job.name
+    # Preparation may prompt the user, so it happens serially and up front
+    for job in pending:
+      if job.prepare is not None:
+        job.prepare()
+
+    results = {}
+    threads = [threading.Thread(target=self._run_job, args=(job, results))
+               for job in pending]
+    for t in threads:
+      t.daemon = True
+      t.start()
+    for t in threads:
+      # A timeout lets KeyboardInterrupt through on Windows
+      while t.is_alive():
+        t.join(0.5)
+
+    failures = []
+    for job in pending:
+      if job.name not in results:
+        failures.append((job.name, InternalError("Upload thread exited unexpectedly")))
+      elif results[job.name] is not None:
+        failures.append((job.name, results[job.name]))
+    if len(failures) == 1:
+      raise failures[0][1]
+    elif len(failures) > 1:
+      message = 'Uploads failed:\n' + '\n'.join(
+        '  %s: %s' % (name, e) for (name, e) in failures)
+      for (_, e) in failures:
+        if isinstance(e, BadVersionCode):
+          raise BadVersionCode(message, e.desired_version_code)
+      raise BuildFailed(message)
+
+
 # ----------------------------------------------------------------------
 # Command-line use. Deprecated and mostly for testing
 # ----------------------------------------------------------------------
@@ -375,6 +622,48 @@ def main(args=None):
     raise BuildFailed("Don't know how to push %s" % args.display)
 
 
+def test_upload_orchestrator():
+  """Exercises retries and resumption using stub command-line tools."""
+  import tempfile
+  tmp_dir = tempfile.mkdtemp()
+  counter = os.path.join(tmp_dir, 'counter')
+  # Fails the first time it's run, then succeeds
+  flaky_cli = [sys.executable, '-c', """if 1:
+    import os, sys
+    print 'uploading\\r50%%\\r100%%'
+    if not os.path.exists(%r):
+      open(%r, 'w').close()
+      sys.exit(1)""" % (counter, counter)]
+  failing_cli = [sys.executable, '-c', 'import sys; sys.exit(2)']
+  def make_job(name, cli):
+    return UploadJob(name, name + ':stamp',
+                     lambda write: run_tool_noninteractive(cli, write), lock_name=name)
+  state_file = os.path.join(tmp_dir, 'state.json')
+  policy = RetryPolicy(max_attempts=2, initial_delay=0)
+  jobs = [make_job('flaky', flaky_cli), make_job('failing', failing_cli)]
+  try:
+    UploadOrchestrator(jobs, state_file, policy).run()
+  except TransientUploadError as e:
+    assert 'code 2' in str(e)
+  else:
+    assert False  # must raise
+
+  orchestrator = UploadOrchestrator(jobs, state_file, policy)
+  assert orchestrator.state['flaky:stamp']['status'] == 'succeeded'
+  assert orchestrator.state['flaky:stamp']['attempts'] == 2
+  assert orchestrator.state['failing:stamp']['attempts'] == 2
+  # Resuming only retries the job that failed, and it gets its retries back
+  failures = [TransientUploadError('flaky again')]
+  def run_flaky_again(write):
+    if failures:
+      raise failures.pop()
+  jobs[1].run = run_flaky_again
+  orchestrator.run()
+  state = UploadOrchestrator(jobs, state_file).state['failing:stamp']
+  assert state['status'] == 'succeeded'
+  assert state['attempts'] == 4
+
+
 if __name__ == '__main__':
   try:
     main()
@@ -16,6 +16,7 @@
 
 import os
 import contextlib
+import threading
 
 from unitybuild.constants import InternalError
 
@@ -34,26 +35,233 @@ def ensure_terminate(proc):
       print "WARN: Could not kill process: %s" % (e,)
 
 
+def _unlink_writable(filename):
+  """Unlinks *filename*, clearing its read-only bit only if necessary.
+  Ignores files that have already disappeared."""
+  import errno, stat
+  try:
+    os.unlink(filename)
+  except OSError as e:
+    if e.errno == errno.ENOENT:
+      return
+    # Windows refuses to unlink read-only files
+    os.chmod(filename, stat.S_IWRITE)
+    os.unlink(filename)
+
+
+def _rmtree_parallel(directory, num_threads=8):
+  """Deletes the directory tree *directory*, unlinking files from several threads.
+  Unlinking is bound by filesystem syscalls rather than by the GIL, so this
+  is substantially faster than a serial walk for large build directories."""
+  import errno
+  import Queue
+  to_unlink = Queue.Queue(maxsize=4096)
+  errors = []
+
+  def worker():
+    while True:
+      filename = to_unlink.get()
+      if filename is None:
+        return
+      try:
+        _unlink_writable(filename)
+      except OSError as e:
+        errors.append(e)
+
+  threads = [threading.Thread(target=worker) for _ in range(num_threads)]
+  for t in threads:
+    t.daemon = True
+    t.start()
+  # os.walk is top-down, so reversing this list visits children before parents
+  dirs = []
+  try:
+    for r, ds, fs in os.walk(directory):
+      dirs.append(r)
+      for f in fs:
+        to_unlink.put(os.path.join(r, f))
+      for d in ds:
+        # os.walk doesn't descend into symlinks, and they must be unlinked, not rmdir'd
+        if os.path.islink(os.path.join(r, d)):
+          to_unlink.put(os.path.join(r, d))
+  finally:
+    for t in threads:
+      to_unlink.put(None)
+    for t in threads:
+      t.join()
+  if errors:
+    raise errors[0]
+  for d in reversed(dirs):
+    try:
+      os.rmdir(d)
+    except OSError as e:
+      if e.errno != errno.ENOENT:
+        raise
+
+
 def destroy(file_or_dir):
   """Ensure that *file_or_dir* does not exist in the filesystem,
   deleting it if necessary."""
-  import stat
-  if os.path.isfile(file_or_dir):
-    os.chmod(file_or_dir, stat.S_IWRITE)
-    os.unlink(file_or_dir)
+  if os.path.islink(file_or_dir) or os.path.isfile(file_or_dir):
+    _unlink_writable(file_or_dir)
   elif os.path.isdir(file_or_dir):
-    import shutil, stat
-    for r,ds,fs in os.walk(file_or_dir, topdown=False):
-      for f in fs:
-        os.chmod(os.path.join(r, f), stat.S_IWRITE)
-        os.unlink(os.path.join(r, f))
-      for d in ds:
-        os.rmdir(os.path.join(r, d))
-    os.rmdir(file_or_dir)
+    _rmtree_parallel(file_or_dir)
   if os.path.exists(file_or_dir):
     raise InternalError("Temp build location '%s' is not empty" % file_or_dir)
 
 
+# Name of the directory (created next to the thing being destroyed) that
+# destroy_in_background() moves things into before deleting them.
+TRASH_DIR_NAME = '.trash'
+
+# Trash entries currently being deleted by this process
+_pending_trash = set()
+_pending_trash_lock = threading.Lock()
+_pending_threads = []
+
+
+def _move_to_trash(file_or_dir):
+  """Renames *file_or_dir* into a trash directory on the same filesystem.
+  Returns the new name. Raises OSError if the rename fails."""
+  import itertools
+  parent, name = os.path.split(os.path.abspath(file_or_dir))
+  trash_dir = os.path.join(parent, TRASH_DIR_NAME)
+  try: os.makedirs(trash_dir)
+  except OSError: pass
+  for i in itertools.count(1):
+    trash_name = os.path.join(trash_dir, '%s_%d_%d' % (name, os.getpid(), i))
+    if not os.path.lexists(trash_name):
+      break
+  os.rename(file_or_dir, trash_name)
+  return trash_name
+
+
+def _empty_trash(trash_dir):
+  """Deletes everything in *trash_dir* that this process isn't already deleting,
+  then removes *trash_dir* itself if it is empty.
+  Only prints warnings on failure, since this is just cleaning up garbage."""
+  try:
+    names = os.listdir(trash_dir)
+  except OSError:
+    return
+  for name in names:
+    trash_name = os.path.join(trash_dir, name)
+    with _pending_trash_lock:
+      if trash_name in _pending_trash:
+        continue
+      _pending_trash.add(trash_name)
+    try:
+      destroy(trash_name)
+    except Exception as e:
+      print "WARN: Could not clean up %s: %s" % (trash_name, e)
+    finally:
+      with _pending_trash_lock:
+        _pending_trash.discard(trash_name)
+  try: os.rmdir(trash_dir)
+  except OSError: pass  # Not empty; another deletion is still in progress
+
+
+def _empty_trash_in_background(trash_dir):
+  t = threading.Thread(target=_empty_trash, args=(trash_dir,))
+  # Don't hold up process exit; anything left over is cleaned up next time.
+  t.daemon = True
+  t.start()
+  _pending_threads.append(t)
+
+
+def destroy_in_background(file_or_dir):
+  """Ensure that *file_or_dir* does not exist in the filesystem.
+
+  Unlike destroy(), this returns as soon as *file_or_dir* has been renamed
+  into a trash directory alongside it; the actual deletion happens in a
+  background thread. Leftovers from earlier, interrupted deletions in the
+  same trash directory are cleaned up too.
+  Falls back to a synchronous destroy() if the rename fails."""
+  if not os.path.lexists(file_or_dir):
+    return
+  try:
+    trash_name = _move_to_trash(file_or_dir)
+  except OSError:
+    destroy(file_or_dir)
+    return
+  _empty_trash_in_background(os.path.dirname(trash_name))
+
+
+def wait_for_background_destroys(timeout=None):
+  """Waits for deletions started by destroy_in_background() to finish.
+  Returns True if they all finished."""
+  import time
+  deadline = None if timeout is None else time.time() + timeout
+  while _pending_threads:
+    t = _pending_threads[0]
+    t.join(None if deadline is None else max(0, deadline - time.time()))
+    if t.is_alive():
+      return False
+    _pending_threads.pop(0)
+  return True
+
+
+def swap_directories(src_dir, dst_dir):
+  """Renames *src_dir* to *dst_dir*, replacing any existing *dst_dir*.
+  The old *dst_dir* is moved aside first and deleted in the background,
+  so *dst_dir* is only ever missing for the instant between two renames.
+  If *src_dir* cannot be renamed, the old *dst_dir* is put back.
+  Raises OSError on failure."""
+  old_dst = None
+  if os.path.lexists(dst_dir):
+    old_dst = _move_to_trash(dst_dir)
+  try:
+    os.rename(src_dir, dst_dir)
+  except OSError:
+    if old_dst is not None:
+      os.rename(old_dst, dst_dir)
+    raise
+  if old_dst is not None:
+    _empty_trash_in_background(os.path.dirname(old_dst))
+
+
+class LineReader(object):
+  """Incrementally splits chunks of text into lines.
+
+  Lines end with \\n, \\r\\n, or a lone \\r (as used by progress bars), and
+  keep their terminators, so joining every line returned reproduces the input.
+  A \\r\\n that straddles two chunks comes out as a line ending in \\r
+  followed by a line containing just \\n, since lines are returned as soon
+  as they're complete.
+
+  To bound memory use, an unterminated line longer than *max_line_length*
+  is returned as-is rather than buffered further."""
+  def __init__(self, max_line_length=65536):
+    self.max_line_length = max_line_length
+    self._partial = ''
+
+  def feed(self, data):
+    """Returns a list of the lines completed by *data*."""
+    if self._partial:
+      data = self._partial + data
+      self._partial = ''
+    lines = data.splitlines(True)
+    if lines and not lines[-1].endswith(('\n', '\r')):
+      self._partial = lines.pop()
+      if len(self._partial) > self.max_line_length:
+        lines.append(self._partial)
+        self._partial = ''
+    return lines
+
+  def flush(self):
+    """Returns any unterminated text, and forgets about it."""
+    ret, self._partial = self._partial, ''
+    return ret
+
+  def iter_lines(self, chunks):
+    """Yields lines from an iterable of chunks, including a final unterminated one."""
+    for chunk in chunks:
+      for line in self.feed(chunk):
+        yield line
+    last = self.flush()
+    if last:
+      yield last
+
+
 def msys_control_c_workaround():
   """Turn off console Ctrl-c support and implement it ourselves."""
   # Used to work around a bug in msys where control-c kills the process
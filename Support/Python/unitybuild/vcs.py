@@ -47,16 +47,180 @@ Raises CalledProcessError if process cannot be started, or exits with an error."
   return stdout
 
 
+def find_git_dirs(cwd=None):
+  """Returns (toplevel, git_dir) for the git client containing *cwd*,
+  without running git. Raises LookupError if not in a git client."""
+  cur = os.path.abspath(cwd or os.getcwd())
+  while True:
+    dotgit = os.path.join(cur, '.git')
+    if os.path.isdir(dotgit):
+      return cur, dotgit
+    elif os.path.isfile(dotgit):
+      # Worktrees and submodules have a file pointing at the real git dir
+      with open(dotgit) as inf:
+        m = re.match(r'gitdir: (.*)', inf.read())
+      if m is not None:
+        return cur, os.path.normpath(os.path.join(cur, m.group(1).strip()))
+    parent = os.path.dirname(cur)
+    if parent == cur:
+      raise LookupError("Not in a git client: %s" % cwd)
+    cur = parent
+
+
+class GitStatus(object):
+  """The parsed output of "git status --porcelain=v2 --branch".
+  oid - sha of HEAD, or None if there are no commits yet.
+  branch - name of the local branch, or None if detached.
+  upstream - short name of the tracking branch (eg "origin/master"), or None.
+  ahead, behind - number of commits relative to upstream, or None.
+  changes - list of (XY, filename) for tracked files with changes, where
+    XY are the two-character index and work tree statuses (eg ".M")."""
+  def __init__(self, text):
+    self.oid = self.branch = self.upstream = None
+    self.ahead = self.behind = None
+    self.changes = []
+    for line in text.splitlines():
+      if line.startswith('# branch.oid '):
+        oid = line.split()[2]
+        self.oid = None if oid == '(initial)' else oid
+      elif line.startswith('# branch.head '):
+        head = line.split(' ', 2)[2]
+        self.branch = None if head == '(detached)' else head
+      elif line.startswith('# branch.upstream '):
+        self.upstream = line.split(' ', 2)[2]
+      elif line.startswith('# branch.ab '):
+        ahead, behind = line.split()[2:4]
+        self.ahead, self.behind = int(ahead), -int(behind)
+      elif line.startswith('1 '):
+        fields = line.split(' ', 8)
+        self.changes.append((fields[1], fields[8]))
+      elif line.startswith('2 '):
+        # Renames and copies have "<path>\t<original path>"
+        fields = line.split(' ', 9)
+        self.changes.append((fields[1], fields[9].split('\t')[0]))
+
+
+class GitQueries(object):
+  """Batched, memoized git queries for a single client.
+
+  Queries that only depend on commits (not on the work tree) can be
+  memoized per HEAD with memoize(); results persist in a small cache file
+  in the git directory, so repeated builds of the same commit don't have to
+  re-run them; call flush() to write new results. Object contents are read
+  through a single long-running "git cat-file --batch" process."""
+  CACHE_FILE = 'unitybuild_cache.json'
+  # Don't let the cache grow without bound
+  MAX_CACHED_HEADS = 50
+
+  def __init__(self, cwd=None):
+    """Raises LookupError if *cwd* is not in a git client."""
+    self.toplevel, self.git_dir = find_git_dirs(cwd)
+    self._memo = None
+    self._memo_dirty = False
+    self._head = None
+    self._cat_file_proc = None
+
+  def run(self, cmd):
+    """Runs git in the client's top level; returns stdout."""
+    return git(cmd, cwd=self.toplevel)
+
+  def get_status(self):
+    """Returns a GitStatus. Always runs git, since the work tree may have changed."""
+    status = GitStatus(self.run('status --porcelain=v2 --branch --untracked-files=no'))
+    self._head = status.oid
+    return status
+
+  def _load_memo(self):
+    if self._memo is None:
+      import json
+      try:
+        with open(os.path.join(self.git_dir, self.CACHE_FILE)) as inf:
+          self._memo = json.load(inf)
+      except (IOError, ValueError):
+        self._memo = {}
+    return self._memo
+
+  def flush(self):
+    """Writes the memo to the cache file, if anything new was memoized."""
+    if not self._memo_dirty:
+      return
+    import json
+    self._memo_dirty = False
+    # Oldest HEADs go first
+    for head in sorted(self._memo, key=lambda h: self._memo[h].get('_used', 0))[
+        :max(0, len(self._memo) - self.MAX_CACHED_HEADS)]:
+      del self._memo[head]
+    try:
+      with open(os.path.join(self.git_dir, self.CACHE_FILE), 'w') as outf:
+        json.dump(self._memo, outf, sort_keys=True)
+    except IOError:
+      pass  # It's only a cache
+
+  def memoize(self, name, func, head=None):
+    """Returns func(), remembering the result for the current HEAD.
+    *name* must uniquely identify the query relative to HEAD.
+    *head* defaults to the sha from the last get_status()."""
+    import time
+    head = head or self._head
+    if head is None:
+      return func()
+    memo = self._load_memo()
+    entry = memo.setdefault(head, {})
+    if name not in entry:
+      entry[name] = func()
+      self._memo_dirty = True
+    # Only written out along with new entries; close enough for eviction
+    entry['_used'] = time.time()
+    return entry[name]
+
+  def get_short_sha(self, sha):
+    """Returns the abbreviation git would use for *sha*."""
+    return self.memoize('short:' + sha,
+                        lambda: self.run('rev-parse --short %s' % sha).strip())
+
+  def cat_file(self, git_object):
+    """Returns the contents of *git_object* (eg "HEAD:Support/foo.txt").
+    Raises LookupError if it doesn't exist."""
+    if self._cat_file_proc is None:
+      try:
+        self._cat_file_proc = Popen(['git', 'cat-file', '--batch'], cwd=self.toplevel,
+                                    stdin=PIPE, stdout=PIPE)
+      except OSError as e:
+        raise CalledProcessError(1, ['git', 'cat-file', '--batch'], str(e))
+    proc = self._cat_file_proc
+    proc.stdin.write(git_object + '\n')
+    proc.stdin.flush()
+    header = proc.stdout.readline()
+    if header == '':
+      self.close()
+      raise CalledProcessError(1, ['git', 'cat-file', '--batch'], 'exited unexpectedly')
+    fields = header.split()
+    if len(fields) != 3:
+      # eg "<object> missing" or "<object> ambiguous"
+      raise LookupError("%s: %s" % (git_object, fields[-1] if fields else 'missing'))
+    size = int(fields[2])
+    contents = proc.stdout.read(size)
+    proc.stdout.read(1)  # trailing newline
+    return contents
+
+  def close(self):
+    if self._cat_file_proc is not None:
+      try:
+        self._cat_file_proc.stdin.close()
+        self._cat_file_proc.wait()
+      except (IOError, OSError):
+        pass
+      self._cat_file_proc = None
+
+
 def create():
   """Returns a VCS instance."""
-  warnings = []
-  in_git = True
   try:
-    git('status')
-  except CalledProcessError as e1:
+    find_git_dirs()
+  except LookupError:
     return NullVcs()
   else:
-    return GitVcs();
+    return GitVcs()
 
 
 class VcsBase(object):
@@ -68,50 +232,74 @@ class VcsBase(object):
     Raises LookupError if this is not possible.
     Build stamp is currently a p4 changelist number, eg '@1234'"""
     raise NotImplementedError()
+  def get_input_hash(self, input_directory):
+    """Returns a hash of the contents of all tracked files, including
+    uncommitted modifications, and of all untracked files that aren't ignored.
+    Raises LookupError if this is not possible."""
+    raise NotImplementedError()
 
 
 class NullVcs(VcsBase):
   """VCS implementation that does nothing"""
   def get_build_stamp(self, input_directory):
     raise LookupError("Not using version control")
+  def get_input_hash(self, input_directory):
+    raise LookupError("Not using version control")
   
 
 class GitVcs(VcsBase):
   """VCS implementation that uses git (without p4)"""
   def __init__(self):
     try:
-      s = git('status')
-    except CalledProcessError:
+      find_git_dirs()
+    except LookupError:
       raise UserError("Not in a git client")
 
-  def _get_local_branch(self):
-    ref = git('rev-parse --symbolic-full-name HEAD')
-    m = re.match('refs/heads/(.*)', ref)
-    if m is None:
+  @staticmethod
+  def _get_local_branch(status):
+    if status.branch is None:
       raise LookupError("Not on a branch")
-    return m.group(1)
+    return status.branch
 
-  def _get_gob_branch(self):
+  def _get_gob_branch(self, status):
     """Returns the name of the branch on GoB that the current branch is tracking,
     as well as the local name of the tracking branch.
-    eg, ("master", "refs/remotes/origin/master")
+    eg, ("master", "origin/master")
     Raises LookupError on failure, eg if not on a branch, or remote is not GoB."""
-    branch = self._get_local_branch()
-    try: remote = git('config branch.%s.remote' % branch).strip()
-    except CalledProcessError: remote = ''
-    if remote == '':
+    self._get_local_branch(status)
+    if status.upstream is None:
       raise LookupError("Can't determine GoB branch: no remote")
-    remote_url = git('config remote.%s.url' % remote).strip()
-    # if ('Prod/TiltBrush' not in remote_url) and ('tiltbrush/launch_trailer' not in remote_url):
-    #   raise LookupError("Can't determine GoB branch: remote is not GoB")
-    remote_branch = git('config branch.%s.merge' % branch).strip()
-    m = re.match('refs/heads/(.*)', remote_branch)
-    if m is None:
-      raise LookupError("Can't determine GoB name: %s looks funny" % remote_branch)
-
-    tracking = git('rev-parse --symbolic-full-name @{u}').strip()
-    assert tracking != ''
-    return m.group(1), tracking
+    if status.ahead is None:
+      raise LookupError("Can't determine GoB branch: %s is gone" % status.upstream)
+    return status.upstream.split('/', 1)[-1], status.upstream
+
+  def get_input_hash(self, input_directory):
+    # The index has a blob sha for every tracked file; the diff picks up
+    # anything modified in the working tree but not yet staged or committed.
+    # Untracked (but not ignored) files are hashed by name and contents,
+    # since a new asset that hasn't been added yet still goes into the build.
+    import hashlib
+    try:
+      index = git('ls-files --stage', cwd=input_directory)
+      diff = git('diff --no-ext-diff --no-color --binary HEAD', cwd=input_directory)
+      others = git('ls-files -z --others --exclude-standard', cwd=input_directory)
+    except CalledProcessError as e:
+      raise LookupError("Cannot hash inputs: %s" % e)
+    h = hashlib.sha1(index + '\0' + diff)
+    for filename in sorted(others.split('\0')):
+      if filename == '':
+        continue
+      h.update('\0' + filename + '\0')
+      try:
+        with open(os.path.join(input_directory, filename), 'rb') as inf:
+          while True:
+            chunk = inf.read(1 << 20)
+            if not chunk:
+              break
+            h.update(chunk)
+      except IOError as e:
+        raise LookupError("Cannot hash untracked file %s: %s" % (filename, e))
+    return h.hexdigest()
 
   def get_build_stamp(self, input_directory):
     """Stamp is of the form:
@@ -119,15 +307,26 @@ class GitVcs(VcsBase):
       <sha>+<local changes>
     <sha> is a sha of the lastest GoB commit included in the current build.
     <local changes> is a tiny description of any changes in the build that aren't on GoB."""
+    # In the common case (a clean client at its upstream commit) this is a
+    # single "git status"; everything else it needs is memoized per HEAD.
     try:
-      status = git('status --porcelain', cwd=input_directory)
+      queries = GitQueries(input_directory)
+      status = queries.get_status()
     except CalledProcessError as e:
       print 'UNEXPECTED: %s\n%s' % (e, e.output)
       print 'In:', os.getcwd()
       assert False
-    for match in re.finditer(r'^(.[MADR]|[MADR].) (.*)', status, re.MULTILINE):
+    try:
+      return self._get_build_stamp(queries, status)
+    finally:
+      queries.flush()
+      queries.close()
+
+  def _get_build_stamp(self, queries, status):
+    for (xy, filename) in status.changes:
+      if not re.search(r'[MADR]', xy):
+        continue
       # Ignore changes in build script files
-      filename = match.group(2)
       if re.match(r'Support/(.*\.py|obfuscation_map\.txt)$', filename):
         continue
       # For practicality, ignore changes to ProjectSettings too; allows Jon to re-build
@@ -138,18 +337,26 @@ class GitVcs(VcsBase):
         continue
       raise LookupError('repo has modified files (%s)' % filename)
 
-    tracked_name, tracked_ref = self._get_gob_branch()
-    base = git('merge-base %s HEAD' % tracked_ref).strip()
+    tracked_name, tracked_ref = self._get_gob_branch(status)
+    if status.ahead == 0:
+      # HEAD is an ancestor of (or equal to) the tracking branch
+      base = status.oid
+    else:
+      # Not memoized, since it depends on where the tracking branch is
+      base = queries.run('merge-base %s HEAD' % tracked_ref).strip()
     if base == '':
       raise LookupError('No common ancestor with %s' % tracked_ref)
-    base = git('rev-parse --short %s' % base).strip()
+    base = queries.get_short_sha(base)
     # It's verbose and redundant (with our human-made version number) to put the
     # gob branch name in the stamp. The sha is all we really need.
     # gob_name = '%s-%s' % (tracked_name.replace('-', ''), base)
     gob_name = base
 
-    ahead_commits = git(['log', '--pretty=tformat:%h %s', '%s..HEAD' % base]).split('\n')[:-1]
-    behind_commits = git(['log', '--pretty=tformat:%h %s', 'HEAD..%s' % tracked_ref]).split('\n')[:-1]
+    def get_log(revisions):
+      return queries.run(['log', '--pretty=tformat:%h %s', revisions]).split('\n')[:-1]
+    # Only pay for listing commits if there are some to list
+    ahead_commits = get_log('%s..HEAD' % base) if status.ahead > 0 else []
+    behind_commits = get_log('HEAD..%s' % tracked_ref) if status.behind > 0 else []
     if len(ahead_commits) == 0:
       if len(behind_commits) > 0:
         # Still allow the build without a custom stamp, but warn that it's not head
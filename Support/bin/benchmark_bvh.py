@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+# Copyright 2020 The Tilt Brush Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks batched queries over tbdata.bvh.
+
+Builds an ArrayRTree from the stroke bounds of each sketch (by default,
+Support/Sketches/PerfTest), then times ray, frustum and box queries against
+a brute-force test of every stroke, and checks that the answers agree."""
+
+import argparse
+import glob
+import os
+import sys
+import time
+
+import numpy
+
+# Add ../Python to sys.path
+sys.path.append(
+  os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Python'))
+
+from tbdata.bvh import ArrayRTree, frustum_planes
+
+PERFTEST_DIR = os.path.join(
+  os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Sketches', 'PerfTest')
+
+
+def load_sketch_bounds(filename):
+  """Returns (stroke_ids, bounds) for a .tilt file."""
+  try:
+    from tiltbrush.tilt import Tilt
+  except ImportError:
+    print "You need the Tilt Brush Toolkit (https://github.com/googlevr/tilt-brush-toolkit)"
+    print "and then put its Python directory in your PYTHONPATH, or use --synthetic."
+    sys.exit(1)
+  from tbdata.stroke_index import get_stroke_bounds
+  return get_stroke_bounds(Tilt(filename).sketch.strokes)
+
+
+def make_synthetic_bounds(num_strokes, rng):
+  """Returns (stroke_ids, bounds) for clumps of small random boxes."""
+  clumps = rng.rand(max(1, num_strokes // 500), 3) * 20
+  centers = clumps[rng.randint(0, len(clumps), num_strokes)] + rng.randn(num_strokes, 3)
+  half = rng.rand(num_strokes, 3) * .2 + .01
+  return numpy.arange(num_strokes), numpy.stack([centers - half, centers + half], axis=1)
+
+
+def make_rays(bounds, num_rays, rng):
+  """Returns rays from a sphere around the sketch towards random points in it."""
+  lo, hi = bounds[:, 0].min(axis=0), bounds[:, 1].max(axis=0)
+  center, radius = (lo + hi) / 2, numpy.linalg.norm(hi - lo)
+  v = rng.randn(num_rays, 3)
+  origins = center + radius * v / numpy.linalg.norm(v, axis=1)[:, numpy.newaxis]
+  targets = lo + rng.rand(num_rays, 3) * (hi - lo)
+  return origins, targets - origins
+
+
+def make_frustums(bounds, num_frustums, rng):
+  """Returns narrow perspective frustums looking at random points in the sketch."""
+  lo, hi = bounds[:, 0].min(axis=0), bounds[:, 1].max(axis=0)
+  center, radius = (lo + hi) / 2, numpy.linalg.norm(hi - lo)
+  near, far, f = radius * .01, radius * 4, 1 / numpy.tan(.2)
+  projection = numpy.array([[f, 0, 0, 0], [0, f, 0, 0],
+                            [0, 0, (far + near) / (near - far), 2 * far * near / (near - far)],
+                            [0, 0, -1, 0]])
+  ret = []
+  for _ in xrange(num_frustums):
+    v = rng.randn(3)
+    eye = center + radius * v / numpy.linalg.norm(v)
+    forward = lo + rng.rand(3) * (hi - lo) - eye
+    forward /= numpy.linalg.norm(forward)
+    right = numpy.cross(forward, [0, 1, 0])
+    right /= numpy.linalg.norm(right)
+    up = numpy.cross(right, forward)
+    view = numpy.eye(4)
+    view[:3, :3] = [right, up, -forward]
+    view[:3, 3] = -view[:3, :3].dot(eye)
+    ret.append(frustum_planes(projection.dot(view)))
+  return numpy.array(ret)
+
+
+def make_boxes(bounds, num_boxes, rng):
+  lo, hi = bounds[:, 0].min(axis=0), bounds[:, 1].max(axis=0)
+  bmins = lo + rng.rand(num_boxes, 3) * (hi - lo)
+  return bmins, bmins + rng.rand(num_boxes, 3) * (hi - lo) * .1
+
+
+# Brute force versions, for timing and correctness
+
+def brute_rays(ids, bounds, origins, directions):
+  ret = []
+  for o, d in zip(origins, directions):
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+      inv = 1.0 / d
+      t1 = (bounds[:, 0] - o) * inv
+      t2 = (bounds[:, 1] - o) * inv
+    t_enter = numpy.fmin(t1, t2).max(axis=1)
+    t_exit = numpy.fmax(t1, t2).min(axis=1)
+    ret.append(numpy.sort(ids[t_exit >= numpy.maximum(t_enter, 0)]))
+  return ret
+
+
+def brute_frustums(ids, bounds, frustums):
+  ret = []
+  for planes in frustums:
+    normals = planes[:, :3]
+    corner = numpy.where(normals >= 0, bounds[:, numpy.newaxis, 1], bounds[:, numpy.newaxis, 0])
+    dist = (normals * corner).sum(axis=2) + planes[:, 3]
+    ret.append(numpy.sort(ids[numpy.all(dist >= 0, axis=1)]))
+  return ret
+
+
+def brute_boxes(ids, bounds, bmins, bmaxs):
+  return [numpy.sort(ids[numpy.all(bounds[:, 0] <= bmax, axis=1) &
+                         numpy.all(bounds[:, 1] >= bmin, axis=1)])
+          for (bmin, bmax) in zip(bmins, bmaxs)]
+
+
+def timed(func, *args):
+  start = time.time()
+  ret = func(*args)
+  return ret, time.time() - start
+
+
+def bench(name, ids, bounds, args, rng):
+  tree, build_time = timed(ArrayRTree.from_bounds, ids, bounds)
+  print '%s: %d strokes, %d nodes, built in %.3fs' % (name, len(ids), len(tree), build_time)
+
+  origins, directions = make_rays(bounds, args.rays, rng)
+  frustums = make_frustums(bounds, args.frustums, rng)
+  bmins, bmaxs = make_boxes(bounds, args.boxes, rng)
+  queries = [
+    ('rays', len(origins), lambda: [numpy.sort(r) for r in tree.query_rays(origins, directions)],
+     lambda: brute_rays(ids, bounds, origins, directions)),
+    ('frustums', len(frustums), lambda: tree.query_frustums(frustums),
+     lambda: brute_frustums(ids, bounds, frustums)),
+    ('boxes', len(bmins), lambda: tree.query_boxes(bmins, bmaxs),
+     lambda: brute_boxes(ids, bounds, bmins, bmaxs)),
+  ]
+  ok = True
+  for (kind, n, query, brute) in queries:
+    result, query_time = timed(query)
+    expected, brute_time = timed(brute)
+    matches = all(numpy.array_equal(r, e) for (r, e) in zip(result, expected))
+    ok = ok and matches
+    print '  %-9s %6d queries  bvh %8.3fs  brute %8.3fs  %6.1fx  avg hits %7.1f%s' % (
+      kind, n, query_time, brute_time, brute_time / max(query_time, 1e-9),
+      numpy.mean([len(r) for r in result]), '' if matches else '  MISMATCH')
+  return ok
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('sketches', nargs='*',
+                      help='.tilt files (default: Support/Sketches/PerfTest/*.tilt)')
+  parser.add_argument('--synthetic', type=int, metavar='N',
+                      help="Use N random strokes instead of sketches")
+  parser.add_argument('--rays', type=int, default=10000)
+  parser.add_argument('--frustums', type=int, default=100)
+  parser.add_argument('--boxes', type=int, default=1000)
+  parser.add_argument('--seed', type=int, default=0)
+  args = parser.parse_args()
+
+  rng = numpy.random.RandomState(args.seed)
+  ok = True
+  if args.synthetic is not None:
+    ids, bounds = make_synthetic_bounds(args.synthetic, rng)
+    ok = bench('synthetic', ids, bounds, args, rng)
+  else:
+    for filename in args.sketches or sorted(glob.glob(os.path.join(PERFTEST_DIR, '*.tilt'))):
+      ids, bounds = load_sketch_bounds(filename)
+      if len(ids) == 0:
+        continue
+      ok = bench(os.path.basename(filename), ids, bounds, args, rng) and ok
+  sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+# Copyright 2020 The Tilt Brush Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks splitting of upload-tool output into lines.
+
+Compares the previous approach (one-byte reads fed through a regex) with
+unitybuild's buffered reads and LineReader, over a transcript of tool output.
+To record a transcript, redirect the output of eg ovr-platform-util or
+steamcmd to a file. If none is given, a synthetic one is generated."""
+
+import argparse
+import os
+import re
+import sys
+import tempfile
+import time
+
+# Add ../Python to sys.path
+sys.path.append(
+  os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Python'))
+
+from unitybuild.push import buffered_reads, group_into_lines
+
+
+def legacy_unbuffered_reads(inf):
+  while True:
+    data = inf.read(1)
+    if data == '': break
+    yield data
+
+
+def legacy_group_into_lines(iterable):
+  current = []
+  terminator = re.compile(r'^([^\r\n]*[\r\n]+)(.*)$', re.MULTILINE)
+  for data in iterable:
+    while True:
+      m = terminator.match(data)
+      if m is None:
+        break
+      eol, data = m.groups()
+      current.append(eol)
+      yield ''.join(current)
+      current = []
+    current.append(data)
+  yield ''.join(current)
+
+
+def write_synthetic_transcript(filename, megabytes):
+  """Writes something resembling ovr-platform-util upload output."""
+  with open(filename, 'wb') as outf:
+    i = 0
+    while outf.tell() < megabytes * 1024 * 1024:
+      outf.write('Uploading file %d: Assets/Data/resources%d.assets\r\n' % (i, i))
+      for pct in range(0, 101, 5):
+        outf.write('\r  [%-20s] %3d%% (%d KB/s)' % ('=' * (pct // 5), pct, 1000 + pct))
+      outf.write('\r\n')
+      i += 1
+
+
+def bench(name, filename, func):
+  with open(filename, 'rb') as inf:
+    start = time.time()
+    lines = list(func(inf))
+    elapsed = time.time() - start
+  size = os.path.getsize(filename)
+  print '%-10s %8.3f s  %8.1f MB/s  %d lines' % (
+    name, elapsed, size / 1e6 / max(elapsed, 1e-9), len(lines))
+  return ''.join(lines)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('transcript', nargs='?',
+                      help='Recorded tool output (default: generate one)')
+  parser.add_argument('--megabytes', type=float, default=4,
+                      help='Size of the synthetic transcript (default: %(default)s)')
+  parser.add_argument('--skip-legacy', action='store_true',
+                      help="Don't run the slow one-byte-at-a-time version")
+  args = parser.parse_args()
+
+  filename = args.transcript
+  if filename is None:
+    fd, filename = tempfile.mkstemp(suffix='.txt')
+    os.close(fd)
+    write_synthetic_transcript(filename, args.megabytes)
+  try:
+    with open(filename, 'rb') as inf:
+      expected = inf.read()
+    print 'Transcript: %s (%.1f MB)' % (filename, len(expected) / 1e6)
+    output = bench('buffered', filename, lambda inf: group_into_lines(buffered_reads(inf)))
+    assert output == expected, "LineReader output differs from input"
+    if not args.skip_legacy:
+      output = bench('legacy', filename,
+                     lambda inf: legacy_group_into_lines(legacy_unbuffered_reads(inf)))
+      assert output == expected
+  finally:
+    if args.transcript is None:
+      os.unlink(filename)
+
+
+if __name__ == '__main__':
+  main()
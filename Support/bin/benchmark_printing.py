@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+
+# Copyright 2020 The Tilt Brush Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks the 3d-printing pipeline in tbdata.printing.
+
+"run" times each processing step on each sketch (by default, everything in
+Support/Sketches) and writes the results to a json file. "compare" checks
+a results file against a baseline and exits non-zero on regressions.
+
+Each step runs in its own process on a freshly-loaded copy of the sketch,
+so the steps don't affect each other's timings or peak memory."""
+
+import argparse
+import glob
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# Add ../Python to sys.path
+sys.path.append(
+  os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Python'))
+
+SKETCH_ROOT = os.path.join(
+  os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Sketches')
+
+STEPS = ['convert_brushes', 'remove_stray_strokes', 'reduce_control_points', 'simplify_colors']
+
+
+# ----------------------------------------------------------------------
+# Worker: runs a single step on a single sketch
+# ----------------------------------------------------------------------
+
+def get_peak_rss_mb():
+  """Returns peak memory use of this process in MB, or None if unknown."""
+  try:
+    import resource
+  except ImportError:
+    pass
+  else:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on OSX, kilobytes elsewhere
+    return rss / (1024.0 * 1024) if sys.platform == 'darwin' else rss / 1024.0
+  try:
+    import psutil
+  except ImportError:
+    return None
+  return psutil.Process().memory_info().peak_wset / (1024.0 * 1024)
+
+
+def count_control_points(tilt):
+  return sum(len(stroke.controlpoints) for stroke in tilt.sketch.strokes)
+
+
+def run_step(step, tilt_filename, args):
+  """Runs *step* on a copy of *tilt_filename*. Returns a dict of measurements."""
+  import tbdata.printing as printing
+  from tbdata.brush_lookup import BrushLookup
+  from tiltbrush.tilt import Tilt
+
+  tilt = Tilt(tilt_filename)
+  control_points = count_control_points(tilt)
+  # Get lazy loading out of the way
+  BrushLookup.get()
+
+  start = time.time()
+  if step == 'convert_brushes':
+    printing.convert_brushes(tilt, printing.BRUSH_REPLACEMENTS)
+  elif step == 'remove_stray_strokes':
+    printing.remove_stray_strokes(tilt, args.max_dist,
+                                  BrushLookup.get().get_unique_guid('Wire'))
+  elif step == 'reduce_control_points':
+    printing.reduce_control_points(tilt, args.pos_error_tolerance)
+  elif step == 'simplify_colors':
+    printing.simplify_colors(tilt, num_colors=args.num_colors, preserve_colors=[])
+  else:
+    raise ValueError("Unknown step %s" % step)
+  seconds = time.time() - start
+
+  return {
+    'seconds': seconds,
+    'peak_rss_mb': get_peak_rss_mb(),
+    'control_points': control_points,
+    'control_points_per_second': control_points / max(seconds, 1e-9),
+  }
+
+
+def worker_main(args):
+  """Entry point for the child process."""
+  # The printing steps are chatty
+  real_stdout = sys.stdout
+  sys.stdout = open(os.devnull, 'w')
+  try:
+    result = run_step(args.step, args.sketch, args)
+  finally:
+    sys.stdout = real_stdout
+  print json.dumps(result)
+
+
+# ----------------------------------------------------------------------
+# Run
+# ----------------------------------------------------------------------
+
+def find_sketches(paths):
+  """Returns a sorted list of .tilt files, given files and directories."""
+  sketches = []
+  for path in paths:
+    if os.path.isdir(path):
+      sketches.extend(glob.glob(os.path.join(path, '*', '*.tilt')))
+      sketches.extend(glob.glob(os.path.join(path, '*.tilt')))
+    else:
+      sketches.append(path)
+  return sorted(set(os.path.normpath(s) for s in sketches))
+
+
+def get_sketch_name(sketch):
+  """Returns a stable name for *sketch*, eg "PerfTest/Bubbles.tilt"."""
+  sketch = os.path.abspath(sketch)
+  if sketch.startswith(os.path.abspath(SKETCH_ROOT) + os.sep):
+    return os.path.relpath(sketch, SKETCH_ROOT).replace('\\', '/')
+  return sketch.replace('\\', '/')
+
+
+def run_in_child(step, sketch, args, tmp_dir):
+  """Runs *step* on a scratch copy of *sketch* in a new process.
+  Returns the measurements, or raises subprocess.CalledProcessError."""
+  working = os.path.join(tmp_dir, os.path.basename(sketch))
+  shutil.copyfile(sketch, working)
+  try:
+    cmd = [sys.executable, os.path.abspath(__file__), '_worker',
+           '--max-dist', str(args.max_dist),
+           '--pos-error-tolerance', str(args.pos_error_tolerance),
+           '--num-colors', str(args.num_colors),
+           step, working]
+    output = subprocess.check_output(cmd)
+    return json.loads(output.strip().splitlines()[-1])
+  finally:
+    for f in glob.glob(os.path.splitext(working)[0] + '*'):
+      os.unlink(f)
+
+
+def run_main(args):
+  sketches = find_sketches(args.sketches or [SKETCH_ROOT])
+  steps = args.steps or STEPS
+  results = {}
+  tmp_dir = tempfile.mkdtemp(prefix='benchmark_printing_')
+  try:
+    for sketch in sketches:
+      name = get_sketch_name(sketch)
+      for step in steps:
+        best = None
+        try:
+          for _ in xrange(args.repeat):
+            result = run_in_child(step, sketch, args, tmp_dir)
+            if best is None or result['seconds'] < best['seconds']:
+              best = result
+        except subprocess.CalledProcessError as e:
+          print '%-40s %-22s FAILED (exit code %s)' % (name, step, e.returncode)
+          continue
+        results.setdefault(name, {})[step] = best
+        print '%-40s %-22s %8.3f s %8s MB %10d cp/s' % (
+          name, step, best['seconds'],
+          '%.1f' % best['peak_rss_mb'] if best['peak_rss_mb'] is not None else '?',
+          best['control_points_per_second'])
+  finally:
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+  with open(args.output, 'w') as outf:
+    json.dump({
+      'created': time.time(),
+      'platform': platform.platform(),
+      'python': platform.python_version(),
+      'settings': {
+        'max_dist': args.max_dist,
+        'pos_error_tolerance': args.pos_error_tolerance,
+        'num_colors': args.num_colors,
+        'repeat': args.repeat,
+      },
+      'results': results,
+    }, outf, indent=2, sort_keys=True)
+  print 'Wrote %s' % args.output
+
+  if args.baseline is not None:
+    return compare_files(args.baseline, args.output, args.time_tolerance,
+                         args.memory_tolerance)
+  return 0
+
+
+# ----------------------------------------------------------------------
+# Compare
+# ----------------------------------------------------------------------
+
+def find_regressions(baseline, current, time_tolerance, memory_tolerance, min_seconds=0.05):
+  """Returns a list of (sketch, step, description) for measurements in
+  *current* that are worse than *baseline* by more than the given fractions.
+  Timings shorter than *min_seconds* are too noisy to compare."""
+  regressions = []
+  for sketch, steps in sorted(current['results'].iteritems()):
+    for step, cur in sorted(steps.iteritems()):
+      try:
+        base = baseline['results'][sketch][step]
+      except KeyError:
+        continue
+      if max(base['seconds'], cur['seconds']) >= min_seconds:
+        if cur['seconds'] > base['seconds'] * (1 + time_tolerance):
+          regressions.append((sketch, step, 'time %.3f s -> %.3f s (%+.0f%%)' % (
+            base['seconds'], cur['seconds'],
+            (cur['seconds'] / max(base['seconds'], 1e-9) - 1) * 100)))
+      if base.get('peak_rss_mb') and cur.get('peak_rss_mb'):
+        if cur['peak_rss_mb'] > base['peak_rss_mb'] * (1 + memory_tolerance):
+          regressions.append((sketch, step, 'memory %.1f MB -> %.1f MB (%+.0f%%)' % (
+            base['peak_rss_mb'], cur['peak_rss_mb'],
+            (cur['peak_rss_mb'] / base['peak_rss_mb'] - 1) * 100)))
+  return regressions
+
+
+def compare_files(baseline_file, results_file, time_tolerance, memory_tolerance):
+  """Prints regressions; returns a process exit code."""
+  with open(baseline_file) as inf:
+    baseline = json.load(inf)
+  with open(results_file) as inf:
+    current = json.load(inf)
+  if baseline.get('settings') != current.get('settings'):
+    print 'WARN: Settings differ from the baseline: %s vs %s' % (
+      baseline.get('settings'), current.get('settings'))
+  if baseline.get('platform') != current.get('platform'):
+    print 'WARN: Baseline was recorded on %s' % baseline.get('platform')
+
+  regressions = find_regressions(baseline, current, time_tolerance, memory_tolerance)
+  for (sketch, step, description) in regressions:
+    print 'REGRESSION: %s %s: %s' % (sketch, step, description)
+  if regressions:
+    print '%d regression(s)' % len(regressions)
+    return 1
+  print 'No regressions'
+  return 0
+
+
+def compare_main(args):
+  return compare_files(args.baseline, args.results, args.time_tolerance, args.memory_tolerance)
+
+
+# ----------------------------------------------------------------------
+# Main
+# ----------------------------------------------------------------------
+
+def add_step_settings(parser):
+  parser.add_argument('--max-dist', type=float, default=5.0,
+                      help='Argument to remove_stray_strokes (default: %(default)s)')
+  parser.add_argument('--pos-error-tolerance', type=float, default=0.2,
+                      help='Argument to reduce_control_points (default: %(default)s)')
+  parser.add_argument('--num-colors', type=int, default=32,
+                      help='Argument to simplify_colors (default: %(default)s)')
+
+
+def add_tolerances(parser):
+  parser.add_argument('--time-tolerance', type=float, default=0.15,
+                      help='Allowed fractional slowdown (default: %(default)s)')
+  parser.add_argument('--memory-tolerance', type=float, default=0.15,
+                      help='Allowed fractional growth in peak memory (default: %(default)s)')
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__,
+                                   formatter_class=argparse.RawDescriptionHelpFormatter)
+  subparsers = parser.add_subparsers()
+
+  run = subparsers.add_parser('run', help='Run the benchmarks')
+  run.set_defaults(func=run_main)
+  run.add_argument('sketches', nargs='*',
+                   help='.tilt files or directories (default: Support/Sketches)')
+  run.add_argument('--step', dest='steps', action='append', choices=STEPS,
+                   help='Step to run; may be repeated (default: all)')
+  run.add_argument('--repeat', type=int, default=1,
+                   help='Run each step this many times and keep the fastest (default: %(default)s)')
+  run.add_argument('-o', '--output', default='benchmark_printing.json',
+                   help='Results file (default: %(default)s)')
+  run.add_argument('--baseline', default=None,
+                   help='Compare against this results file when done')
+  add_step_settings(run)
+  add_tolerances(run)
+
+  compare = subparsers.add_parser('compare', help='Compare results against a baseline')
+  compare.set_defaults(func=compare_main)
+  compare.add_argument('baseline', help='Baseline results file')
+  compare.add_argument('results', help='New results file')
+  add_tolerances(compare)
+
+  worker = subparsers.add_parser('_worker')
+  worker.set_defaults(func=worker_main)
+  worker.add_argument('step', choices=STEPS)
+  worker.add_argument('sketch')
+  add_step_settings(worker)
+
+  args = parser.parse_args(argv)
+  return args.func(args)
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
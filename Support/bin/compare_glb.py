@@ -15,21 +15,21 @@
 # limitations under the License.
 
 from __future__ import print_function
+import fnmatch
 import glob
+import hashlib
 import json
+import multiprocessing
 import os
 import re
 import struct
 import sys
+import time
 from subprocess import Popen, PIPE, STDOUT
 
+from tbdata import json_diff
 from tbdata.glb import binfile, BaseGlb, Glb1, Glb2
-
-try:
-  import jsondiff
-except ImportError:
-  print("Try 'pip install jsondiff'", file=sys.stderr)
-  raise
+from tbdata.json_diff import Ignore, Rewrite
 
 DEFAULT_BASELINE_DIR = 'Baseline 22.0'
 ROOT = os.path.expanduser('~/Documents/Tilt Brush/Exports')
@@ -42,28 +42,95 @@ def first_glob(glob_pat):
   raise LookupError("Too many %s: %s" % (glob_pat, maybe))
 
 
+class ExportIndex(object):
+  """Index of the export directories in *root*, built with a single
+  listdir and rebuilt only when root's mtime changes.
+
+  Export directories are named '<tilt_name>' or '<tilt_name> NN'. A sketch
+  whose name itself ends in digits is ambiguous, so directories are indexed
+  under both their full name and their name without the number, just as
+  the old get_latest_glb would have matched them.
+
+  Contents of glb1/ and glb/ directories are cached the same way."""
+  GLB_PATTERN = '*.glb*'
+
+  def __init__(self, root=ROOT):
+    self.root = root
+    self._mtime = None
+    self._exports = {}  # name -> sorted list of (NN, dirname); NN is -1 if none
+    self._glbs = {}     # directory -> (mtime, list of glb files)
+
+  def refresh(self):
+    mtime = os.stat(self.root).st_mtime
+    if mtime == self._mtime:
+      return
+    exports = {}
+    for dirname in os.listdir(self.root):
+      exports.setdefault(dirname, []).append((-1, dirname))
+      m = re.match(r'(.*) (\d+)$', dirname)
+      if m is not None:
+        exports.setdefault(m.group(1), []).append((int(m.group(2)), dirname))
+    for lst in exports.values():
+      lst.sort()
+    self._exports = exports
+    self._mtime = mtime
+
+  def get_exports(self, tilt_name):
+    """Returns a sorted list of (NN, dirname) for exports of <tilt_name>.tilt.
+    NN is -1 for the unnumbered export."""
+    self.refresh()
+    return self._exports.get(tilt_name, [])
+
+  def get_glb(self, directory):
+    """Returns the single glb file in *directory*, or raises LookupError."""
+    try:
+      mtime = os.stat(directory).st_mtime
+    except OSError:
+      mtime = None
+    cached = self._glbs.get(directory)
+    if cached is None or cached[0] != mtime:
+      glbs = []
+      if mtime is not None:
+        glbs = sorted(f for f in os.listdir(directory)
+                      if fnmatch.fnmatch(f, self.GLB_PATTERN) and not f.startswith('.'))
+      self._glbs[directory] = cached = (mtime, glbs)
+    glb_pat = os.path.join(directory, self.GLB_PATTERN)
+    glbs = cached[1]
+    if len(glbs) == 0: raise LookupError("No %s" % glb_pat)
+    if len(glbs) == 1: return os.path.join(directory, glbs[0]).replace('\\', '/')
+    raise LookupError("Too many %s: %s" % (glb_pat, glbs))
+
+  def get_latest_glb(self, tilt_name, poly):
+    exports = self.get_exports(tilt_name)
+    if len(exports) == 0:
+      raise LookupError("No export %s" % tilt_name)
+    directory = 'glb1' if poly else 'glb'
+    return self.get_glb(os.path.join(self.root, exports[-1][1], directory))
+
+
+# Shared by all comparisons in this process; see get_export_index()
+_export_index = None
+
+
+def get_export_index():
+  global _export_index
+  if _export_index is None or _export_index.root != ROOT:
+    _export_index = ExportIndex(ROOT)
+  return _export_index
+
+
+def set_export_index(index):
+  """Pool initializer, so worker processes share the parent's index."""
+  global _export_index
+  _export_index = index
+
+
 def get_latest_glb(tilt_name, poly):
   """Gets the .glb file that was most-recently exported from <name>.tilt
   Pass:
     poly - True for Poly-style glb1, False for glb2 """
   assert type(poly) is bool
-  def get_index(dirname):
-    """Returns the small NN if dirname matches '<tilt_name> NN'"""
-    length = len(tilt_name)
-    prefix, suffix = dirname[:length], dirname[length:]
-    # Careful; if tilt_name = 'ET_All', directories like 'ET_All_Huge 3' will pass this check
-    if prefix != tilt_name: return None
-    if suffix == '': return -1
-    m = re.match(r' (\d+)$', suffix)
-    if m is not None: return int(m.group(1))
-    return None
-
-  matches = [d for d in os.listdir(ROOT) if get_index(d) is not None]
-  matches.sort(key=get_index)
-  if len(matches) == 0:
-    raise LookupError("No export %s" % tilt_name)
-  directory = 'glb1' if poly else 'glb'
-  return first_glob(os.path.join(os.path.join(ROOT, matches[-1]), directory, '*.glb*'))
+  return get_export_index().get_latest_glb(tilt_name, poly)
 
 
 def get_baseline_glb(name, baseline_dir_name, poly=True):
@@ -74,8 +141,8 @@ def get_baseline_glb(name, baseline_dir_name, poly=True):
   assert type(poly) is bool
   name_no_digit = re.sub(r' \d+$', '', os.path.basename(name))
   directory = 'glb1' if poly else 'glb'
-  parent = os.path.join(ROOT, baseline_dir_name, name_no_digit, directory)
-  return first_glob(parent + '/*.glb*')
+  return get_export_index().get_glb(
+    os.path.join(ROOT, baseline_dir_name, name_no_digit, directory))
 
 
 def redact(dct, keys):
@@ -99,28 +166,6 @@ def tweak_fix_sampler(dcts):
         texture['sampler'] = rename(texture['sampler'])
 
 
-def tweak_ignore_nondeterministic_geometry(dcts):
-  for label, dct in enumerate(dcts):
-    # Geometry is nondeterministic, so ignore min/max values
-    for accessor in dct.get('accessors', {}).values():
-      redact(accessor, ['min', 'max'])
-
-
-def tweak_ignore_envlight(dcts):
-  for label, dct in enumerate(dcts):
-    # The exported light color is slightly nondeterminstic
-    # and also I changed the environment in one of the .tilt files and don't
-    # want to bother re-exporting it
-    for name, node in items(dct.get('nodes', {})):
-      if type(name) is int:
-        name = node['name']
-      if 'SceneLight' in name:
-        redact(node, 'matrix')
-    for mat in values(dct.get('materials', {})):
-      redact(mat.get('values', {}),
-             ['SceneLight_0_color', 'SceneLight_1_color', 'ambient_light_color'])
-
-
 def tweak_remove_vertexid(dcts):
   removed = []     # nodes that were deleted; may contain Nones
   for label, dct in enumerate(dcts):
@@ -141,41 +186,31 @@ def tweak_remove_vertexid(dcts):
       redact(dct['buffers']['binary_glTF'], 'byteLength')
 
 
-def tweak_remove_color_minmax(dcts):
-  # It's ok if the newer glb doesn't have min/max on color. I intentionally removed it.
-  for dct in dcts:
-    for name, acc in dct['accessors'].items():
-      if 'color' in name:
-        acc.pop('min', None)
-        acc.pop('max', None)
+# Rules for json_diff. These replace tweak_ functions that edited both
+# dicts; which=1 is the baseline.
 
+# Geometry is nondeterministic, so ignore min/max values
+RULES_IGNORE_NONDETERMINISTIC_GEOMETRY = [
+  Ignore('accessors/*/min'), Ignore('accessors/*/max')]
 
-def items(dct_or_lst):
-  """Returns list items, or dictionary items"""
-  if type(dct_or_lst) is dict:
-    return dct_or_lst.items()
-  else:
-    return list(enumerate(dct_or_lst))
+# It's ok if the newer glb doesn't have min/max on color. I intentionally removed it.
+RULES_REMOVE_COLOR_MINMAX = [
+  Ignore('accessors/*color*/min'), Ignore('accessors/*color*/max')]
 
+# The exported light color is slightly nondeterminstic
+# and also I changed the environment in one of the .tilt files and don't
+# want to bother re-exporting it
+RULES_IGNORE_ENVLIGHT = [
+  Ignore('nodes/*SceneLight*/matrix'),
+  Ignore('materials/*/values/SceneLight_[01]_color'),
+  Ignore('materials/*/values/ambient_light_color')]
 
-def values(dct_or_lst):
-  """Returns list values, or dictionary values"""
-  if type(dct_or_lst) is dict:
-    return dct_or_lst.values()
-  else:
-    return list(dct_or_lst)
+# I renamed reference image uris from "refimageN_" -> "media_"; change the baseline to suit
+RULES_RENAME_REFIMAGE = [Rewrite('images/*/uri', r'^refimage[0-9]*', 'media', which=1)]
 
+RULES_IGNORE_GENERATOR = [Ignore('asset/generator')]
 
-def tweak_rename_refimage(dcts):
-  # I renamed reference image uris from "refimageN_" -> "media_"; change the baseline to suit
-  for name, image in items(dcts[1]['images']):
-    if 'uri' in image:
-      image['uri'] = re.sub(r'^refimage[0-9]*', 'media', image['uri'])
-
-
-def tweak_ignore_generator(dcts):
-  for dct in dcts:
-    redact(dct['asset'], 'generator')
+DEFAULT_RULES = RULES_IGNORE_GENERATOR + RULES_RENAME_REFIMAGE + RULES_IGNORE_ENVLIGHT
 
 
 def binary_diff(bina, binb):
@@ -185,68 +220,407 @@ def binary_diff(bina, binb):
   return bin_same, '' if bin_same else '\nBINARY DIFFERENCE'
 
 
+# Default tolerances for accessor_diff. A float passes if it is within
+# either tolerance of the baseline.
+DEFAULT_ABS_TOLERANCE = 1e-6
+DEFAULT_ULP_TOLERANCE = 4
+
+
+def iter_primitive_accessors(glb):
+  """Yields (mesh_name, primitive_index, {attribute: accessor}) for every
+  primitive. The indices accessor, if any, is under 'indices'.
+  gltf2 mesh names needn't be unique, so later meshes with the same name
+  are named eg 'name#2'."""
+  occurrences = {}
+  for key, mesh in glb.iter_objs('mesh'):
+    if glb.version == 1:
+      mesh_name = key
+    else:
+      mesh_name = mesh.get('name', str(key))
+      occurrences[mesh_name] = occurrences.get(mesh_name, 0) + 1
+      if occurrences[mesh_name] > 1:
+        mesh_name = '%s#%d' % (mesh_name, occurrences[mesh_name])
+    for i, prim in enumerate(mesh['primitives']):
+      refs = dict(prim['attributes'])
+      if 'indices' in prim:
+        refs['indices'] = prim['indices']
+      yield mesh_name, i, dict((attr, glb.json['accessors'][ref])
+                               for (attr, ref) in refs.items())
+
+
+def float_ulps(a, b):
+  """Returns the distance in float32 ulps between a and b, elementwise."""
+  import numpy
+  def ordered(x):
+    # Map float32 bit patterns to integers that sort the same way as the floats
+    i = numpy.ascontiguousarray(x, dtype=numpy.float32).view(numpy.int32).astype(numpy.int64)
+    return numpy.where(i < 0, -0x80000000 - i, i)
+  return numpy.abs(ordered(a) - ordered(b))
+
+
+def numeric_error(a, b):
+  """Returns (abs_error, ulp_error) arrays for the elements of a and b.
+  NaNs compare equal to NaNs, and infinitely far from anything else."""
+  import numpy
+  a64, b64 = a.astype(numpy.float64), b.astype(numpy.float64)
+  with numpy.errstate(invalid='ignore'):
+    abs_error = numpy.abs(a64 - b64)
+  if a.dtype.kind == 'f':
+    ulp_error = float_ulps(a, b).astype(numpy.float64)
+  else:
+    ulp_error = abs_error.copy()
+  a_nan, b_nan = numpy.isnan(a64), numpy.isnan(b64)
+  for err in (abs_error, ulp_error):
+    err[a_nan & b_nan] = 0
+    err[a_nan != b_nan] = numpy.inf
+  return abs_error, ulp_error
+
+
+def get_triangle_order(indices, positions):
+  """Returns indices, reshaped to (n, 3), in a canonical order that doesn't
+  depend on how the exporter happened to order the triangles.
+  Each triangle is rotated (preserving winding) to start at its
+  lexicographically-smallest position, then triangles are sorted by position.
+  Positions that differ by float noise may still sort differently."""
+  import numpy
+  tris = numpy.asarray(indices, dtype=numpy.int64)
+  tris = tris[:len(tris) // 3 * 3].reshape(-1, 3)
+  corners = positions[tris].reshape(-1, positions.shape[1])
+  rank = numpy.empty(len(corners), dtype=numpy.int64)
+  rank[numpy.lexsort(corners.T[::-1])] = numpy.arange(len(corners))
+  first = numpy.argmin(rank.reshape(-1, 3), axis=1)
+  tris = tris[numpy.arange(len(tris))[:, numpy.newaxis],
+              (first[:, numpy.newaxis] + numpy.arange(3)) % 3]
+  keys = positions[tris].reshape(len(tris), -1)
+  return tris[numpy.lexsort(keys.T[::-1])]
+
+
+def accessor_diff(glbs, abs_tolerance=DEFAULT_ABS_TOLERANCE,
+                  ulp_tolerance=DEFAULT_ULP_TOLERANCE, ignore_order=False):
+  """Compares the accessor data of two glbs of the same version, matching
+  meshes by name. Floats pass if they are within abs_tolerance or
+  ulp_tolerance ulps; other components must be within abs_tolerance.
+  Accessor min/max are checked the same way.
+  If ignore_order, triangles are compared as an unordered set (see
+  get_triangle_order) and index values themselves are not compared.
+  Returns (success, details, bounds_checked); details has one line per mesh
+  and attribute that is not bit-identical, with its max error.
+  bounds_checked is True if min/max of every accessor in both glbs were
+  compared; accessors no primitive uses are not."""
+  import numpy
+  problems = []
+  prims = [{}, {}]
+  for (glb, prim, side) in zip(glbs, prims, ('new', 'baseline')):
+    for (mesh, i, accs) in iter_primitive_accessors(glb):
+      if (mesh, i) in prim:
+        problems.append('%s[%d]: more than one primitive with this name in %s' % (
+          mesh, i, side))
+      else:
+        prim[(mesh, i)] = accs
+  lines = []
+  num_identical = 0
+  checked = set()  # ids of accessors whose min/max were compared
+  for key in sorted(set(prims[0]) | set(prims[1])):
+    label = '%s[%d]' % key
+    if key not in prims[0] or key not in prims[1]:
+      problems.append('%s: only in %s' % (label, 'new' if key in prims[0] else 'baseline'))
+      continue
+    accs = [prims[0][key], prims[1][key]]
+    for attr in sorted(set(accs[0]) - set(accs[1])):
+      problems.append('%s %s: only in new' % (label, attr))
+    for attr in sorted(set(accs[1]) - set(accs[0])):
+      problems.append('%s %s: only in baseline' % (label, attr))
+    attrs = sorted(set(accs[0]) & set(accs[1]))
+    arrays = [dict((attr, glb.get_accessor_array(acc[attr])) for attr in attrs)
+              for (glb, acc) in zip(glbs, accs)]
+
+    if ignore_order and 'indices' in attrs and 'POSITION' in attrs:
+      orders = [get_triangle_order(arr['indices'], arr['POSITION']) for arr in arrays]
+      if orders[0].shape != orders[1].shape:
+        problems.append('%s: %d vs %d triangles' % (label, len(orders[0]), len(orders[1])))
+        continue
+      for arr, order in zip(arrays, orders):
+        for attr in attrs:
+          if attr != 'indices':
+            arr[attr] = arr[attr][order]
+      attrs.remove('indices')
+
+    for attr in attrs:
+      a, b = arrays[0][attr], arrays[1][attr]
+      if a.shape != b.shape:
+        problems.append('%s %s: shape %s vs %s' % (label, attr, a.shape, b.shape))
+        continue
+      if a.dtype != b.dtype:
+        problems.append('%s %s: type %s vs %s' % (label, attr, a.dtype, b.dtype))
+        continue
+      abs_error, ulp_error = numeric_error(a, b)
+      if all((bound in accs[0][attr]) == (bound in accs[1][attr])
+             for bound in ('min', 'max')):
+        checked.update([id(accs[0][attr]), id(accs[1][attr])])
+      for bound in ('min', 'max'):
+        if bound in accs[0][attr] and bound in accs[1][attr]:
+          bounds = [numpy.array(acc[attr][bound], dtype=a.dtype) for acc in accs]
+          if bounds[0].shape == bounds[1].shape:
+            errors = numeric_error(bounds[0], bounds[1])
+            abs_error = numpy.concatenate([abs_error.ravel(), errors[0].ravel()])
+            ulp_error = numpy.concatenate([ulp_error.ravel(), errors[1].ravel()])
+          else:
+            problems.append('%s %s: %s has %d vs %d values' % (
+              label, attr, bound, bounds[0].size, bounds[1].size))
+      if abs_error.size == 0 or abs_error.max() == 0:
+        num_identical += 1
+        continue
+      if a.dtype.kind == 'f':
+        ok = numpy.all((abs_error <= abs_tolerance) | (ulp_error <= ulp_tolerance))
+      else:
+        ok = numpy.all(abs_error <= abs_tolerance)
+      lines.append('%-4s %s %s: max error %g%s' % (
+        'ok' if ok else 'FAIL', label, attr, abs_error.max(),
+        ' (%g ulps)' % ulp_error.max() if a.dtype.kind == 'f' else ''))
+      if not ok:
+        problems.append('%s %s: out of tolerance' % (label, attr))
+
+  bounds_checked = all(id(acc) in checked
+                       for glb in glbs for (_, acc) in glb.iter_objs('accessor'))
+  success = len(problems) == 0
+  details = ['%d attributes identical' % num_identical] + lines
+  details += [p for p in problems if not p.endswith('out of tolerance')]
+  return success, '\nACCESSOR %s\n  %s' % ('ok' if success else 'DIFFERENCE',
+                                           '\n  '.join(details)), bounds_checked
+
+
+def file_digest(filename, chunk_size=1<<20):
+  """Returns the sha1 of a file, reading it in chunks."""
+  h = hashlib.sha1()
+  with open(filename, 'rb') as inf:
+    while True:
+      chunk = inf.read(chunk_size)
+      if not chunk:
+        return h.hexdigest()
+      h.update(chunk)
+
+
+def files_identical(a, b):
+  if os.path.getsize(a) != os.path.getsize(b):
+    return False
+  return file_digest(a) == file_digest(b)
+
+
 def compare_glb(a, b, binary,
                 tweaks=(
                         #tweak_fix_sampler,
                         #tweak_remove_vertexid,
-                        #tweak_ignore_nondeterministic_geometry,
-                        #tweak_remove_color_minmax,
-                        tweak_ignore_generator,
-                        tweak_rename_refimage,
-                        tweak_ignore_envlight,
-                )):
-  if open(a).read() == open(b).read():
+                ),
+                rules=DEFAULT_RULES,
+                numeric=True, abs_tolerance=DEFAULT_ABS_TOLERANCE,
+                ulp_tolerance=DEFAULT_ULP_TOLERANCE, ignore_order=False,
+                max_differences=100):
+  """Pass:
+    binary - also compare the binary chunks
+    tweaks - functions that edit both json dicts before comparing
+    rules - tbdata.json_diff rules, eg RULES_REMOVE_COLOR_MINMAX
+    numeric - if the binary chunks differ, compare them accessor by
+      accessor, with the given tolerances; see accessor_diff.
+      Otherwise, any difference is a failure. Accessor min/max are only
+      compared with tolerance if accessor_diff checked all of them;
+      otherwise they must match exactly.
+    max_differences - only report this many json differences"""
+  if files_identical(a, b):
     return (True, 'IDENTICAL')
 
   glbs = map(BaseGlb.create, [a, b])
   objs = [json.loads(g.get_json()) for g in glbs]
-  for tweak in tweaks: tweak(objs)
-  details = jsondiff.diff(objs[0], objs[1], syntax='symmetric',
-                          dump=True,
-                          dumper=jsondiff.JsonDumper(indent=2))
   if binary:
     bin_same, bin_details = binary_diff(glbs[0].bin_chunk, glbs[1].bin_chunk)
+    if not bin_same and numeric:
+      bin_same, bin_details, bounds_checked = accessor_diff(
+        glbs, abs_tolerance, ulp_tolerance, ignore_order)
+      if bounds_checked:
+        # accessor_diff checked min/max with tolerance instead
+        rules = list(rules) + RULES_IGNORE_NONDETERMINISTIC_GEOMETRY
   else:
     bin_same, bin_details = True, 'n/a'
-  return details=='{}' and bin_same, details + bin_details
+  for tweak in tweaks: tweak(objs)
+  lines = []
+  num_differences = 0
+  for difference in json_diff.diff(objs[0], objs[1], rules):
+    num_differences += 1
+    if num_differences <= max_differences:
+      lines.append(json_diff.format_difference(difference))
+  if num_differences > max_differences:
+    lines.append('... and %d more' % (num_differences - max_differences))
+  details = ''
+  if num_differences > 0:
+    details = '\nJSON DIFFERENCE (%d)\n  %s' % (num_differences, '\n  '.join(lines))
+  return num_differences == 0 and bin_same, details + bin_details
 
 
 def compare_to_baseline(name, binary=True, poly=True, baseline_dir_name=DEFAULT_BASELINE_DIR):
   """Compare the Poly .glb file to its baseline and report differences"""
+  result = run_comparison((name, poly, {'binary': binary}, baseline_dir_name))
+  print(format_result(result))
+  return result
+
+
+def run_comparison(job):
+  """Compares one export to its baseline. Never raises.
+  Pass:
+    job - (name, poly, compare_glb_kwargs, baseline_dir_name)
+  Returns a dict with keys export (the passed name), name (of the export
+  directory), version, latest, baseline, status ('ok', 'fail', 'missing',
+  or 'error'), details, and seconds."""
+  name, poly, options, baseline_dir_name = job
+  result = {'export': name, 'name': name, 'version': 1 if poly else 2,
+            'latest': None, 'baseline': None, 'details': ''}
+  start = time.time()
   try:
     latest = get_latest_glb(name, poly=poly)
+    result['latest'] = latest
+    result['name'] = os.path.basename(os.path.dirname(os.path.dirname(latest)))
   except LookupError:
-    print("%s: Not found" % name)
-    return
-  baseline = get_baseline_glb(name, baseline_dir_name, poly=poly)
-  result, details = compare_glb(latest, baseline, binary)
-  short = os.path.basename(os.path.dirname(os.path.dirname(latest)))
-  summary = ('ok' if result else ('FAIL: %s' % (details, )))
-  print("%s ver %d: %s" % (short, 1 if poly else 2, summary))
+    result['status'] = 'missing'
+    result['details'] = 'Not found'
+  else:
+    try:
+      baseline = get_baseline_glb(name, baseline_dir_name, poly=poly)
+      result['baseline'] = baseline
+      same, details = compare_glb(latest, baseline, **options)
+    except Exception as e:
+      result['status'] = 'error'
+      result['details'] = '%s: %s' % (type(e).__name__, e)
+    else:
+      result['status'] = 'ok' if same else 'fail'
+      result['details'] = details
+  result['seconds'] = time.time() - start
+  return result
+
+
+def format_result(result):
+  if result['status'] == 'missing':
+    return "%s: Not found" % result['name']
+  elif result['status'] == 'ok':
+    summary = 'ok'
+  elif result['status'] == 'fail':
+    summary = 'FAIL: %s' % (result['details'], )
+  else:
+    summary = 'ERROR: %s' % (result['details'], )
+  return "%s ver %d: %s" % (result['name'], result['version'], summary)
+
+
+def run_regressions(names, binary=True, baseline_dir_name=DEFAULT_BASELINE_DIR, jobs=None,
+                    **options):
+  """Compares glb1 and glb2 exports of each name to their baselines, using
+  *jobs* processes (default: one per cpu). Results are printed as they
+  finish. Other keyword arguments are passed to compare_glb().
+  Returns the list of results from run_comparison(), in order."""
+  options['binary'] = binary
+  work = [(name, poly, options, baseline_dir_name)
+          for name in names for poly in (True, False)]
+  jobs = min(jobs or multiprocessing.cpu_count(), len(work))
+  if jobs <= 1:
+    results = []
+    for job in work:
+      results.append(run_comparison(job))
+      print(format_result(results[-1]))
+    return results
+
+  # The diffs are pure Python, so use processes rather than threads
+  # Index the exports once, up front, and hand the index to the workers
+  index = get_export_index()
+  index.refresh()
+  pool = multiprocessing.Pool(jobs, set_export_index, (index,))
+  try:
+    results = []
+    for result in pool.imap_unordered(run_comparison, work):
+      print(format_result(result))
+      results.append(result)
+  finally:
+    pool.terminate()
+  order = dict((job[:2], i) for (i, job) in enumerate(work))
+  return sorted(results, key=lambda r: order[(r['export'], r['version'] == 1)])
+
+
+def write_json_report(results, filename):
+  with open(filename, 'w') as outf:
+    json.dump({'created': time.time(), 'results': results}, outf, indent=2, sort_keys=True)
+
+
+def write_junit_report(results, filename):
+  """Writes results in the JUnit xml format understood by most CI systems."""
+  import xml.etree.ElementTree as ET
+  def count(status): return str(sum(1 for r in results if r['status'] == status))
+  suite = ET.Element('testsuite', name='compare_glb', tests=str(len(results)),
+                     failures=count('fail'), errors=count('error'), skipped=count('missing'),
+                     time='%.3f' % sum(r['seconds'] for r in results))
+  for r in results:
+    case = ET.SubElement(suite, 'testcase', classname='compare_glb.glb%d' % r['version'],
+                         name=r['name'], time='%.3f' % r['seconds'])
+    if r['status'] == 'fail':
+      ET.SubElement(case, 'failure', message='Differs from baseline').text = r['details']
+    elif r['status'] == 'error':
+      ET.SubElement(case, 'error', message=r['details'].splitlines()[0])
+    elif r['status'] == 'missing':
+      ET.SubElement(case, 'skipped', message=r['details'])
+  ET.ElementTree(suite).write(filename, encoding='utf-8')
 
 
 def compare_two(name1, name2, binary=True):
   def get_glb_named(name):
-    return first_glob(os.path.join(ROOT, name, 'glb1', '*.glb*'))
+    return get_export_index().get_glb(os.path.join(ROOT, name, 'glb1'))
   result, details = compare_glb(get_glb_named(name1), get_glb_named(name2), binary)
   summary = ('ok' if result else ('FAIL: %s' % (details, )))
   print(summary)
 
 # -----
 
+def get_baseline_names(baseline_dir_name=DEFAULT_BASELINE_DIR):
+  return sorted(os.path.basename(dirname) for dirname in
+                glob.glob(os.path.join(ROOT, baseline_dir_name, 'ET_All*')))
+
+
 def test():
-  for dirname in glob.glob(os.path.join(ROOT, DEFAULT_BASELINE_DIR, 'ET_All*')):
-    compare_to_baseline(os.path.basename(dirname), poly=True)
-    compare_to_baseline(os.path.basename(dirname), poly=False)
+  run_regressions(get_baseline_names(), jobs=1)
 
 
 def main():
   import argparse
   parser = argparse.ArgumentParser()
-  parser.add_argument('exports', nargs='*', help='Names of tilt exports to check')
+  parser.add_argument('exports', nargs='*',
+                      help='Names of tilt exports to check (default: ET_All* in the baseline)')
+  parser.add_argument('--baseline-dir', default=DEFAULT_BASELINE_DIR,
+                      help='Name of the baseline directory in %s (default: %%(default)s)' % ROOT)
+  parser.add_argument('-j', '--jobs', type=int, default=None,
+                      help='Number of comparisons to run at once (default: number of cpus)')
+  parser.add_argument('--no-binary', dest='binary', action='store_false',
+                      help="Don't compare the binary chunks")
+  parser.add_argument('--exact', dest='numeric', action='store_false',
+                      help="Fail on any binary difference, instead of comparing accessors")
+  parser.add_argument('--abs-tolerance', type=float, default=DEFAULT_ABS_TOLERANCE,
+                      help='Allowed absolute error in accessor data (default: %(default)s)')
+  parser.add_argument('--ulp-tolerance', type=float, default=DEFAULT_ULP_TOLERANCE,
+                      help='Allowed error in float accessor data, in ulps (default: %(default)s)')
+  parser.add_argument('--ignore-order', action='store_true',
+                      help='Compare triangles without regard to their order')
+  parser.add_argument('--json', metavar='FILE', help='Write a json report')
+  parser.add_argument('--junit', metavar='FILE', help='Write a JUnit xml report')
   args = parser.parse_args()
-  for arg in args.exports:
-    compare_to_baseline(arg)
+
+  start = time.time()
+  results = run_regressions(args.exports or get_baseline_names(args.baseline_dir),
+                            binary=args.binary, baseline_dir_name=args.baseline_dir,
+                            jobs=args.jobs, numeric=args.numeric,
+                            abs_tolerance=args.abs_tolerance,
+                            ulp_tolerance=args.ulp_tolerance,
+                            ignore_order=args.ignore_order)
+  if args.json:
+    write_json_report(results, args.json)
+  if args.junit:
+    write_junit_report(results, args.junit)
+  failed = [r for r in results if r['status'] in ('fail', 'error')]
+  print("%d compared, %d failed, %d not found in %.1fs" % (
+    len(results), len(failed), sum(1 for r in results if r['status'] == 'missing'),
+    time.time() - start))
+  return 1 if failed else 0
 
 if __name__ == '__main__':
-  test()
+  sys.exit(main())
@@ -19,14 +19,25 @@
 Not intended for production use.
 
 This was written to help scope out the work required to convert
-Tilt Brush gltf1 to gltf2."""
+Tilt Brush gltf1 to gltf2.
+
+.gltf files are converted to .2.gltf. .glb (version 1) files are converted
+to .2.glb; the binary chunk is re-packed, and copied through a piece at a
+time so large exports convert in bounded memory. Directories are searched
+for .glb files, which are converted in parallel."""
 
 from __future__ import print_function
 
 import collections
+import contextlib
+import functools
+import gc
 import json
+import multiprocessing
 import os
 import re
+import struct
+import sys
 
 # (Brush guid, gltf alphaMode)
 PBR_BRUSH_DESCRIPTORS = [
@@ -39,7 +50,7 @@ def convert_to_array_helper(dct, name_to_index, key):
     return
   by_name = dct[key]
   by_index = []
-  for name, value in by_name.items():
+  for name, value in by_name.iteritems():
     assert name not in name_to_index, "Name %s already added as %s" % (name, name_to_index[name])
 
     if 'name' in value:
@@ -52,21 +63,121 @@ def convert_to_array_helper(dct, name_to_index, key):
   dct[key] = by_index
 
 
-def convert_to_index(container, key, name_to_index, required_object_type):
-  name = container[key]
-  try:
-    index, object_type = name_to_index[name]
-  except KeyError:
-    raise LookupError("No %s named %s" % (required_object_type, name))
-  assert object_type == required_object_type
-  container[key] = index
+# Every gltf1 property that refers to another object by name, as
+# (collection, path to the property within each object, collection referred to).
+# '' is the top-level object; '*' is every member of a dict or list.
+# These are the properties as they are just before resolve_references(),
+# so some of them are gltf2 properties (eg node.mesh, image.bufferView).
+GLTF1_REFERENCES = [
+  ('', ('scene',), 'scenes'),
+  ('accessors', ('bufferView',), 'bufferViews'),
+  ('bufferViews', ('buffer',), 'buffers'),
+  ('images', ('bufferView',), 'bufferViews'),
+  ('materials', ('pbrMetallicRoughness', 'baseColorTexture', 'index'), 'textures'),
+  ('meshes', ('primitives', '*', 'attributes', '*'), 'accessors'),
+  ('meshes', ('primitives', '*', 'indices'), 'accessors'),
+  ('meshes', ('primitives', '*', 'material'), 'materials'),
+  ('nodes', ('camera',), 'cameras'),
+  ('nodes', ('mesh',), 'meshes'),
+  ('nodes', ('children', '*'), 'nodes'),
+  ('scenes', ('nodes', '*'), 'nodes'),
+  ('textures', ('sampler',), 'samplers'),
+  ('textures', ('source',), 'images'),
+]
 
 
-def convert_to_indices(dct, key, name_to_index, required_object_type):
-  lst = dct[key]
-  assert type(lst) is list
-  for i in range(len(lst)):
-    convert_to_index(lst, i, name_to_index, required_object_type)
+def compile_references(references):
+  """Turns a list like GLTF1_REFERENCES into a table of
+  {collection: trie}, where each trie maps a property name (or '*') to
+  either another trie or the name of the collection referred to."""
+  table = collections.OrderedDict()
+  for (collection, path, target) in references:
+    trie = table.setdefault(collection, {})
+    for prop in path[:-1]:
+      trie = trie.setdefault(prop, {})
+    assert path[-1] not in trie, "Duplicate reference %s %s" % (collection, path)
+    trie[path[-1]] = target
+  return table
+
+
+GLTF1_REFERENCE_TABLE = compile_references(GLTF1_REFERENCES)
+
+
+def resolve_references(gltf, name_to_index, table=GLTF1_REFERENCE_TABLE):
+  """Replaces every by-name reference in *table* with an index, in a single
+  pass that only visits the properties that can hold references.
+  Returns a list of problems (eg dangling references), which is empty if
+  everything resolved."""
+  problems = []
+
+  def resolve(container, key, target, where):
+    # where is (collection, index) or (), and only formatted if there's a problem
+    name = container[key]
+    try:
+      index, object_type = name_to_index[name]
+    except (KeyError, TypeError):
+      problems.append("%s%s: No %s named %s" % (
+        '%s[%d].' % where if where else '', key, target, name))
+      return
+    if object_type != target:
+      problems.append("%s%s: %s is in %s, not %s" % (
+        '%s[%d].' % where if where else '', key, name, object_type, target))
+      return
+    container[key] = index
+
+  def walk(obj, trie, where):
+    for prop, sub in trie.iteritems():
+      if prop == '*':
+        keys = obj.keys() if isinstance(obj, dict) else xrange(len(obj))
+        if type(sub) is dict:
+          for key in keys:
+            walk(obj[key], sub, where)
+        else:
+          for key in keys:
+            resolve(obj, key, sub, where)
+      elif prop in obj:
+        if type(sub) is dict:
+          walk(obj[prop], sub, where)
+        else:
+          resolve(obj, prop, sub, where)
+
+  for collection, trie in table.iteritems():
+    if collection == '':
+      walk(gltf, trie, ())
+      continue
+    for i, obj in enumerate(gltf.get(collection, [])):
+      walk(obj, trie, (collection, i))
+  return problems
+
+
+def find_unresolved_names(gltf, names):
+  """Returns a problem for every string (other than a 'name') that is still
+  the name of an object; ie, a reference missing from GLTF1_REFERENCES.
+  This walks the whole tree, so it only runs with --check.
+  Lists of numbers are skipped, which is most of the data."""
+  problems = []
+  path = []
+
+  def check(value):
+    t = type(value)
+    if t is collections.OrderedDict or t is dict:
+      for (k, v) in value.iteritems():
+        if k != 'name':
+          path.append('.' + k)
+          check(v)
+          path.pop()
+    elif t is list:
+      if len(value) > 0 and type(value[0]) in (int, long, float):
+        return
+      for i, elt in enumerate(value):
+        path.append('[%d]' % i)
+        check(elt)
+        path.pop()
+    elif (t is unicode or t is str) and value in names:
+      problems.append("%s: %s was not converted to an index" % (''.join(path)[1:], value))
+
+  check(gltf)
+  return problems
 
 
 COMPONENT_SIZES = {
@@ -119,11 +230,33 @@ def pop_non_gltf2_property(thing, property_name, gltf1_default):
     value, thing['name'], property_name)
 
 
-def convert(filename):
+@contextlib.contextmanager
+def gc_disabled():
+  """Parsing a large gltf creates millions of containers, which makes the
+  cyclic garbage collector run over and over. Nothing here creates cycles."""
+  was_enabled = gc.isenabled()
+  gc.disable()
+  try:
+    yield
+  finally:
+    if was_enabled:
+      gc.enable()
+
+
+def convert(filename, check=False):
+  """Converts a .gltf file; returns gltf2 json text."""
   txt = open(filename).read()
   txt = re.sub('// [^\"\n]*\n', '\n', txt)
 
-  gltf = json.loads(txt, object_pairs_hook=collections.OrderedDict)
+  with gc_disabled():
+    gltf = json.loads(txt, object_pairs_hook=collections.OrderedDict)
+    return json.dumps(convert_json(gltf, check), indent=2)
+
+
+def convert_json(gltf, check=False):
+  """Converts parsed gltf1 json to gltf2, in place. Returns gltf.
+  If check, also look for references that GLTF1_REFERENCES doesn't know
+  about; see find_unresolved_names."""
   name_to_index = {}
 
   # Store the vertex shader URI for convenient access; it'll be removed again later down
@@ -151,9 +284,6 @@ def convert(filename):
 
   gltf['asset']['version'] = '2.0'
 
-  if 'scene' in gltf:
-    convert_to_index(gltf, 'scene', name_to_index, 'scenes')
-
   if 'extensionsUsed' in gltf:
     lst = gltf['extensionsUsed']
     # This extension is obsolete
@@ -161,10 +291,13 @@ def convert(filename):
     if len(lst) == 0:
       del gltf['extensionsUsed']
 
+  # References are still by name until resolve_references(), below
   for accessor in gltf['accessors']:
-    convert_to_index(accessor, 'bufferView', name_to_index, 'bufferViews')
     # Move byteStride from accessor to bufferView.
-    buffer_view = gltf['bufferViews'][accessor['bufferView']]
+    try:
+      buffer_view = gltf['bufferViews'][name_to_index[accessor['bufferView']][0]]
+    except KeyError:
+      continue  # resolve_references() will complain
     byte_stride = pop_explicit_byte_stride(accessor)
     assert buffer_view.get('byteStride', byte_stride) == byte_stride, \
       "byteStride conflict: %s vs %s" % (buffer_view.get('byteStride'), byte_stride)
@@ -174,9 +307,6 @@ def convert(filename):
   for thing in gltf['buffers']:
     pop_non_gltf2_property(thing, 'type', 'arraybuffer')
 
-  for thing in gltf['bufferViews']:
-    convert_to_index(thing, 'buffer', name_to_index, 'buffers')
-
   for material in gltf['materials']:
     material.pop('technique', None)
     vertex_shader_uri = material.pop('_vs_uri', '')
@@ -197,16 +327,10 @@ def convert(filename):
         'metallicFactor': values['MetallicFactor'],
         'roughnessFactor': values['RoughnessFactor']
       }
-      convert_to_index(material['pbrMetallicRoughness']['baseColorTexture'], 'index',
-                       name_to_index, 'textures')
 
   for mesh in gltf['meshes']:
     for primitive in mesh.get('primitives', []):
       attributes = primitive.get('attributes', {})
-      for semantic, accessor in attributes.items():
-        convert_to_index(attributes, semantic, name_to_index, 'accessors')
-      convert_to_index(primitive, 'indices', name_to_index, 'accessors')
-      convert_to_index(primitive, 'material', name_to_index, 'materials')
       # COLOR is not a valid semantic; COLOR_0 is
       if 'COLOR' in attributes:
         assert 'COLOR_0' not in attributes
@@ -225,45 +349,224 @@ def convert(filename):
     else:
       assert False, "Unsupported: convert node with multiple meshes"
 
-    if 'mesh' in node:
-      convert_to_index(node, 'mesh', name_to_index, 'meshes')
-    if 'children' in node:
-      convert_to_indices(node, 'children', name_to_index, 'nodes')
-
-  for scene in gltf['scenes']:
-    convert_to_indices(scene, 'nodes', name_to_index, 'nodes')
-
-  for texture in gltf['textures']:
+  for texture in gltf.get('textures', []):
     pop_non_gltf2_property(texture, 'format', 6408)
     pop_non_gltf2_property(texture, 'internalFormat', 6408)
     pop_non_gltf2_property(texture, 'target', 3553)
     pop_non_gltf2_property(texture, 'type', 5121)
-    convert_to_index(texture, 'sampler', name_to_index, 'samplers')
-    convert_to_index(texture, 'source', name_to_index, 'images')
 
-  check_for_forbidden_values(gltf, set(name_to_index.keys()))
+  for image in gltf.get('images', []):
+    # Images embedded in a glb1 use KHR_binary_glTF; gltf2 has bufferView built in
+    extensions = image.get('extensions', {})
+    binary = extensions.pop('KHR_binary_glTF', None)
+    if binary is not None:
+      image.pop('uri', None)
+      image['bufferView'] = binary['bufferView']
+      image['mimeType'] = binary['mimeType']
+    if 'extensions' in image and len(extensions) == 0:
+      del image['extensions']
 
-  return json.dumps(gltf, indent=2)
+  problems = resolve_references(gltf, name_to_index)
+  if check and not problems:
+    problems = find_unresolved_names(gltf, name_to_index)
+  if problems:
+    raise LookupError('\n'.join(problems))
 
+  return gltf
 
-def check_for_forbidden_values(value, forbidden, primitives=set([int, long, float, str, unicode])):
-  """Recursively check that value does not contain any values in forbidden."""
-  if type(value) in (dict, collections.OrderedDict):
-    for (k, v) in value.iteritems():
-      # It's okay for the name to be in the forbidden list
-      if k != 'name':
-        check_for_forbidden_values(v, forbidden)
-  elif type(value) is list:
-    if len(value) > 0 and type(value[0]) in (int, float, long):
-      # Don't bother
-      return
-    for elt in value:
-      check_for_forbidden_values(elt, forbidden)
-  elif type(value) in primitives:
-    if value in forbidden:
-      print('Found forbidden %s' % (value,), file=sys.stderr)
-  else:
-    assert False, "Cannot handle type %s" % (type(value), )
+
+# ----------------------------------------------------------------------
+# glb
+# ----------------------------------------------------------------------
+
+GLB1_HEADER = struct.Struct('<4s4I')  # magic, version, length, contentLength, contentFormat
+GLB2_HEADER = struct.Struct('<4s2I')  # magic, version, length
+GLB2_CHUNK_HEADER = struct.Struct('<I4s')  # chunkLength, chunkType
+ARRAY_BUFFER = 34962
+ELEMENT_ARRAY_BUFFER = 34963
+
+
+def pad4(n):
+  return (n + 3) & ~3
+
+
+def get_element_size(accessor):
+  return COMPONENT_SIZES[accessor['componentType']] * NUM_COMPONENTS[accessor['type']]
+
+
+def get_restride(view_index, buffer_view, accessors):
+  """Returns (element_size, stride) if the tightly-packed vertex attributes
+  in *buffer_view* need padding out to a stride, or None if they don't.
+  gltf2 requires vertex attribute elements to be 4-byte aligned, but
+  gltf1 allows eg an UNSIGNED_SHORT VEC3 to be tightly packed.
+  Raises ValueError if the view can't be re-strided."""
+  if 'byteStride' in buffer_view:
+    return None
+  sizes = set(get_element_size(accessor) for accessor in accessors)
+  if all(size % 4 == 0 for size in sizes):
+    return None
+  if len(sizes) > 1:
+    raise ValueError("bufferViews[%d]: cannot pad vertex attributes of sizes %s" % (
+      view_index, sorted(sizes)))
+  size = sizes.pop()
+  if (buffer_view['byteLength'] % size != 0 or
+      any(accessor.get('byteOffset', 0) % size != 0 for accessor in accessors)):
+    raise ValueError("bufferViews[%d]: cannot pad vertex attributes that are "
+                     "not tightly packed" % view_index)
+  return size, pad4(size)
+
+
+def repack_buffer_views(gltf):
+  """Lays out the bufferViews that are still referenced (dropping eg the
+  ones that held gltf1 shaders) contiguously and 4-byte aligned in buffer 0,
+  the glb binary chunk, and updates references to them.
+  Vertex attributes that aren't 4-byte aligned are padded; see get_restride.
+  Returns (copies, length): copies is a list of (old_offset, new_offset,
+  byte_length, restride) to copy from the old buffer to the new one;
+  restride is None or the (element_size, stride) to pad elements to."""
+  assert len(gltf['buffers']) == 1, "Only the binary_glTF buffer is supported"
+  referencers = [obj for key in ('accessors', 'images')
+                 for obj in gltf.get(key, []) if 'bufferView' in obj]
+  used = sorted(set(obj['bufferView'] for obj in referencers))
+  attributes = set(index for mesh in gltf.get('meshes', [])
+                   for primitive in mesh.get('primitives', [])
+                   for index in primitive.get('attributes', {}).itervalues())
+  view_accessors = {}
+  for (index, accessor) in enumerate(gltf.get('accessors', [])):
+    if 'bufferView' in accessor:
+      view_accessors.setdefault(accessor['bufferView'], []).append((index, accessor))
+  old_to_new = {}
+  copies = []
+  offset = 0
+  buffer_views = []
+  for old_index in used:
+    buffer_view = gltf['bufferViews'][old_index]
+    offset = pad4(offset)
+    accessors = view_accessors.get(old_index, [])
+    restride = None
+    if any(index in attributes for (index, _) in accessors):
+      restride = get_restride(old_index, buffer_view, [acc for (_, acc) in accessors])
+    copies.append((buffer_view.get('byteOffset', 0), offset, buffer_view['byteLength'],
+                   restride))
+    if restride is not None:
+      size, stride = restride
+      buffer_view['byteLength'] = buffer_view['byteLength'] // size * stride
+      buffer_view['byteStride'] = stride
+      for (_, accessor) in accessors:
+        if 'byteOffset' in accessor:
+          accessor['byteOffset'] = accessor['byteOffset'] // size * stride
+    buffer_view['byteOffset'] = offset
+    offset += buffer_view['byteLength']
+    if buffer_view.get('target') == ELEMENT_ARRAY_BUFFER:
+      # Only vertex attributes may have a stride
+      buffer_view.pop('byteStride', None)
+    old_to_new[old_index] = len(buffer_views)
+    buffer_views.append(buffer_view)
+  for obj in referencers:
+    obj['bufferView'] = old_to_new[obj['bufferView']]
+  gltf['bufferViews'] = buffer_views
+
+  length = pad4(offset)
+  buffer = gltf['buffers'][0]
+  # In a glb, buffer 0 is the binary chunk and has no uri
+  buffer.pop('uri', None)
+  buffer['byteLength'] = length
+  return copies, length
+
+
+class GlbWriter(object):
+  """Writes a glb2 file. The json is written up front; the binary chunk
+  is streamed through write() and must add up to *bin_length* bytes."""
+  def __init__(self, outf, json_text, bin_length):
+    json_text += ' ' * (pad4(len(json_text)) - len(json_text))
+    assert bin_length % 4 == 0
+    self.outf = outf
+    self.bin_length = bin_length
+    self.written = 0
+    length = (GLB2_HEADER.size + GLB2_CHUNK_HEADER.size + len(json_text) +
+              (GLB2_CHUNK_HEADER.size + bin_length if bin_length > 0 else 0))
+    outf.write(GLB2_HEADER.pack('glTF', 2, length))
+    outf.write(GLB2_CHUNK_HEADER.pack(len(json_text), 'JSON'))
+    outf.write(json_text)
+    if bin_length > 0:
+      outf.write(GLB2_CHUNK_HEADER.pack(bin_length, 'BIN\0'))
+
+  def write(self, data):
+    assert self.written + len(data) <= self.bin_length
+    self.outf.write(data)
+    self.written += len(data)
+
+  def pad_to(self, offset):
+    """Pads the binary chunk with zeros up to *offset*."""
+    assert offset >= self.written
+    self.write('\0' * (offset - self.written))
+
+  def close(self):
+    self.pad_to(self.bin_length)
+
+
+def restride(data, size, stride):
+  """Pads each *size*-byte element of *data* with zeros out to *stride* bytes."""
+  out = bytearray(len(data) // size * stride)
+  for i in xrange(size):
+    out[i::stride] = data[i::size]
+  return str(out)
+
+
+def load_glb1(inf, src, check=False):
+  """Reads the json of the glb1 file *inf* (named *src*) and converts it to
+  the json of the glb2 file. Call with the garbage collector disabled.
+  Returns (gltf, copies, bin_length, body_start); see repack_buffer_views.
+  body_start is the offset of the glb1 binary body in *inf*."""
+  header = inf.read(GLB1_HEADER.size)
+  if len(header) != GLB1_HEADER.size:
+    raise ValueError("%s: not a glb1 file" % src)
+  magic, version, _, content_length, content_format = GLB1_HEADER.unpack(header)
+  if magic != 'glTF' or version != 1 or content_format != 0:
+    raise ValueError("%s: not a glb1 file" % src)
+  gltf = json.loads(inf.read(content_length), object_pairs_hook=collections.OrderedDict)
+  convert_json(gltf, check)
+  copies, bin_length = repack_buffer_views(gltf)
+  return gltf, copies, bin_length, GLB1_HEADER.size + content_length
+
+
+def convert_glb(src, dst, chunk_size=1<<20, check=False):
+  """Converts a glb1 file to a glb2 file. Only the json and one chunk of
+  the binary are held in memory at a time. Nothing is left at *dst* (or
+  next to it) if the conversion fails."""
+  with open(src, 'rb') as inf:
+    with gc_disabled():
+      gltf, copies, bin_length, body_start = load_glb1(inf, src, check)
+      json_text = json.dumps(gltf, separators=(',', ':'))
+    del gltf
+
+    tmp = dst + '.tmp'
+    try:
+      with open(tmp, 'wb') as outf:
+        writer = GlbWriter(outf, json_text, bin_length)
+        for (old_offset, new_offset, byte_length, padding) in copies:
+          writer.pad_to(new_offset)
+          inf.seek(body_start + old_offset)
+          # Read whole elements, if they need padding
+          read_size = chunk_size if padding is None else max(
+            padding[0], chunk_size // padding[0] * padding[0])
+          while byte_length > 0:
+            data = inf.read(min(byte_length, read_size))
+            if len(data) == 0:
+              raise ValueError("%s: bufferView extends past end of file" % src)
+            byte_length -= len(data)
+            if padding is not None:
+              if len(data) % padding[0] != 0:
+                raise ValueError("%s: bufferView extends past end of file" % src)
+              data = restride(data, *padding)
+            writer.write(data)
+        writer.close()
+      if os.path.exists(dst):
+        os.unlink(dst)
+      os.rename(tmp, dst)
+    finally:
+      if os.path.exists(tmp):
+        os.unlink(tmp)
 
 
 def write_if_different(filename, contents):
@@ -276,25 +579,98 @@ def write_if_different(filename, contents):
     print("Updated", filename)
 
 
+def is_glb1(filename):
+  with open(filename, 'rb') as inf:
+    header = inf.read(8)
+  return len(header) == 8 and struct.unpack('<4sI', header) == ('glTF', 1)
+
+
+def find_glb1_files(directory):
+  """Returns a sorted list of glb1 files in *directory* and its subdirectories."""
+  found = []
+  for (dirpath, _, filenames) in os.walk(directory):
+    found.extend(os.path.join(dirpath, f) for f in filenames
+                 if f.lower().endswith('.glb') and is_glb1(os.path.join(dirpath, f)))
+  return sorted(found)
+
+
+def convert_file(src, check=False):
+  """Converts a .gltf or .glb file next to itself. Never raises.
+  Returns (src, dst, error message or None)."""
+  if os.path.splitext(src)[1].lower() == '.glb':
+    dst = os.path.splitext(src)[0] + '.2.glb'
+  else:
+    dst = os.path.splitext(src)[0] + '.2.gltf'
+  assert dst != src
+  try:
+    if dst.endswith('.glb'):
+      convert_glb(src, dst, check=check)
+    else:
+      write_if_different(dst, convert(src, check))
+  except Exception as e:
+    return (src, dst, '%s: %s' % (type(e).__name__, e))
+  return (src, dst, None)
+
+
+def convert_files(files, jobs=None, check=False):
+  """Converts files in parallel. Returns the number that failed."""
+  jobs = min(jobs or multiprocessing.cpu_count(), len(files))
+  convert_one = functools.partial(convert_file, check=check)
+  if jobs <= 1:
+    results = (convert_one(f) for f in files)
+  else:
+    pool = multiprocessing.Pool(jobs)
+    results = pool.imap_unordered(convert_one, files)
+  num_failed = 0
+  for (src, dst, error) in results:
+    if error is None:
+      if dst.endswith('.glb'):
+        print("Wrote", dst)
+    else:
+      print("%s: FAILED: %s" % (src, error), file=sys.stderr)
+      num_failed += 1
+  if jobs > 1:
+    pool.close()
+  return num_failed
+
+
 def main(args):
   import argparse
   parser = argparse.ArgumentParser()
-  parser.add_argument('files', nargs=1, help="File to convert")
-  parser.add_argument('--stdout', action='store_true')
+  parser.add_argument('files', nargs='+', help="Files to convert, or directories of .glb files")
+  parser.add_argument('--stdout', action='store_true',
+                      help="Print the converted json of .gltf and .glb files")
+  parser.add_argument('-j', '--jobs', type=int, default=None,
+                      help="Number of files to convert at once (default: number of cpus)")
+  parser.add_argument('--check', action='store_true',
+                      help="Also check for object names left unconverted (slow)")
   args = parser.parse_args(args)
 
+  if args.stdout:
+    for src in args.files:
+      if os.path.isdir(src):
+        parser.error("--stdout doesn't support directories: %s" % src)
+    num_failed = 0
+    for src in args.files:
+      try:
+        if os.path.splitext(src)[1].lower() == '.glb':
+          with open(src, 'rb') as inf, gc_disabled():
+            print(json.dumps(load_glb1(inf, src, args.check)[0], indent=2))
+        else:
+          print(convert(src, args.check))
+      except (IOError, ValueError, LookupError) as e:
+        print("%s: FAILED: %s: %s" % (src, type(e).__name__, e), file=sys.stderr)
+        num_failed += 1
+    return 1 if num_failed else 0
+
+  files = []
   for src in args.files:
-    gltf2 = convert(src)
-    if args.stdout:
-      print(gltf2)
+    if os.path.isdir(src):
+      files.extend(find_glb1_files(src))
     else:
-      dst = os.path.splitext(src)[0] + '.2.gltf'
-      assert dst != src
-      write_if_different(dst, gltf2)
-
-
+      files.append(src)
+  return 1 if convert_files(files, args.jobs, args.check) else 0
 
 
 if __name__ == '__main__':
-  import sys
-  main(sys.argv[1:])
+  sys.exit(main(sys.argv[1:]))
@@ -21,7 +21,12 @@ import sys
 import argparse
 
 from collections import defaultdict
-from subprocess import Popen, PIPE
+
+# Add ../Python to sys.path
+sys.path.append(
+  os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Python'))
+
+from unitybuild.vcs import GitQueries
 
 # Common 11-letter words that shouldn't be interpreted as obfuscated symbols
 COMMON_WORDS_11 = set(['initializer'])
@@ -94,14 +99,15 @@ class ObfuscationMap(object):
       return True
     return False
 
-  def load_from_git_rev(self, git_object):
-    """Additively load entries from the given git object (eg HEAD:Assets/obfuscation_map.txt)"""
-    proc = Popen(['git', 'cat-file', '-p', git_object], stdout=PIPE, stderr=PIPE)
-    stdout, stderr = proc.communicate()
-    if proc.returncode != 0:
-      print >>sys.stderr, "WARN: Couldn't load deobfuscation from '%s'\n%s" % (git_object, stderr)
+  def load_from_git_rev(self, git_object, git_queries):
+    """Additively load entries from the given git object (eg HEAD:Assets/obfuscation_map.txt)
+    git_queries - a unitybuild.vcs.GitQueries"""
+    try:
+      contents = git_queries.cat_file(git_object)
+    except LookupError as e:
+      print >>sys.stderr, "WARN: Couldn't load deobfuscation from '%s'\n%s" % (git_object, e)
       return
-    n = self._load_from_text(stdout)
+    n = self._load_from_text(contents)
     if n > 0 and os.isatty(sys.stdout.fileno()):
       print "Added %d symbols from '%s'" % (n, git_object)
 
@@ -160,11 +166,8 @@ class ObfuscationMap(object):
     return pat.sub(lookup, text)
 
 
-def get_client_root():
-  proc = Popen(['git', 'rev-parse', '--show-toplevel'], stdout=PIPE, stderr=PIPE)
-  stdout, stderr = proc.communicate()
-  assert proc.returncode == 0, "Couldn't determine git client root"
-  return stdout.strip()
+def get_client_root(git_queries):
+  return git_queries.toplevel
 
 
 def format_nicely(txt, verbose):
@@ -298,13 +301,19 @@ def main():
   args = parser.parse_args()
 
   os.chdir(os.path.dirname(os.path.realpath(__file__)))
-  map_file = os.path.join(get_client_root(), args.map_file)
+  try:
+    git_queries = GitQueries()
+  except LookupError:
+    parser.error("Couldn't determine git client root")
+  map_file = os.path.join(get_client_root(git_queries), args.map_file)
   omap = ObfuscationMap()
   omap.load_from_file(map_file)
   # Assumes that the remote is called "origin", but that's typically the case
   args.releases = map(lambda s: 'origin/release/' + s, args.releases)
+  # All of the map files come through a single "git cat-file --batch"
   for branch in itertools.chain(args.releases, args.branches):
-    omap.load_from_git_rev('%s:%s' % (branch, args.map_file))
+    omap.load_from_git_rev('%s:%s' % (branch, args.map_file), git_queries)
+  git_queries.close()
   sys.stdout.flush()
 
   if omap.is_empty():
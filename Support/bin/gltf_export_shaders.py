@@ -29,6 +29,7 @@ Outputs:
 """
 
 import argparse
+import hashlib
 import json
 import os
 import platform
@@ -50,18 +51,17 @@ UPDATED_GUIDS_BY_NAME = {
 def destroy(file_or_dir):
   """Ensure that *file_or_dir* does not exist in the filesystem,
   deleting it if necessary."""
-  import stat
+  def make_writable_and_retry(func, path, exc_info):
+    # Only read-only files need the extra chmod; don't pay for it on every file
+    os.chmod(path, stat.S_IWRITE)
+    func(path)
   if os.path.isfile(file_or_dir):
-    os.chmod(file_or_dir, stat.S_IWRITE)
-    os.unlink(file_or_dir)
+    try:
+      os.unlink(file_or_dir)
+    except OSError:
+      make_writable_and_retry(os.unlink, file_or_dir, None)
   elif os.path.isdir(file_or_dir):
-    for r,ds,fs in os.walk(file_or_dir, topdown=False):
-      for f in fs:
-        os.chmod(os.path.join(r, f), stat.S_IWRITE)
-        os.unlink(os.path.join(r, f))
-      for d in ds:
-        os.rmdir(os.path.join(r, d))
-    os.rmdir(file_or_dir)
+    shutil.rmtree(file_or_dir, onerror=make_writable_and_retry)
   if os.path.exists(file_or_dir):
     raise Exception("Temp build location '%s' is not empty" % file_or_dir)
 
@@ -71,38 +71,87 @@ class PreprocessException(Exception):
   pass
 
 
-def preprocess_lite(input_file, defines, include_dirs):
+class IncludeCache(object):
+  """Fully-expanded text of files read by preprocess_lite(), so that includes
+  shared by many shaders are only read and expanded once.
+  Entries are invalidated if the mtime of the file, or of anything it
+  includes, changes."""
+  def __init__(self):
+    # (filename, include_dirs) -> (expanded text, {dependency: mtime})
+    self._entries = {}
+
+  def get(self, filename, include_dirs):
+    """Returns (text, dependencies) or None."""
+    entry = self._entries.get((filename, include_dirs))
+    if entry is None:
+      return None
+    for (dep, mtime) in entry[1].iteritems():
+      try:
+        if os.path.getmtime(dep) != mtime:
+          return None
+      except OSError:
+        return None
+    return entry
+
+  def put(self, filename, include_dirs, text, dependencies):
+    self._entries[(filename, include_dirs)] = (text, dependencies)
+
+
+_include_cache = IncludeCache()
+
+
+def preprocess_lite(input_file, defines, include_dirs, dependencies=None):
   """Returns contents of input_file with #includes expanded.
 defines is a dict of #defines.
 include_dirs is a list of directories.
-Raises PreprocessException on error."""
+dependencies, if passed, is a set; input_file and every file it includes are added to it.
+Raises PreprocessException on error, including on #include cycles."""
   include_pat = re.compile(r'^[ \t]*#[ \t]*include[ \t]+([<"])(.*)[">].*$\n?', re.MULTILINE)
-  def expand_include(include, current_file, is_quote):
-    """Given the body of an #include, returns replacement text."""
+  include_dirs = tuple(include_dirs)
+  def expand_file(filename, stack):
+    """Returns (expanded text of filename, {dependency: mtime})."""
+    cached = _include_cache.get(filename, include_dirs)
+    if cached is not None:
+      return cached
+    file_deps = {filename: os.path.getmtime(filename)}
+    with open(filename, 'r') as inf:
+      text = inf.read()
+      if not text.endswith('\n'):
+        text += '\n'
+      # uncomment for debugging
+      # text = '// %s\n%s' % (filename, text)
+    def expand_include_match(match):
+      char, body = match.groups()
+      sub_text, sub_deps = expand_include(body, filename, char == '"', stack + [filename])
+      file_deps.update(sub_deps)
+      return sub_text
+    text = include_pat.sub(expand_include_match, text)
+    _include_cache.put(filename, include_dirs, text, file_deps)
+    return text, file_deps
+
+  def expand_include(include, current_file, is_quote, stack):
+    """Given the body of an #include, returns (replacement text, {dependency: mtime})."""
     # https://gcc.gnu.org/onlinedocs/cpp/Include-Syntax.html
     if is_quote:
-      search_path = [os.path.dirname(current_file)] + include_dirs
+      search_path = [os.path.dirname(current_file)] + list(include_dirs)
     else:
       search_path = include_dirs
 
     for include_dir in search_path:
       candidate = os.path.join(include_dir, include)
       if os.path.exists(candidate):
-        with open(candidate, 'r') as inf:
-          candidate_text = inf.read()
-          if not candidate_text.endswith('\n'):
-            candidate_text += '\n'
-          # uncomment for debugging
-          # candidate_text = '// %s\n%s' % (candidate, candidate_text)
-        def expand_include_match(match):
-          char, body = match.groups()
-          return expand_include(body, candidate, char == '"')
-        return include_pat.sub(expand_include_match, candidate_text)
+        candidate = os.path.normpath(candidate)
+        if candidate in stack:
+          raise PreprocessException("%s : fatal error: #include cycle: %s" % (
+            current_file, ' -> '.join(stack[stack.index(candidate):] + [candidate])))
+        return expand_file(candidate, stack)
     else:
       raise PreprocessException("%s : fatal error: Cannot open include file: '%s'" % (
         current_file, include))
 
-  contents = expand_include(input_file, input_file, True)
+  contents, file_deps = expand_include(input_file, input_file, True, [])
+  if dependencies is not None:
+    dependencies.update(file_deps)
   # inject defines
   defines = ["#define %s %s\n" % (k, v)
              for (k, v) in sorted(defines.items())
@@ -184,6 +233,67 @@ def get_defines(brush):
   return defines
 
 
+class DependencyManifest(object):
+  """Records what each generated shader was made from: the brush's #defines,
+  and the path and hash of every file that preprocess_lite() read.
+  Used to skip regenerating shaders whose inputs haven't changed."""
+  def __init__(self, filename):
+    self.filename = filename
+    # Changes to this script can change every output
+    self.generator_hash = self.hash_file(os.path.abspath(__file__).replace('.pyc', '.py'))
+    self.entries = {}
+    try:
+      with open(filename) as inf:
+        data = json.load(inf)
+      if data['generator'] == self.generator_hash:
+        self.entries = data['outputs']
+    except (IOError, ValueError, KeyError):
+      pass
+    # Avoid re-hashing the same include for every brush
+    self._hash_cache = {}
+
+  @staticmethod
+  def hash_file(filename):
+    try:
+      with open(filename, 'rb') as inf:
+        return hashlib.sha1(inf.read()).hexdigest()
+    except IOError:
+      return None
+
+  def get_hash(self, filename):
+    """Returns the sha1 of *filename*, or None if it doesn't exist."""
+    try:
+      return self._hash_cache[filename]
+    except KeyError:
+      ret = self._hash_cache[filename] = self.hash_file(filename)
+      return ret
+
+  def is_up_to_date(self, key, final_output_file, defines):
+    """Returns True if *final_output_file* was generated from the same inputs
+    that would be used now."""
+    entry = self.entries.get(key)
+    if entry is None or entry['defines'] != defines:
+      return False
+    if self.get_hash(final_output_file) != entry['output']:
+      return False
+    return all(self.get_hash(dep) == dep_hash
+               for (dep, dep_hash) in entry['dependencies'].iteritems())
+
+  def record(self, key, output_data, defines, dependencies):
+    self.entries[key] = {
+      'defines': defines,
+      'output': hashlib.sha1(output_data).hexdigest(),
+      'dependencies': dict((dep, self.get_hash(dep)) for dep in dependencies),
+    }
+
+  def save(self):
+    try: os.makedirs(os.path.dirname(self.filename))
+    except OSError: pass
+    with open(self.filename, 'w') as outf:
+      json.dump({'generator': self.generator_hash, 'outputs': self.entries},
+                outf, indent=1, sort_keys=True)
+
+
 class Generator(object):
   """Instantiate this class to run generate()."""
   def __init__(self, input_dir, include_dirs, brush_manifest_file):
@@ -222,11 +332,13 @@ class Generator(object):
       # Unity Standard Diffuse + Specular.
       return "FragStandard.glsl"
 
-  def generate(self, out_root):
-    """Generate output for all brushes in the manifest."""
-    brushes = self.brush_manifest["brushes"]
-    for guid, brush in brushes.iteritems():
-      self.generate_brush(brush, out_root)
+  def generate(self, out_root, final_root=None, dependency_manifest=None):
+    """Generate output for all brushes in the manifest.
+    If *dependency_manifest* is passed, shaders whose copy in *final_root*
+    is up to date are skipped.
+    Returns the number of shaders generated."""
+    return sum(self.generate_brush(brush, out_root, final_root, dependency_manifest)
+               for brush in self.brush_manifest["brushes"].values())
 
   def copy_from_prev_brush(self, brush, out_dir):
     """Copies vert and frag shaders from brush's predecessor, if possible."""
@@ -251,9 +363,10 @@ class Generator(object):
     maybe_copy('vertexShader')
     maybe_copy('fragmentShader')
 
-  def generate_brush(self, brush, out_root):
+  def generate_brush(self, brush, out_root, final_root=None, dependency_manifest=None):
     """Generate output for a single brush in the manifest.
-    Pass the manifest entry."""
+    Pass the manifest entry.
+    Returns the number of shaders generated."""
     name = brush["name"]
     version = brush["shaderVersion"]
     guid = brush["guid"]
@@ -263,6 +376,7 @@ class Generator(object):
     color_params = brush["colorParams"]
 
     defines = get_defines(brush)
+    num_generated = 0
 
     # Vertex shader
 
@@ -273,7 +387,8 @@ class Generator(object):
     if not os.path.exists(vert_input):
       print "Auto-creating %s" % os.path.basename(vert_input)
       file(vert_input, 'w').write('#include "VertDefault.glsl"\n')
-    self.preprocess(vert_input, vert_output, defines, self.include_dirs)
+    num_generated += self.preprocess(vert_input, vert_output, defines, self.include_dirs,
+                                     out_root, final_root, dependency_manifest)
 
     # Fragment shader
 
@@ -282,18 +397,32 @@ class Generator(object):
     if not os.path.exists(frag_input):
       print "Auto-creating %s" % os.path.basename(frag_input)
       file(frag_input, 'w').write('#include "%s"\n' % self.get_frag_template(brush))
-    self.preprocess(frag_input, frag_output, defines, self.include_dirs)
+    num_generated += self.preprocess(frag_input, frag_output, defines, self.include_dirs,
+                                     out_root, final_root, dependency_manifest)
+    return num_generated
 
-  def preprocess(self, input_file, output_file, defines, include_dirs):
+  def preprocess(self, input_file, output_file, defines, include_dirs,
+                 out_root=None, final_root=None, dependency_manifest=None):
     """Wrapper around global preprocess that does some massaging of
-    the input and output."""
-    output_data = preprocess_lite(input_file, defines, include_dirs)
+    the input and output.
+    Skips the work if *dependency_manifest* says the copy of *output_file*
+    in *final_root* is up to date. Returns 1 if the output was generated, else 0."""
+    if dependency_manifest is not None:
+      key = os.path.relpath(output_file, out_root).replace('\\', '/')
+      final_output_file = os.path.join(final_root, key)
+      if dependency_manifest.is_up_to_date(key, final_output_file, defines):
+        return 0
+    dependencies = set()
+    output_data = preprocess_lite(input_file, defines, include_dirs, dependencies)
     try:
       os.makedirs(os.path.dirname(output_file))
     except OSError:
       pass
     with file(output_file, 'w') as outf:
       outf.write(output_data)
+    if dependency_manifest is not None:
+      dependency_manifest.record(key, output_data, defines, dependencies)
+    return 1
 
 
 def finalize_dir(tmp_dir, out_dir):
@@ -344,6 +473,8 @@ def main():
                       help='Path to exportManifest.json (optional)')
   parser.add_argument('export_root', nargs='?', default=None,
                       help='Output root directory (optional)')
+  parser.add_argument('-f', '--force', action='store_true',
+                      help='Regenerate all shaders, even those whose inputs are unchanged')
   args = parser.parse_args()
 
   project_root = os.path.normpath(
@@ -358,10 +489,18 @@ def main():
   include_dirs = [os.path.join(project_root, 'Support/GlTFShaders/include')]
 
   gen = Generator(input_dir, include_dirs, args.brush_manifest)
+  dependency_manifest = DependencyManifest(
+    os.path.join(project_root, 'Library', 'gltf_export_shaders.json'))
+  if args.force:
+    dependency_manifest.entries = {}
   destroy(tmp_dir)
-  gen.generate(tmp_dir)
-  print "Writing to %s" % os.path.normpath(args.export_root)
-  finalize_dir(tmp_dir, args.export_root)
+  num_generated = gen.generate(tmp_dir, args.export_root, dependency_manifest)
+  print "Generated %d shaders; writing to %s" % (
+    num_generated, os.path.normpath(args.export_root))
+  if os.path.exists(tmp_dir):
+    finalize_dir(tmp_dir, args.export_root)
+  # Only record the new outputs once they're actually in place
+  dependency_manifest.save()
   destroy(tmp_dir)
 
 
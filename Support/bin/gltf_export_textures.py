@@ -23,13 +23,16 @@ Input is a .json file generated by SyncExportMaterials.
 """
 
 import argparse
+import itertools
 import json
+import multiprocessing
 import os
 import platform
 import re
 import shutil
 import stat
 import sys
+import time
 
 try:
   import PIL
@@ -46,7 +49,10 @@ MEG = 1024.0*1024.0
 BLUR_RADIUS_TEXELS = 1.0
 
 def process_request(request):
-  """Process a single downsample-and-copy request"""
+  """Process a single downsample-and-copy request.
+  Returns a dict with the keys input_bytes, output_bytes, seconds.
+  These are also stored into the request."""
+  start = time.time()
   im = PIL.Image.open(request['source'])
   if 'P' in im.mode:
     assert False, "Unexpected: png with indexed color"
@@ -75,9 +81,52 @@ def process_request(request):
 
   outdir = os.path.dirname(request['destination'])
   if not os.path.isdir(outdir):
-    os.makedirs(outdir)
+    try: os.makedirs(outdir)
+    except OSError: pass  # Another worker may have created it
 
   im.save(request['destination'])
+  request['seconds'] = time.time() - start
+  return dict((k, request[k]) for k in ('input_bytes', 'output_bytes', 'seconds'))
+
+
+def get_request_params(request):
+  """Returns everything that affects the output of *request*."""
+  return {
+    'source': request['source'],
+    'desiredWidth': request['desiredWidth'],
+    'desiredHeight': request['desiredHeight'],
+    'isBump': request['isBump'],
+    'blurRadius': BLUR_RADIUS_TEXELS,
+  }
+
+
+def is_up_to_date(request, manifest):
+  """Returns True if the destination of *request* was made from the same source
+  and parameters, and is newer than the source."""
+  entry = manifest.get(request['destination'])
+  if entry is None or entry['params'] != get_request_params(request):
+    return False
+  try:
+    return (os.path.getmtime(request['destination']) >=
+            os.path.getmtime(request['source']))
+  except OSError:
+    return False
+
+
+def load_manifest(filename):
+  """Returns a dict mapping destination to {'params', 'input_bytes', 'output_bytes'}"""
+  try:
+    with open(filename) as inf:
+      return json.load(inf)
+  except (IOError, ValueError):
+    return {}
+
+
+def save_manifest(filename, manifest):
+  try: os.makedirs(os.path.dirname(filename))
+  except OSError: pass
+  with open(filename, 'w') as outf:
+    json.dump(manifest, outf, indent=1, sort_keys=True)
 
 
 def main():
@@ -87,15 +136,62 @@ def main():
   parser = argparse.ArgumentParser()
   parser.add_argument('requests', nargs='?', default=None,
                       help='Path to a json containing export requests')
+  parser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count(),
+                      help='Number of processes to use (default: %(default)s)')
+  parser.add_argument('-f', '--force', action='store_true',
+                      help='Process all requests, even those that look up-to-date')
+  parser.add_argument('-v', '--verbose', action='store_true',
+                      help='Print the time taken by every request')
+  parser.add_argument('--manifest', default=None,
+                      help='Records what each destination was made from, so it can be skipped '
+                      'next time. (default: Library/gltf_export_textures.json)')
   args = parser.parse_args()
   if args.requests is None:
     args.requests = os.path.join(project_root, 'Temp', 'ExportRequests.json')
+  if args.manifest is None:
+    args.manifest = os.path.join(project_root, 'Library', 'gltf_export_textures.json')
 
   with open(args.requests) as inf:
     requests = json.load(inf)
 
+  manifest = {} if args.force else load_manifest(args.manifest)
+  todo = []
   for request in requests['exports']:
-    process_request(request)
+    if is_up_to_date(request, manifest):
+      entry = manifest[request['destination']]
+      request['input_bytes'] = entry['input_bytes']
+      request['output_bytes'] = entry['output_bytes']
+      request['seconds'] = 0
+    else:
+      manifest.pop(request['destination'], None)
+      todo.append(request)
+
+  start = time.time()
+  pool = multiprocessing.Pool(args.jobs) if args.jobs > 1 and len(todo) > 1 else None
+  try:
+    if pool is not None:
+      results = pool.imap(process_request, todo)
+    else:
+      results = itertools.imap(process_request, todo)
+    for (request, result) in itertools.izip(todo, results):
+      request.update(result)
+      manifest[request['destination']] = {
+        'params': get_request_params(request),
+        'input_bytes': request['input_bytes'],
+        'output_bytes': request['output_bytes'],
+      }
+  finally:
+    if pool is not None:
+      pool.terminate()
+    # Remember whatever did get done
+    save_manifest(args.manifest, manifest)
+  elapsed = time.time() - start
+
+  by_time = sorted(todo, key=lambda r: r['seconds'], reverse=True)
+  for request in (by_time if args.verbose else by_time[:5]):
+    print "  %6.2fs  %s" % (request['seconds'], request['destination'])
+  print "Processed %d of %d requests in %.2fs (%d jobs)" % (
+    len(todo), len(requests['exports']), elapsed, args.jobs)
 
   input_bytes = sum(r['input_bytes'] for r in requests['exports'])
   output_bytes = sum(r['output_bytes'] for r in requests['exports'])
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+# Copyright 2020 The Tilt Brush Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Usage (with Support/Python on PYTHONPATH):
+#   python test_compare_glb.py
+
+import json
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+import compare_glb
+
+POSITIONS = [0.0, 0.0, 0.0,  1.0, 0.0, 0.0,  0.0, 1.0, 0.0]
+
+
+def write_glb2(filename, positions=POSITIONS, edit=None, positions2=None):
+  """Writes a one-triangle glb2, plus an accessor (of positions2, which
+  defaults to positions) that no primitive uses.
+  edit, if passed, is called with the json before it is written."""
+  accessors = []
+  buffer_views = []
+  bin_chunk = ''
+  for (i, values) in enumerate([positions, positions2 or positions]):
+    buffer_views.append({'buffer': 0, 'byteOffset': len(bin_chunk), 'byteLength': 36})
+    bin_chunk += struct.pack('<9f', *values)
+    accessors.append({'bufferView': i, 'byteOffset': 0, 'componentType': 5126,
+                      'count': 3, 'type': 'VEC3',
+                      'min': [min(values[j::3]) for j in range(3)],
+                      'max': [max(values[j::3]) for j in range(3)]})
+  gltf = {
+    'asset': {'version': '2.0'},
+    'buffers': [{'byteLength': len(bin_chunk)}],
+    'bufferViews': buffer_views,
+    'accessors': accessors,
+    'meshes': [{'name': 'mesh', 'primitives': [{'attributes': {'POSITION': 0}}]}],
+  }
+  if edit is not None:
+    edit(gltf)
+  json_chunk = json.dumps(gltf)
+  json_chunk += ' ' * (-len(json_chunk) % 4)
+  with open(filename, 'wb') as outf:
+    outf.write(struct.pack('<4sII', 'glTF', 2,
+                           12 + 8 + len(json_chunk) + 8 + len(bin_chunk)))
+    outf.write(struct.pack('<I4s', len(json_chunk), 'JSON') + json_chunk)
+    outf.write(struct.pack('<I4s', len(bin_chunk), 'BIN\0') + bin_chunk)
+
+
+class TestCompareGlb(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.baseline = os.path.join(self.dir, 'baseline.glb')
+    self.latest = os.path.join(self.dir, 'latest.glb')
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def compare(self):
+    return compare_glb.compare_glb(self.latest, self.baseline, binary=True)
+
+  def test_identical(self):
+    write_glb2(self.baseline)
+    write_glb2(self.latest)
+    self.assertEqual(self.compare(), (True, 'IDENTICAL'))
+
+  def test_max_changed_with_identical_binary(self):
+    def edit(gltf):
+      gltf['accessors'][0]['max'][0] = 2.0
+    write_glb2(self.baseline)
+    write_glb2(self.latest, edit=edit)
+    same, details = self.compare()
+    self.assertFalse(same)
+    self.assertIn('accessors/0/max', details)
+
+  def test_unused_max_changed_with_noisy_binary(self):
+    noisy = [x + 1e-7 for x in POSITIONS]
+    def edit(gltf):
+      gltf['accessors'][1]['max'][0] = 2.0
+    write_glb2(self.baseline)
+    write_glb2(self.latest, positions=noisy, edit=edit)
+    same, details = self.compare()
+    self.assertFalse(same)
+    self.assertIn('accessors/1/max', details)
+
+  def test_noisy_binary_within_tolerance(self):
+    noisy = [x + 1e-7 for x in POSITIONS]
+    def edit(gltf):
+      gltf['meshes'][0]['primitives'].append({'attributes': {'POSITION': 1}})
+    write_glb2(self.baseline, edit=edit)
+    write_glb2(self.latest, positions=noisy, edit=edit)
+    same, details = self.compare()
+    self.assertTrue(same, details)
+
+  def test_meshes_with_same_name(self):
+    shifted = [x + 5 for x in POSITIONS]
+    def edit(gltf):
+      gltf['meshes'].append({'name': 'mesh', 'primitives': [{'attributes': {'POSITION': 1}}]})
+    write_glb2(self.baseline, edit=edit)
+    write_glb2(self.latest, positions2=shifted, edit=edit)
+    same, details = self.compare()
+    self.assertFalse(same)
+    self.assertIn('FAIL mesh#2[0] POSITION', details)
+
+  def test_mesh_name_collision(self):
+    noisy = [x + 1e-7 for x in POSITIONS]
+    def edit(gltf):
+      for name in ('mesh#2', 'mesh'):
+        gltf['meshes'].append({'name': name, 'primitives': [{'attributes': {'POSITION': 1}}]})
+    write_glb2(self.baseline, edit=edit)
+    write_glb2(self.latest, positions=noisy, edit=edit)
+    same, details = self.compare()
+    self.assertFalse(same)
+    self.assertIn('mesh#2[0]: more than one primitive with this name', details)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+# Copyright 2020 The Tilt Brush Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Usage:
+#   python test_convert_gltf1.py
+
+import copy
+import unittest
+
+import convert_gltf1
+from convert_gltf1 import GLTF1_REFERENCES
+
+
+def make_gltf1():
+  """Returns gltf1 json that uses every kind of by-name reference.
+  Objects are named '<collection>_<n>', except for the binary_glTF buffer."""
+  return {
+    'asset': {'version': '1.0'},
+    'scene': 'scenes_0',
+    'scenes': {'scenes_0': {'nodes': ['nodes_0']}},
+    'nodes': {
+      'nodes_0': {'children': ['nodes_1'], 'meshes': ['meshes_0'], 'camera': 'cameras_0'},
+      'nodes_1': {},
+    },
+    'cameras': {'cameras_0': {'type': 'perspective',
+                              'perspective': {'yfov': 1.0, 'znear': 0.1}}},
+    'meshes': {'meshes_0': {'primitives': [{
+      'attributes': {'POSITION': 'accessors_0'},
+      'indices': 'accessors_1',
+      'material': 'materials_0'}]}},
+    'accessors': {
+      'accessors_0': {'bufferView': 'bufferViews_0', 'componentType': 5126,
+                      'type': 'VEC3', 'count': 1, 'byteStride': 12},
+      'accessors_1': {'bufferView': 'bufferViews_1', 'componentType': 5123,
+                      'type': 'SCALAR', 'count': 3, 'byteStride': 0},
+    },
+    'bufferViews': {
+      'bufferViews_0': {'buffer': 'binary_glTF', 'byteOffset': 0, 'byteLength': 12},
+      'bufferViews_1': {'buffer': 'binary_glTF', 'byteOffset': 12, 'byteLength': 6},
+      'bufferViews_2': {'buffer': 'binary_glTF', 'byteOffset': 20, 'byteLength': 4},
+    },
+    'buffers': {'binary_glTF': {'type': 'arraybuffer', 'byteLength': 24}},
+    'materials': {'materials_0': {
+      'technique': 'techniques_0',
+      'values': {'BaseColorFactor': [1, 1, 1, 1], 'BaseColorTex': 'textures_0',
+                 'MetallicFactor': 0, 'RoughnessFactor': 1}}},
+    'techniques': {'techniques_0': {'program': 'programs_0'}},
+    'programs': {'programs_0': {'vertexShader': 'shaders_0'}},
+    'shaders': {'shaders_0': {'uri': 'vertex.glsl'}},
+    'textures': {'textures_0': {'sampler': 'samplers_0', 'source': 'images_0'}},
+    'samplers': {'samplers_0': {}},
+    'images': {'images_0': {'extensions': {'KHR_binary_glTF': {
+      'bufferView': 'bufferViews_2', 'mimeType': 'image/png'}}}},
+  }
+
+
+def iter_references(gltf, collection, path):
+  """Yields every value at *path* in the objects of *collection*."""
+  objs = [gltf] if collection == '' else gltf.get(collection, [])
+  def walk(obj, path):
+    if len(path) == 0:
+      yield obj
+      return
+    prop, rest = path[0], path[1:]
+    if prop == '*':
+      children = obj.values() if isinstance(obj, dict) else obj
+    elif prop in obj:
+      children = [obj[prop]]
+    else:
+      children = []
+    for child in children:
+      for value in walk(child, rest):
+        yield value
+  for obj in objs:
+    for value in walk(obj, path):
+      yield value
+
+
+class TestConvertGltf1(unittest.TestCase):
+  def test_every_reference_is_resolved(self):
+    gltf2 = convert_gltf1.convert_json(make_gltf1())
+    for (collection, path, target) in GLTF1_REFERENCES:
+      values = list(iter_references(gltf2, collection, path))
+      self.assertTrue(values, "make_gltf1() doesn't use %s %s" % (collection, path))
+      for value in values:
+        self.assertIs(type(value), int, "%s %s: %r" % (collection, path, value))
+        name = gltf2[target][value]['name']
+        self.assertTrue(name.startswith(target + '_') or name == 'binary_glTF',
+                        "%s %s: %s is not in %s" % (collection, path, name, target))
+
+  def test_no_names_left(self):
+    gltf2 = convert_gltf1.convert_json(make_gltf1(), check=True)
+    self.assertEqual([node['camera'] for node in gltf2['nodes'] if 'camera' in node], [0])
+
+  def test_dangling_reference(self):
+    gltf = make_gltf1()
+    gltf['nodes']['nodes_0']['camera'] = 'nope'
+    with self.assertRaises(LookupError) as context:
+      convert_gltf1.convert_json(gltf)
+    self.assertRegexpMatches(str(context.exception), r'nodes\[\d\]\.camera: No cameras named nope')
+
+  def test_check_finds_unknown_reference(self):
+    gltf = make_gltf1()
+    gltf['nodes']['nodes_0']['skin'] = 'nodes_1'
+    convert_gltf1.convert_json(copy.deepcopy(gltf))
+    with self.assertRaises(LookupError) as context:
+      convert_gltf1.convert_json(gltf, check=True)
+    self.assertIn('skin: nodes_1 was not converted', str(context.exception))
+
+
+if __name__ == '__main__':
+  unittest.main()